@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+'''benchmarks of the Python-side hot paths of neural, using synthetic data
+
+Usage::
+
+    python benchmarks/run_benchmarks.py [--sizes small,medium] [--only dset_info,scan_dir] [--repeat 5]
+                                        [--output results.json] [--compare old_results.json]
+
+All of the data is generated into a temporary directory, and the AFNI programs that get called are replaced
+with the fake ones in :mod:`stubs`, so AFNI doesn't need to be installed. The results (and some information
+about the machine) are printed as JSON, or saved to ``--output``. With ``--compare``, the speed-up relative to
+an earlier results file is printed for each benchmark as well.
+
+The ``neural`` in this checkout is the one that is benchmarked, not an installed copy'''
+import os,sys,time,json,argparse,tempfile,shutil,platform,subprocess,datetime,gc,multiprocessing
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(bench_dir))
+sys.path.insert(0,bench_dir)
+
+import numpy as np
+import neural as nl
+import neural.general,neural.eprime,neural.decon,neural.preprocess,neural.alignment,neural.qc,neural.dicom
+import synthetic,stubs
+
+#! Parameters used for each benchmark at each size
+sizes = {
+    'small': {
+        'nifti_shape': (16,16,10,50),
+        'dicom': {'num_series':2,'slices':10,'reps':5,'duplicates':10},
+        'eprime_frames': 100,
+        'motion_reps': 200,
+        'stims': {'runs':2,'stims':4,'events':20,'reps':150},
+        'outcount_reps': 150,
+        'voxel_shape': (16,16,10,20),
+    },
+    'medium': {
+        'nifti_shape': (64,64,32,200),
+        'dicom': {'num_series':4,'slices':20,'reps':10,'duplicates':50},
+        'eprime_frames': 1000,
+        'motion_reps': 1000,
+        'stims': {'runs':6,'stims':10,'events':40,'reps':300},
+        'outcount_reps': 600,
+        'voxel_shape': (32,32,20,50),
+    },
+    'large': {
+        'nifti_shape': (96,96,48,400),
+        'dicom': {'num_series':8,'slices':30,'reps':20,'duplicates':200},
+        'eprime_frames': 5000,
+        'motion_reps': 5000,
+        'stims': {'runs':12,'stims':20,'events':80,'reps':600},
+        'outcount_reps': 2000,
+        'voxel_shape': (64,64,32,100),
+    }
+}
+
+#! List of ``(name,setup function)``. The setup function is called with the temporary directory and the size
+#! parameters, and returns ``(params,function to time)``
+benchmarks = []
+
+def benchmark(func):
+    '''adds a setup function to :data:`benchmarks`'''
+    benchmarks.append((func.__name__.replace('bench_',''),func))
+    return func
+
+@benchmark
+def bench_dset_info(data_dir,size):
+    '''reading a NIfTI header with :meth:`neural.dset_info` (with the info cache off)'''
+    dset = synthetic.make_nifti(os.path.join(data_dir,'dset_info.nii.gz'),size['nifti_shape'])
+    def run():
+        enabled = nl.dsets.info_cache.enabled
+        nl.dsets.info_cache.enabled = False
+        try:
+            nl.dset_info(dset)
+        finally:
+            nl.dsets.info_cache.enabled = enabled
+    return ({'shape':size['nifti_shape']},run)
+
+@benchmark
+def bench_dset_info_cached(data_dir,size):
+    '''repeated :meth:`neural.dset_info` calls that hit the in-memory cache'''
+    dset = synthetic.make_nifti(os.path.join(data_dir,'dset_info_cached.nii.gz'),size['nifti_shape'])
+    nl.dset_info(dset)
+    return ({'shape':size['nifti_shape']},lambda: nl.dset_info(dset))
+
+def _dicom_dir(data_dir,size):
+    directory = os.path.join(data_dir,'dicom')
+    if not os.path.exists(directory):
+        synthetic.make_dicom_series(directory,**size['dicom'])
+    return directory
+
+@benchmark
+def bench_scan_dir(data_dir,size):
+    '''reading the default tags of every file with :meth:`neural.dicom.scan_dir`'''
+    directory = _dicom_dir(data_dir,size)
+    return (dict(size['dicom'],files=len(os.listdir(directory))),lambda: nl.dicom.scan_dir(directory))
+
+@benchmark
+def bench_find_dups(data_dir,size):
+    '''finding duplicate files in the output of :meth:`neural.dicom.scan_dir`'''
+    directory = _dicom_dir(data_dir,size)
+    file_dict = nl.dicom.scan_dir(directory)
+    return (dict(size['dicom'],files=len(file_dict)),lambda: nl.dicom.find_dups(file_dict))
+
+@benchmark
+def bench_cluster_files(data_dir,size):
+    '''grouping the output of :meth:`neural.dicom.scan_dir` into series'''
+    directory = _dicom_dir(data_dir,size)
+    file_dict = nl.dicom.scan_dir(directory)
+    return (dict(size['dicom'],files=len(file_dict)),lambda: nl.dicom.cluster_files(file_dict))
+
+@benchmark
+def bench_parse_frames(data_dir,size):
+    '''parsing every frame of an E-Prime log with :meth:`neural.eprime.parse_frames`'''
+    log = synthetic.make_eprime_log(os.path.join(data_dir,'eprime.txt'),size['eprime_frames'])
+    return ({'frames':size['eprime_frames']},lambda: list(nl.eprime.parse_frames(log)))
+
+def _decon_stims(data_dir,size,run):
+    '''a ``dict`` of :class:`neural.decon.DeconStim` for a single run, half ``stim_times`` and half columns
+    (read into memory, since :meth:`neural.decon.DeconStim.concat_stim` only reads the file of the first stim)'''
+    s = size['stims']
+    stims = {}
+    for i in xrange(s['stims']):
+        name = 'stim%d' % i
+        if i % 2:
+            stims[name] = nl.decon.DeconStim(name,times_file=synthetic.make_stim_times(os.path.join(data_dir,'%s_run%d.txt' % (name,run)),1,s['events'],seed=run*100+i))
+        else:
+            stims[name] = nl.decon.DeconStim(name,column_file=synthetic.make_stim_column(os.path.join(data_dir,'%s_run%d.1D' % (name,run)),s['reps'],seed=run*100+i))
+        stims[name].reps = s['reps']
+        stims[name].read_file()
+    return stims
+
+@benchmark
+def bench_stack_decon_stims(data_dir,size):
+    '''concatenating the stimuli of every run with :meth:`neural.decon.stack_decon_stims`'''
+    s = size['stims']
+    runs = [_decon_stims(data_dir,size,r) for r in xrange(s['runs'])]
+    return (s,lambda: nl.decon.stack_decon_stims(runs))
+
+@benchmark
+def bench_decon_command_list(data_dir,size):
+    '''building a 3dDeconvolve command with :meth:`neural.decon.Decon.command_list`'''
+    s = size['stims']
+    stim_dir = os.path.join(data_dir,'decon')
+    os.makedirs(stim_dir)
+    stims = nl.decon.stack_decon_stims([_decon_stims(stim_dir,size,r) for r in xrange(s['runs'])])
+    decon = nl.decon.Decon()
+    decon.input_dsets = ['run%d.nii.gz' % r for r in xrange(s['runs'])]
+    decon.decon_stims = stims
+    for i in xrange(s['stims']):
+        decon.stim_times['extra%d' % i] = synthetic.make_stim_times(os.path.join(stim_dir,'extra%d.txt' % i),s['runs'],s['events'],seed=i)
+    decon.glts = dict([('stim%d-stim%d' % (i,i+1),'stim%d -stim%d' % (i,i+1)) for i in xrange(s['stims']-1)])
+    decon.prefix = 'decon.nii.gz'
+    def run():
+        with nl.run_in(stim_dir):
+            decon.command_list()
+    return (s,run)
+
+@benchmark
+def bench_create_censor_file(data_dir,size):
+    '''making a censor file with :meth:`neural.preprocess.create_censor_file` (``3dToutcount`` is stubbed)'''
+    reps = size['outcount_reps']
+    dset = synthetic.make_nifti(os.path.join(data_dir,'censor.nii.gz'),(4,4,4,reps))
+    motion = synthetic.make_motion_params(os.path.join(data_dir,'censor_motion.1D'),reps)
+    out = os.path.join(data_dir,'censor.1D')
+    return ({'reps':reps},lambda: nl.preprocess.create_censor_file(dset,out,motion_file=motion,motion_exclude=10.0))
+
+@benchmark
+def bench_outcount_native(data_dir,size):
+    '''counting the outliers at each time point in Python with :meth:`neural.qc.outcount_native`'''
+    dset = synthetic.make_nifti(os.path.join(data_dir,'outcount.nii'),size['voxel_shape'])
+    return ({'shape':size['voxel_shape']},lambda: nl.qc.outcount_native(dset,polort=3))
+
+@benchmark
+def bench_motion_from_params(data_dir,size):
+    '''calculating motion regressors with :meth:`neural.alignment.motion_from_params`'''
+    reps = size['motion_reps']
+    params = synthetic.make_motion_params(os.path.join(data_dir,'motion_params.1D'),reps)
+    out = os.path.join(data_dir,'motion.1D')
+    return ({'reps':reps},lambda: nl.alignment.motion_from_params(params,out))
+
+@benchmark
+def bench_voxel_loop(data_dir,size):
+    '''iterating over every voxel with :meth:`neural.general.Analyze.voxel_loop`'''
+    dset = synthetic.make_nifti(os.path.join(data_dir,'voxel_loop.nii.gz'),size['voxel_shape'])
+    analyze = nl.general.Analyze(dset)
+    def run():
+        for voxel in analyze.voxel_loop():
+            pass
+    return ({'shape':size['voxel_shape']},run)
+
+@benchmark
+def bench_roi_stats(data_dir,size):
+    '''statistics in every ROI of a 20-ROI atlas with :meth:`neural.roi_stats` (calculated in Python)'''
+    shape = size['voxel_shape']
+    dset = synthetic.make_nifti(os.path.join(data_dir,'roi_stats.nii.gz'),shape)
+    atlas = synthetic.make_nifti(os.path.join(data_dir,'roi_atlas.nii.gz'),shape[:3])
+    nl.general.Analyze(atlas).save(np.random.RandomState(0).randint(0,21,shape[:3]).astype(np.int16),atlas)
+    nl.roi_stats(atlas,dset,native=True)
+    return ({'shape':shape,'rois':20},lambda: nl.roi_stats(atlas,dset,native=True))
+
+@benchmark
+def bench_seed_maps(data_dir,size):
+    '''correlation maps of 50 seeds with :meth:`neural.connectivity.correlation_maps`'''
+    shape = size['voxel_shape']
+    dset = synthetic.make_nifti(os.path.join(data_dir,'seed_maps.nii'),shape)
+    rand = np.random.RandomState(0)
+    seeds = [tuple(x) for x in rand.uniform(-10,10,(50,3))]
+    return ({'shape':shape,'seeds':len(seeds)},lambda: nl.connectivity.correlation_maps(dset,seeds,radius=4))
+
+def _coefficient_of_variation(x):
+    return x.std(axis=1) / x.mean(axis=1)
+
+@benchmark
+def bench_voxel_apply(data_dir,size):
+    '''a voxel-wise statistic over the whole dataset with :meth:`neural.general.Analyze.apply`'''
+    dset = synthetic.make_nifti(os.path.join(data_dir,'voxel_apply.nii'),size['voxel_shape'])
+    analyze = nl.general.Analyze(dset)
+    return ({'shape':size['voxel_shape']},lambda: analyze.apply(_coefficient_of_variation))
+
+@benchmark
+def bench_summary_maps(data_dir,size):
+    '''mean, standard deviation, tSNR and DVARS of a dataset with :meth:`neural.qc.summary_maps`'''
+    dset = synthetic.make_nifti(os.path.join(data_dir,'summary_maps.nii'),size['voxel_shape'])
+    return ({'shape':size['voxel_shape']},lambda: nl.qc.summary_maps(dset))
+
+@benchmark
+def bench_max_diff(data_dir,size):
+    '''comparing two nearly identical datasets with :meth:`neural.dicom.max_diff`'''
+    dset = synthetic.make_nifti(os.path.join(data_dir,'max_diff.nii'),size['voxel_shape'])
+    analyze = nl.general.Analyze(dset,mmap=False)
+    data = analyze.data.copy()
+    data[...,-1] += 1
+    other = os.path.join(data_dir,'max_diff_other.nii')
+    analyze.save(data,other)
+    return ({'shape':size['voxel_shape']},lambda: nl.dicom.max_diff(dset,other))
+
+def time_function(func,repeat=5,min_time=0.0):
+    '''runs ``func`` ``repeat`` times (or until it has run for ``min_time`` seconds) and returns the list
+    of wall-clock times'''
+    times = []
+    total = 0.
+    gc_enabled = gc.isenabled()
+    try:
+        while len(times)<repeat or total<min_time:
+            gc.collect()
+            gc.disable()
+            start = time.time()
+            func()
+            times.append(time.time()-start)
+            if gc_enabled:
+                gc.enable()
+            total += times[-1]
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return times
+
+def machine_info():
+    '''information about where the benchmarks were run, saved with the results'''
+    try:
+        commit = subprocess.check_output(['git','rev-parse','HEAD'],cwd=bench_dir,stderr=open(os.devnull,'w')).strip()
+    except (subprocess.CalledProcessError,OSError):
+        commit = None
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': multiprocessing.cpu_count(),
+        'numpy': np.__version__,
+        'commit': commit
+    }
+
+def run_benchmarks(size_names,only=None,repeat=5,min_time=0.0):
+    '''runs each benchmark at each size and returns the list of results'''
+    results = []
+    with stubs.stub_programs():
+        for size_name in size_names:
+            for (name,setup) in benchmarks:
+                if only and name not in only:
+                    continue
+                data_dir = tempfile.mkdtemp(prefix='neural-bench-')
+                try:
+                    (params,func) = setup(data_dir,sizes[size_name])
+                    with nl.run_in(data_dir):
+                        times = time_function(func,repeat,min_time)
+                finally:
+                    shutil.rmtree(data_dir,True)
+                result = {
+                    'benchmark': name,
+                    'size': size_name,
+                    'params': params,
+                    'repeat': len(times),
+                    'min': min(times),
+                    'median': sorted(times)[len(times)//2],
+                    'mean': sum(times)/len(times),
+                    'max': max(times)
+                }
+                results.append(result)
+                sys.stderr.write('%-24s %-8s %10.4fs (median of %d)\n' % (name,size_name,result['median'],len(times)))
+    return results
+
+def compare(results,old_results):
+    '''prints the speed-up of each benchmark compared to an earlier results file'''
+    old = dict([((x['benchmark'],x['size']),x) for x in old_results['results']])
+    for result in results:
+        key = (result['benchmark'],result['size'])
+        if key in old:
+            sys.stderr.write('%-24s %-8s %10.4fs -> %10.4fs  (%.2fx)\n' % (key[0],key[1],old[key]['median'],result['median'],old[key]['median']/max(result['median'],1e-9)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the Python-side hot paths of neural, using synthetic data')
+    parser.add_argument('--sizes',default='small,medium',help='comma-separated list of sizes to run (%s)' % ', '.join(sorted(sizes)))
+    parser.add_argument('--only',help='comma-separated list of benchmarks to run (%s)' % ', '.join([x[0] for x in benchmarks]))
+    parser.add_argument('--repeat',type=int,default=5,help='number of times to time each benchmark')
+    parser.add_argument('--min-time',type=float,default=0.0,help='keep repeating each benchmark until it has run this many seconds')
+    parser.add_argument('--output',help='save the results to this JSON file instead of printing them')
+    parser.add_argument('--compare',help='JSON file from an earlier run to compare the results to')
+    args = parser.parse_args(argv)
+
+    size_names = args.sizes.split(',')
+    for size_name in size_names:
+        if size_name not in sizes:
+            parser.error('unknown size "%s"' % size_name)
+    only = args.only.split(',') if args.only else None
+    if only:
+        for name in only:
+            if name not in [x[0] for x in benchmarks]:
+                parser.error('unknown benchmark "%s"' % name)
+
+    nl.verbose = False
+    results = run_benchmarks(size_names,only,args.repeat,args.min_time)
+    output = {'machine':machine_info(),'results':results}
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results,json.load(f))
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(output,f,indent=2,sort_keys=True)
+    else:
+        print json.dumps(output,indent=2,sort_keys=True)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,39 @@
+'''fake versions of the external (AFNI) programs the benchmarks call, so they run without AFNI installed
+
+Each stub is a small Python script put in a temporary directory at the front of the ``PATH``. They produce output
+in the same format as the real programs, but don't do any real work, so only the Python side is timed'''
+import os,sys,stat,tempfile,shutil
+
+#! Script bodies of the stubbed programs (``sys.argv`` has the arguments, as usual)
+stubs = {
+    # Prints one (deterministic) outlier fraction per time point of the input dataset
+    '3dToutcount': '''
+import random
+import nibabel as nib
+dset = sys.argv[-1]
+reps = nib.load(dset).shape[3]
+rand = random.Random(reps)
+print '\\n'.join(['%.4f' % (rand.random()*0.12) for i in range(reps)])
+''',
+    # Programs that just need to succeed
+    '3dDeconvolve': 'pass',
+    '3dinfo': 'pass',
+    'dicom_hdr': 'pass',
+}
+
+class stub_programs:
+    '''puts the :data:`stubs` on the ``PATH`` while in a ``with`` statement'''
+    def __enter__(self):
+        self.bin_dir = tempfile.mkdtemp(prefix='neural-bench-bin-')
+        for name in stubs:
+            filename = os.path.join(self.bin_dir,name)
+            with open(filename,'w') as f:
+                f.write('#!%s\nimport sys\n%s\n' % (sys.executable,stubs[name]))
+            os.chmod(filename,os.stat(filename).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        self.old_path = os.environ.get('PATH','')
+        os.environ['PATH'] = self.bin_dir + os.pathsep + self.old_path
+        return self
+
+    def __exit__(self,type,value,traceback):
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.bin_dir,True)
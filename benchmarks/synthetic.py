@@ -0,0 +1,118 @@
+'''generators for the synthetic data used by the benchmarks
+
+Everything is generated from a fixed random seed, so the same sizes always give the same files'''
+import os,random
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.dataset import Dataset,FileDataset
+
+def make_nifti(filename,shape=(32,32,20,50),dtype=np.int16,TR=2.0,seed=0):
+    '''writes a NIfTI dataset of smooth-ish random data with the given ``shape``'''
+    rand = np.random.RandomState(seed)
+    data = (1000 + 50*rand.standard_normal(shape)).astype(dtype)
+    img = nib.Nifti1Image(data,np.diag([2.,2.,3.,1.]))
+    img.header.set_xyzt_units('mm','sec')
+    if len(shape)>3:
+        img.header.set_zooms((2.,2.,3.,TR))
+    nib.save(img,filename)
+    return filename
+
+def make_dicom(filename,series=1,instance=1,z=0.0,rows=64,cols=64,description='EPI',series_time='120000',acquisition_time='120000.0',subject='subj1'):
+    '''writes a single-slice MR DICOM image'''
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.%d.%d' % (series,instance)
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    d = FileDataset(filename,{},file_meta=meta,preamble='\0'*128)
+    d.PatientID = subject
+    d.SeriesDate = '20150101'
+    d.SeriesTime = series_time
+    d.SeriesDescription = description
+    d.SeriesNumber = series
+    d.InstitutionName = 'Synthetic'
+    d.Rows = rows
+    d.Columns = cols
+    d.InstanceNumber = instance
+    d.AcquisitionTime = acquisition_time
+    d.RepetitionTime = 2000
+    d.ImagePositionPatient = [-100,-100,z]
+    d.ImageOrientationPatient = [1,0,0,0,1,0]
+    d.PixelSpacing = [2,2]
+    d.SliceThickness = 3
+    d.SamplesPerPixel = 1
+    d.PhotometricInterpretation = 'MONOCHROME2'
+    d.BitsAllocated = 16
+    d.BitsStored = 16
+    d.HighBit = 15
+    d.PixelRepresentation = 1
+    d.PixelData = (np.ones((rows,cols),dtype=np.int16)*instance).tostring()
+    d.is_little_endian = True
+    d.is_implicit_VR = False
+    d.save_as(filename,write_like_original=False)
+    return filename
+
+def make_dicom_series(directory,num_series=2,slices=10,reps=5,rows=64,cols=64,duplicates=0):
+    '''writes ``num_series`` series of ``slices`` x ``reps`` DICOM images into ``directory``, plus ``duplicates``
+    copies of existing images. Returns the list of files'''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    files = []
+    i = 0
+    for series in xrange(1,num_series+1):
+        for rep in xrange(reps):
+            for z in xrange(slices):
+                i += 1
+                files.append(make_dicom(os.path.join(directory,'IM%06d.dcm' % i),series=series,instance=rep*slices+z+1,z=3.0*z,
+                        rows=rows,cols=cols,description='series%d' % series,series_time='12%02d00' % series,acquisition_time='12%02d%02d.0' % (series,rep)))
+    for d in xrange(duplicates):
+        dup = os.path.join(directory,'DUP%06d.dcm' % d)
+        with open(files[d % len(files)],'rb') as f, open(dup,'wb') as out:
+            out.write(f.read())
+        files.append(dup)
+    return files
+
+def make_eprime_log(filename,frames=200,seed=0):
+    '''writes an E-Prime text log with ``frames`` trial frames'''
+    rand = random.Random(seed)
+    lines = ['*** Header Start ***','VersionPersist: 1','Experiment: synthetic','Subject: 1','*** Header End ***']
+    for i in xrange(frames):
+        lines += [
+            '\tLevel: 2',
+            '\t*** LogFrame Start ***',
+            '\tProcedure: TrialProc',
+            '\tTrialList: %d' % (i+1),
+            '\tTrialSlide.Tag: %s' % rand.choice(['a','b','c']),
+            '\tTrialSlide.OnsetTime: %d' % (10000 + 2000*i),
+            '\tTrialSlide.RT: %d' % rand.randint(200,1500),
+            '\tTrialSlide.ACC: %d' % rand.randint(0,1),
+            '\tTrialSlide.RESP: %s' % rand.choice(['1','2']),
+            '\t*** LogFrame End ***'
+        ]
+    with open(filename,'w') as f:
+        f.write('\r\n'.join(lines) + '\r\n')
+    return filename
+
+def make_motion_params(filename,reps=200,seed=0):
+    '''writes a 3dAllineate/3dvolreg-style parameter file (6 columns) with ``reps`` rows'''
+    rand = np.random.RandomState(seed)
+    params = np.cumsum(0.05*rand.standard_normal((reps,6)),axis=0)
+    with open(filename,'w') as f:
+        f.write('# synthetic motion parameters\n')
+        f.write('\n'.join([' '.join(['%.4f' % x for x in row]) for row in params]))
+    return filename
+
+def make_stim_times(filename,runs=4,events=20,run_length=300.0,seed=0):
+    '''writes a ``stim_times`` file with one line of ``events`` onsets for each of ``runs`` runs'''
+    rand = random.Random(seed)
+    with open(filename,'w') as f:
+        for r in xrange(runs):
+            f.write(' '.join(['%.1f' % x for x in sorted([rand.uniform(0,run_length) for e in xrange(events)])]) + '\n')
+    return filename
+
+def make_stim_column(filename,reps=200,seed=0):
+    '''writes a single-column stimulus file with ``reps`` rows'''
+    rand = random.Random(seed)
+    with open(filename,'w') as f:
+        f.write('\n'.join([str(rand.randint(0,1)) for r in xrange(reps)]))
+    return filename
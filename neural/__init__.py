@@ -8,6 +8,7 @@ version = '1.2.5'
 #! flag to indicate whether most functions should be verbose or not
 verbose = True
 
+import notification
 from notification import level,notify
 
 from utils import *
@@ -33,27 +34,17 @@ from connectivity import *
 import qc
 from qc import *
 
-import eprime
-import general
-import notification
-import freesurfer
-import driver
-
-# Check for update
-import xmlrpclib
-try:
-    pypi = xmlrpclib.ServerProxy('http://pypi.python.org/pypi')
-    latest = pypi.package_releases('neural-fmri')
-    if latest:
-        if latest[0]!=version:
-            notify('## Update to neural available on PyPI (current version: %s; latest version: %s)' % (version,latest[0]),level=level.debug)
-except:
-    pass
-
-
-# user customization
-import sys
-if sys.stdout.isatty():
+import lazy
+#! submodules that are only imported the first time they are used
+lazy.lazy_submodules(__name__,['eprime','general','freesurfer','driver','dag','scheduler','update'])
+
+import os,sys
+# Check for update (only if asked to, and without waiting for the answer)
+if os.environ.get('NEURAL_CHECK_UPDATES','0') not in ['','0']:
+    update.check_for_update(block=False)
+
+# user customization (set NEURAL_NO_GREETING to turn it off)
+if sys.stdout.isatty() and os.environ.get('NEURAL_NO_GREETING','0') in ['','0']:
     import personality
     personality.display('greeting')
     personality.set_goodbye()
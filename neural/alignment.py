@@ -2,7 +2,8 @@ import neural as nl
 import os,tempfile,subprocess,shutil
 from math import sqrt
 from operator import add
-import numpy as np
+from neural.lazy import lazy_import
+np = lazy_import('numpy',globals())
 
 def align_epi(anatomy,epis,suffix='_al',base=3,skull_strip=True):
     '''[[currently in progress]]: a simple replacement for the ``align_epi_anat.py`` script, because I've found it to be unreliable, in my usage'''
@@ -381,7 +382,10 @@ def skullstrip_template(dset,template,prefix=None,suffix=None,dilate=0):
                 nl.affine_align(template,dset,skull_strip=None,cost='mi',opts=['-nmatch','100%'])
                 nl.run(['3dQwarp','-minpatch','20','-penfac','10','-noweight','-source',nl.suffix(template,'_aff'),'-base',dset,'-prefix',nl.suffix(template,'_qwarp')],products=nl.suffix(template,'_qwarp'))
                 info = nl.dset_info(nl.suffix(template,'_qwarp'))
-                max_value = info.subbricks[0]['max']
+                max_value = info.subbricks[0].get('max')
+                if max_value==None:
+                    # not stored in the header
+                    max_value = nl.max(nl.suffix(template,'_qwarp'))
                 nl.calc([dset,nl.suffix(template,'_qwarp')],'a*step(b-%f*0.05)'%max_value,prefix)
                 shutil.move(prefix,cwd)
             shutil.rmtree(tmp_dir)
@@ -1,10 +1,16 @@
 '''methods to aide in functional connectivity analyses'''
 import neural as nl
-import tempfile,os
+import tempfile,os,multiprocessing
+from neural.lazy import lazy_import
+np = lazy_import('numpy',globals())
+nib = lazy_import('nibabel',globals())
 
 def connectivity_map(dset,prefix,x,y,z,radius=2):
     '''Will perform connectivity analysis on ``dset`` using seed point ``(x,y,z)`` (in RAI order) with a sphere of radius ``radius``.
-    Does not perform any preprocessing of ``dset``. This should be already motion corrected, noise-regressed, residualized, etc.'''
+    Does not perform any preprocessing of ``dset``. This should be already motion corrected, noise-regressed, residualized, etc.
+
+    This runs a full ``3dDeconvolve`` for the seed. To get correlation maps for many seeds at once, use
+    :class:`SeedConnectivity` or :meth:`correlation_maps` instead'''
     seed_series = nl.sphere_average(dset,x,y,z,radius)
     with tempfile.NamedTemporaryFile(delete=False) as temp:
         temp.write('\n'.join([str(x) for x in seed_series]))
@@ -17,4 +23,222 @@ def connectivity_map(dset,prefix,x,y,z,radius=2):
         os.remove(temp.name)
     except:
         pass
-    
\ No newline at end of file
+
+def _normalize(series):
+    '''returns the rows of ``series`` minus their means and scaled to a length of 1 (constant rows become 0), so
+    the dot product of two rows is their correlation'''
+    series = series - series.mean(axis=1)[:,None]
+    norm = np.sqrt((series**2).sum(axis=1))
+    norm[norm==0] = np.inf
+    return series / norm[:,None]
+
+def _fisher(r):
+    '''Fisher z-transform of the correlations ``r``'''
+    return np.arctanh(np.clip(r,-0.999999,0.999999))
+
+class SeedConnectivity(object):
+    '''correlates the average time series of seed spheres with every voxel of a dataset, without calling any
+    external programs
+
+    The dataset (which should already be motion corrected, noise-regressed, residualized, etc.) is read from the
+    file ``chunk_size`` time points at a time, and the correlations with all of the seeds are built up together,
+    as a matrix product for each block, so only one block of the time series is in memory at once. If a ``mask``
+    is given, only the voxels inside of it are used (it's resampled to the grid of ``dset`` if needed)::
+
+        seeds = [(-2,50,20),(44,-20,6),(-44,-20,6)]
+        conn = nl.connectivity.SeedConnectivity('rest_resid.nii.gz',mask='brain_mask.nii.gz')
+        conn.maps(seeds,radius=6,fisher=True,prefix='seed_z.nii.gz')
+        print conn.matrix(seeds,radius=6)
+
+    Seeds are given as coordinates ``(x,y,z)`` in RAI order. Raises a ``ValueError`` if the datasets can't be
+    read directly'''
+    def __init__(self,dset,mask=None,chunk_size=16):
+        self.dset = dset
+        self.mask = mask
+        self.chunk_size = chunk_size
+        self.engine = nl.stats.roi_engine(dset,[mask] if mask else [],native=True)
+        if self.engine==None:
+            raise ValueError('cannot read %s directly' % dset)
+        if mask:
+            #! indices (in file order) of the voxels that are used
+            self.voxels = np.flatnonzero(self.engine.labels(mask))
+        else:
+            self.voxels = np.arange(np.prod(self.engine.shape))
+
+    def seed_series(self,seeds,radius=2):
+        '''returns a (seeds x time) array with the average time series within ``radius`` mm of each seed
+
+        Every voxel is only read once, even if the spheres overlap. Seeds without any voxels in the dataset
+        are all 0'''
+        spheres = [self.engine.sphere_voxels(x,y,z,radius) for (x,y,z) in seeds]
+        for i in xrange(len(seeds)):
+            if len(spheres[i])==0:
+                nl.notify('Warning: seed %s has no voxels in %s' % (seeds[i],self.dset),level=nl.level.warning)
+        voxels = np.unique(np.concatenate(spheres + [np.array([],dtype=int)]))
+        rows = self.engine.series(voxels)
+        weights = np.zeros((len(seeds),len(voxels)))
+        for i in xrange(len(seeds)):
+            if len(spheres[i]):
+                weights[i,np.searchsorted(voxels,spheres[i])] = 1.0/len(spheres[i])
+        return weights.dot(rows)
+
+    def maps(self,seeds,radius=2,fisher=False,prefix=None):
+        '''returns an array with the correlation of every voxel with each seed (with the shape ``(x,y,z,seeds)``),
+        which is 0 outside of the mask
+
+        :fisher:    Fisher z-transform the correlations
+        :prefix:    if given, also save the maps as a dataset with this filename (one subbrick per seed)
+        '''
+        seed_norm = _normalize(self.seed_series(seeds,radius)).astype(np.float32)
+        # the seeds have a mean of 0 and a length of 1, so the correlation of a voxel with them is the sum of its
+        # products with them, over the length of the voxel's time series minus its mean
+        sums = np.zeros(len(self.voxels))
+        squares = np.zeros(len(self.voxels))
+        products = np.zeros((len(self.voxels),len(seeds)),dtype=np.float32)
+        for (i,chunk) in self.engine.time_chunks(self.chunk_size):
+            chunk = np.asarray(chunk[self.voxels] if self.mask else chunk,dtype=float)
+            sums += chunk.sum(axis=1)
+            squares += np.einsum('vt,vt->v',chunk,chunk)
+            products += chunk.astype(np.float32).dot(seed_norm[:,i:i+chunk.shape[1]].T)
+        norm = np.sqrt(np.maximum(squares - sums**2/self.engine.reps,0))
+        r = np.zeros(products.shape,dtype=np.float32)
+        np.divide(products,norm[:,None].astype(np.float32),out=r,where=norm[:,None]>0)
+        output = np.zeros((int(np.prod(self.engine.shape)),len(seeds)),dtype=np.float32)
+        output[self.voxels] = _fisher(r) if fisher else r
+        output = output.reshape(self.engine.shape + (len(seeds),),order='F')
+        if prefix:
+            nib.save(nib.Nifti1Image(output,self.engine.affine),prefix)
+        return output
+
+    def matrix(self,seeds,radius=2,fisher=False):
+        '''returns the (seeds x seeds) matrix of the correlations between the seeds (Fisher z-transformed, if
+        ``fisher`` is ``True``)'''
+        seed_norm = _normalize(self.seed_series(seeds,radius))
+        r = seed_norm.dot(seed_norm.T)
+        return _fisher(r) if fisher else r
+
+def correlation_maps(dset,seeds,prefix=None,radius=2,mask=None,fisher=False,chunk_size=16):
+    '''returns the correlation maps of ``dset`` with each seed coordinate ``(x,y,z)`` (in RAI order) in ``seeds``,
+    calculated with :class:`SeedConnectivity`, and saves them as ``prefix`` (if given). Returns ``None`` if
+    the datasets can't be read directly'''
+    try:
+        return SeedConnectivity(dset,mask,chunk_size).maps(seeds,radius,fisher,prefix)
+    except ValueError:
+        return None
+
+def seed_matrix(dset,seeds,radius=2,fisher=False):
+    '''returns the (seeds x seeds) correlation matrix of the seed coordinates ``(x,y,z)`` (in RAI order) in ``seeds``,
+    calculated with :class:`SeedConnectivity`. Returns ``None`` if the dataset can't be read directly'''
+    try:
+        return SeedConnectivity(dset).matrix(seeds,radius,fisher)
+    except ValueError:
+        return None
+
+def roi_series(dset,atlas):
+    '''returns a tuple of the ROI values in ``atlas`` and a (ROIs x time) array with the average time series of
+    ``dset`` in each of them
+
+    ``atlas`` is resampled to the grid of ``dset`` (nearest-neighbour) if needed. The dataset is read in one pass,
+    a block of time points at a time, and all of the ROIs are averaged together in each block, so only the
+    averages and one block are in memory at once. Returns ``None`` if the datasets can't be read directly'''
+    engine = nl.stats.roi_engine(dset,[atlas],native=True)
+    if engine==None:
+        return None
+    labels = engine.labels(atlas)
+    voxels = np.flatnonzero(labels>0)
+    # the voxels sorted by ROI
+    voxels = voxels[np.argsort(labels[voxels],kind='mergesort')]
+    (rois,starts,counts) = np.unique(labels[voxels],return_index=True,return_counts=True)
+    series = np.zeros((len(rois),engine.reps))
+    if len(rois)==0:
+        return (rois,series)
+    for (i,chunk) in engine.time_chunks():
+        series[:,i:i+chunk.shape[1]] = np.add.reduceat(np.asarray(chunk[voxels],dtype=float),starts,axis=0)
+    return (rois,series / counts[:,None])
+
+def _partial_correlation(r):
+    '''returns the partial correlations from the correlation matrix ``r`` (using the pseudo-inverse, so it also
+    works when there are more ROIs than time points)'''
+    precision = np.linalg.pinv(r)
+    scale = np.sqrt(np.abs(np.diag(precision)))
+    scale[scale==0] = np.inf
+    partial = -precision / np.outer(scale,scale)
+    np.fill_diagonal(partial,1.0)
+    return partial
+
+def roi_matrix(dset,atlas,method='correlation',fisher=False):
+    '''returns a tuple of the ROI values in ``atlas`` and the (ROIs x ROIs) connectivity matrix between the average
+    time series of ``dset`` in each ROI (see :meth:`roi_series`)
+
+    :method:    ``correlation`` or ``partial`` (partial correlation of each pair, given all of the other ROIs)
+    :fisher:    Fisher z-transform the matrix
+
+    Returns ``None`` if the datasets can't be read directly'''
+    if method not in ['correlation','partial']:
+        nl.notify('Error: unknown connectivity method "%s"' % method,level=nl.level.error)
+        return None
+    series = roi_series(dset,atlas)
+    if series==None:
+        return None
+    (rois,series) = series
+    series = _normalize(series)
+    r = series.dot(series.T)
+    if method=='partial':
+        r = _partial_correlation(r)
+    return (rois,_fisher(r) if fisher else r)
+
+def _roi_matrix_job(args):
+    '''runs :meth:`roi_matrix` for :meth:`roi_matrices` (in a pool process)'''
+    try:
+        return roi_matrix(*args)
+    except Exception as e:
+        nl.notify('Error: could not calculate the connectivity matrix of %s (%s: %s)' % (args[0],type(e).__name__,e),level=nl.level.error)
+        return None
+
+def roi_matrices(dsets,atlas,output=None,method='correlation',fisher=False,workers=1):
+    '''calculates the :meth:`roi_matrix` of each dataset in ``dsets`` (e.g., one per subject) with the same ``atlas``,
+    and stacks them together
+
+    :output:    if given, the results are saved in this (compressed) ``.npz`` file
+    :workers:   number of datasets to do at the same time (in a pool of processes; ``None`` uses one per CPU)
+
+    Returns a ``dict`` with (the same arrays that are saved in ``output``):
+
+        :matrices:  (datasets x ROIs x ROIs) ``float32`` array. ROIs that aren't in a dataset (e.g., outside of
+                    its field of view), and datasets that failed, are ``NaN``
+        :rois:      the ROI value of each row/column
+        :dsets:     the datasets, in the same order as ``matrices``
+        :method:    the method used (with ``_fisher`` appended if the matrices are Fisher z-transformed)
+    '''
+    if isinstance(dsets,basestring):
+        dsets = [dsets]
+    if workers==None:
+        workers = multiprocessing.cpu_count()
+    jobs = [(dset,atlas,method,fisher) for dset in dsets]
+    if workers>1 and len(jobs)>1:
+        pool = multiprocessing.Pool(min(workers,len(jobs)))
+        try:
+            results = pool.map(_roi_matrix_job,jobs)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [_roi_matrix_job(job) for job in jobs]
+    found = [x for x in results if x!=None]
+    rois = np.unique(np.concatenate([x[0] for x in found] + [np.array([],dtype=int)]))
+    matrices = np.empty((len(dsets),len(rois),len(rois)),dtype=np.float32)
+    matrices.fill(np.nan)
+    for i in xrange(len(results)):
+        if results[i]!=None:
+            index = np.searchsorted(rois,results[i][0])
+            matrices[i][np.ix_(index,index)] = results[i][1]
+    out = {
+        'matrices': matrices,
+        'rois': rois,
+        'dsets': np.array([str(x) for x in dsets]),
+        'method': method + ('_fisher' if fisher else '')
+    }
+    if output:
+        np.savez_compressed(output,**out)
+    return out
@@ -0,0 +1,179 @@
+'''run the commands in a script as a dependency graph, so independent steps can run at the same time
+
+Inside a :class:`DAG`, calls to :meth:`neural.run` are recorded instead of being run. Each command depends on
+any earlier command whose ``products`` appear in its arguments, and when :meth:`DAG.run` is called, every
+command is started as soon as the commands it depends on have finished.
+
+Example::
+
+    dag = nl.dag.DAG()
+    for subject in subjects:
+        with dag, nl.run_in(subject):
+            nl.tshift('func.nii.gz')
+            nl.volreg('func_tshift.nii.gz','func_tshift.nii.gz[0]')
+            nl.blur('func_tshift_volreg.nii.gz',4.0)
+    dag.run(workers=8)
+
+Since the commands haven't actually run yet, this only works for code that doesn't need to look at the output
+of a command before running the next one'''
+import neural as nl
+import os,re,multiprocessing,Queue
+
+class Node:
+    '''a single recorded command in a :class:`DAG`
+
+    :status:    ``waiting``, ``running``, ``done``, ``failed`` or ``skipped`` (if a command it depends on failed)
+    :result:    the :class:`neural.utils.RunResult` once it has run
+    '''
+    def __init__(self,command,products,working_directory,stderr=True,quiet=False,cache=None):
+        self.command = command
+        self.products = products
+        self.working_directory = working_directory
+        self.stderr = stderr
+        self.quiet = quiet
+        self.cache = cache
+        self.parents = []
+        self.children = []
+        self.status = 'waiting'
+        self.result = None
+
+    def __str__(self):
+        return ' '.join([str(x) for x in self.command])
+
+def _dset_key(filename,working_directory):
+    '''returns a normalized name for a dataset, so that e.g. ``anat+orig.HEAD``, ``anat+orig[0]`` and the
+    product ``anat`` all match'''
+    filename = re.sub(r'(\[.*\]|<.*>|\{.*\})+$','',str(filename))
+    filename = os.path.normpath(os.path.join(working_directory,filename))
+    return re.sub(r'(\+(orig|tlrc|acpc))?(\.(HEAD|BRIK)(\.gz|\.bz2)?)?$','',filename)
+
+def _argument_keys(command,working_directory):
+    '''returns the set of everything in ``command`` that could be the name of a dataset'''
+    keys = set()
+    for arg in nl.flatten(command):
+        arg = str(arg)
+        for x in [arg] + re.split(r'[=,\s]+',arg):
+            if x and not x.startswith('-'):
+                keys.add(_dset_key(x,working_directory))
+    return keys
+
+def _run_node(args):
+    '''runs a single command on one of the workers of :meth:`DAG.run`'''
+    (command,products,working_directory,stderr,quiet,cache) = args
+    try:
+        return nl.utils.run(command,products,working_directory,force_local=True,stderr=stderr,quiet=quiet,cache=cache)
+    except Exception as e:
+        return nl.utils.RunResult('%s: %s' % (type(e).__name__,e),1)
+
+class DAG:
+    '''records calls to :meth:`neural.run` (while used in a ``with`` statement) into a graph that can be run in parallel
+
+    Can be used in several ``with`` statements to add more commands to the same graph'''
+    def __init__(self):
+        self.nodes = []         #! list of :class:`Node` objects, in the order they were recorded
+        self._products = {}     # normalized product name -> the last :class:`Node` that makes it
+        self._old_run = []
+
+    def __enter__(self):
+        self._old_run.append(nl.run)
+        nl.run = self.add
+        return self
+
+    def __exit__(self,type,value,traceback):
+        old_run = self._old_run.pop()
+        # if something else replaced nl.run inside the block (like importing neural.scheduler), it's left alone
+        if nl.run==self.add:
+            nl.run = old_run
+
+    def add(self,command,products=None,working_directory='.',force_local=False,stderr=True,quiet=False,cache=None):
+        '''records a command (takes the same arguments as :meth:`neural.run`)
+
+        Returns ``False`` if all of the products already exist (like :meth:`neural.run`), otherwise returns a
+        :class:`neural.utils.RunResult` with the name of the first product, and no output'''
+        working_directory = os.path.abspath(working_directory)
+        if products:
+            if isinstance(products,basestring):
+                products = [products]
+            if all([os.path.exists(os.path.join(working_directory,x)) for x in products]):
+                return False
+        node = Node(command,products,working_directory,stderr,quiet,cache)
+        for key in _argument_keys(command,working_directory):
+            parent = self._products.get(key)
+            if parent and parent not in node.parents:
+                node.parents.append(parent)
+                parent.children.append(node)
+        for product in (products or []):
+            self._products[_dset_key(product,working_directory)] = node
+        self.nodes.append(node)
+        return nl.utils.RunResult(None,0,products[0] if products else None)
+
+    def run(self,workers=None,scheduler=False):
+        '''runs all of the recorded commands that haven't been run yet
+
+        :workers:       maximum number of commands to run at once (by default, one per CPU)
+        :scheduler:     if ``True``, sends the commands to the servers in :mod:`neural.scheduler` instead
+                        of running them on a local pool of processes
+
+        A command that fails (returns a non-zero exit code) causes every command that depends on it to be
+        skipped. Returns ``True`` if everything ran successfully'''
+        if workers==None:
+            workers = multiprocessing.cpu_count()
+        waiting = [x for x in self.nodes if x.status=='waiting']
+        finished = Queue.Queue()
+        if scheduler:
+            import neural.scheduler
+            pool = None
+        else:
+            pool = multiprocessing.Pool(workers)
+        running = 0
+        done = 0
+        total = len(waiting)
+
+        def start(node):
+            node.status = 'running'
+            if pool:
+                pool.apply_async(_run_node,((node.command,node.products,node.working_directory,node.stderr,node.quiet,node.cache),),callback=lambda result: finished.put((node,result)))
+            else:
+                def callback(future):
+                    finished.put((node,future.result() if not future.error else nl.utils.RunResult(future.error,1)))
+                nl.scheduler.submit(node.command,node.products,node.working_directory,stderr=node.stderr,quiet=node.quiet,cache=node.cache).add_done_callback(callback)
+
+        try:
+            with nl.notify('Running %d commands' % total):
+                while len(waiting)>0 or running>0:
+                    changed = False
+                    for node in list(waiting):
+                        if any([x.status in ['failed','skipped'] for x in node.parents]):
+                            node.status = 'skipped'
+                            waiting.remove(node)
+                            done += 1
+                            changed = True
+                            nl.notify('Warning: [%d/%d] skipping %s' % (done,total,node),level=nl.level.warning)
+                        elif running<workers and all([x.status=='done' for x in node.parents]):
+                            waiting.remove(node)
+                            running += 1
+                            start(node)
+                    if running==0:
+                        if changed:
+                            continue
+                        break
+                    # a timeout is given so Ctrl-C still works while waiting (Python 2 can't interrupt a plain get())
+                    (node,result) = finished.get(True,1e6)
+                    running -= 1
+                    done += 1
+                    node.result = result
+                    if result==False or result.return_code==0:
+                        node.status = 'done'
+                        nl.notify('[%d/%d] finished %s' % (done,total,node))
+                    else:
+                        node.status = 'failed'
+                        nl.notify('Error: [%d/%d] failed %s' % (done,total,node),level=nl.level.error)
+        finally:
+            if pool:
+                # if interrupted, don't wait for the commands that are still running
+                if running>0:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+        return all([x.status=='done' for x in self.nodes])
@@ -1,14 +1,19 @@
 '''methods to analyze DICOM format images'''
 
 from __future__ import absolute_import
-import subprocess,re,os,multiprocessing,glob,itertools,tempfile,shutil
+import subprocess,re,os,multiprocessing,multiprocessing.pool,glob,itertools,tempfile,shutil,StringIO,sqlite3,tarfile,time,filecmp
+import cPickle as pickle
 from datetime import datetime
 import neural as nl
 import string
-import pydicom
-from fuzzywuzzy import process
-import nibabel as nib
-import numpy as np
+from neural.lazy import lazy_import
+pydicom = lazy_import('pydicom',globals())
+process = lazy_import('fuzzywuzzy.process',globals())
+nib = lazy_import('nibabel',globals())
+# nibabel warns that its DICOM readers are experimental every time they're imported
+dicomwrappers = lazy_import('nibabel.nicom.dicomwrappers',globals(),ignore_warnings=True)
+csareader = lazy_import('nibabel.nicom.csareader',globals(),ignore_warnings=True)
+np = lazy_import('numpy',globals())
 
 def is_dicom(filename):
     '''returns Boolean of whether the given file has the DICOM magic number'''
@@ -37,6 +42,11 @@ class DicomInfo:
         self.raw_frames = frames    #! list of dictionaries containing information on each frame
         self.sex_info = sex_info    #! dictinary with Siemen's extra info fields
         self.slice_times = slice_times #! list of Siemen's slice timing information
+        self._addr_index = {}
+        self._label_index = {}
+        for frame in frames:
+            self._addr_index.setdefault(frame['addr'],frame)
+            self._label_index.setdefault(frame['label'],frame)
 
     def addr(self,address):
         '''returns dictionary with frame information for given address (a tuple of two hex numbers)'''
@@ -49,15 +59,11 @@ class DicomInfo:
         for i in xrange(len(addr)):
             if isinstance(addr[i],basestring):
                 addr[i] = int(addr[i],16)
-        for frame in self.raw_frames:
-            if frame['addr']==address:
-                return frame
+        return self._addr_index.get(tuple(addr))
 
     def label(self,label):
         '''returns dictionary with frame information for a given text label'''
-        for frame in self.raw_frames:
-            if frame['label']==label:
-                return frame
+        return self._label_index.get(label)
 
 def info(filename):
     '''returns a DicomInfo object containing the header information in ``filename``'''
@@ -82,6 +88,91 @@ def info(filename):
 
     return DicomInfo(frames,sex_info,slice_timing)
 
+def _tags_from_dicom(d,filename,tags):
+    '''returns a dictionary of ``tags`` from the already-read pydicom dataset ``d`` (read from ``filename``)
+
+    Tags that aren't in the top level of ``d`` are looked for in nested sequences (like ``dicom_hdr`` does), after
+    reading the whole header of ``filename``'''
+    return_dict = {}
+    full_dicom = None
+    for k in tags:
+        if k in d:
+            return_dict[k] = d[k].value
+        else:
+            if full_dicom==None:
+                try:
+                    full_dicom = pydicom.read_file(filename,stop_before_pixels=True,force=True)
+                except Exception:
+                    full_dicom = pydicom.dataset.Dataset()
+            for element in full_dicom.iterall():
+                if element.tag==k:
+                    return_dict[k] = element.value
+                    break
+    return return_dict
+
+def _csa_slice_times(d):
+    '''returns the list of slice times (in ms) from the Siemens CSA image header in the pydicom dataset ``d``,
+    or ``None`` if there aren't any'''
+    try:
+        csa = csareader.get_csa_header(d,'image')
+        return [float(x) for x in csa['tags']['MosaicRefAcqTimes']['items']]
+    except Exception:
+        return None
+
+#! Tags needed to find the Siemens CSA image header (the private creator, and the header for each possible block)
+_csa_tags = [(0x29,x) for x in xrange(0x10,0x20)] + [(0x29,(x<<8)|0x10) for x in xrange(0x10,0x20)]
+
+def _read_tags(args):
+    '''reads the tags for a single file for :meth:`info_table`. Returns a tuple of ``(index,tag dict)``'''
+    (i,filename,tags,slice_times) = args
+    specific_tags = [pydicom.tag.Tag(x) for x in tags + (_csa_tags if slice_times else [])]
+    try:
+        d = pydicom.read_file(filename,defer_size='1 KB',stop_before_pixels=True,specific_tags=specific_tags)
+    except Exception:
+        return (i,None)
+    tag_dict = _tags_from_dicom(d,filename,tags)
+    if slice_times:
+        tag_dict['slice_times'] = _csa_slice_times(d)
+    return (i,tag_dict)
+
+def _table_column(values):
+    '''converts a list of header values into a NumPy array (numeric if possible, otherwise ``object``)'''
+    if len(values)>0 and all([isinstance(x,(int,long,float)) and not isinstance(x,bool) for x in values]):
+        return np.array(values)
+    column = np.empty(len(values),dtype=object)
+    for i in xrange(len(values)):
+        column[i] = values[i]
+    return column
+
+def info_table(filenames,tags,slice_times=False,workers=1):
+    '''reads the DICOM ``tags`` from each of ``filenames``, and returns a table as a dictionary of columns
+
+    This is much faster than calling :meth:`info` or :meth:`info_for_tags` on each file: the headers are read with
+    pydicom, only the requested tags are parsed, and large values are never loaded. ``tags`` is a list of tuples
+    of the DICOM addresses. The returned dictionary has the keys:
+
+    :filename:      array of the filenames
+    :valid:         boolean array of whether each file could be read as a DICOM
+    ``tag``:        one array for each tag, with ``None`` where the tag is missing (numeric tags that are
+                    present in every file are returned as a numeric array)
+    :slice_times:   if ``slice_times`` is ``True``, the Siemens slice timings (in ms) for each file
+                    (read from the CSA header, like ``dicom_hdr -slice_times``)
+
+    If ``workers`` is more than 1 (or ``None``, to use one per CPU), the files are read by a pool of processes'''
+    if isinstance(tags,tuple):
+        tags = [tags]
+    tags = list(tags)
+    rows = [None]*len(filenames)
+    for (i,tag_dict) in _pool_imap(_read_tags,[(i,filenames[i],tags,slice_times) for i in xrange(len(filenames))],workers,chunksize=16):
+        rows[i] = tag_dict
+    table = {
+        'filename': _table_column(list(filenames)),
+        'valid': np.array([x!=None for x in rows],dtype=bool)
+    }
+    for k in tags + (['slice_times'] if slice_times else []):
+        table[k] = _table_column([x.get(k) if x else None for x in rows])
+    return table
+
 def info_for_tags(filename,tags):
     '''return a dictionary for the given ``tags`` in the header of the DICOM file ``filename``
 
@@ -91,21 +182,172 @@ def info_for_tags(filename,tags):
     if isinstance(tags,tuple):
         tags = [tags]
     d = pydicom.read_file(filename)
-    return_dict = {}
-    dicom_info = None
-    for k in tags:
-        if k in d:
-            return_dict[k] = d[k].value
-        else:
-            # Backup to the old method
-            if dicom_info==None:
-                dicom_info = info(filename)
-            i = dicom_info.addr(k)
-            if i:
-                return_dict[k] = nl.numberize(i['value'])
-    return return_dict
-
-def scan_dir(dirname,tags=None,md5_hash=False):
+    return _tags_from_dicom(d,filename,tags)
+
+class DicomIndex(object):
+    '''persistent record of DICOM files that have already been scanned, stored in the SQLite database ``db_file``
+
+    For each file, the size, modification time and the scanned tags (including the MD5 hash, if it was
+    calculated) are saved, so a file that hasn't changed doesn't need to be read again. The index also keeps track of
+    the series directories made by :meth:`organize_dir`, whether they have changed since a
+    dataset was last made from them, and the name of that dataset'''
+    def __init__(self,db_file):
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file,timeout=30)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, tags BLOB)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS series (name TEXT PRIMARY KEY, dir TEXT, dirty INTEGER, dset TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_size ON files (size)')
+        self.db.commit()
+
+    def lookup(self,filename,tags,md5_hash=False):
+        '''returns a tuple of ``(found,tag dict)``. ``found`` is ``True`` if ``filename`` is unchanged since it
+        was indexed, and all of ``tags`` (and the MD5 hash, if ``md5_hash``) were read then. The tag dict
+        is ``None`` if the file isn't a DICOM'''
+        row = self.db.execute('SELECT size,mtime,tags FROM files WHERE path=?',(os.path.abspath(filename),)).fetchone()
+        if row==None:
+            return (False,None)
+        try:
+            s = os.stat(filename)
+        except OSError:
+            return (False,None)
+        if (s.st_size,s.st_mtime)!=tuple(row[:2]):
+            return (False,None)
+        (scanned_tags,tag_dict) = pickle.loads(str(row[2]))
+        if not set(tags).issubset(scanned_tags) or (md5_hash and tag_dict!=None and 'md5' not in tag_dict):
+            return (False,None)
+        if tag_dict!=None:
+            tag_dict = dict([(k,tag_dict[k]) for k in tag_dict if k in tags or (md5_hash and k=='md5')])
+        return (True,tag_dict)
+
+    def update(self,filename,tags,tag_dict):
+        '''saves the ``tag_dict`` read from ``filename`` (or ``None`` if it isn't a DICOM) that was scanned for ``tags``'''
+        s = os.stat(filename)
+        self.db.execute('INSERT OR REPLACE INTO files (path,size,mtime,tags) VALUES (?,?,?,?)',(os.path.abspath(filename),s.st_size,s.st_mtime,sqlite3.Binary(pickle.dumps((list(tags),tag_dict),2))))
+
+    def rename(self,old_filename,new_filename):
+        '''updates the index after a file has been moved'''
+        self.db.execute('UPDATE files SET path=? WHERE path=?',(os.path.abspath(new_filename),os.path.abspath(old_filename)))
+
+    def remove(self,filename):
+        self.db.execute('DELETE FROM files WHERE path=?',(os.path.abspath(filename),))
+
+    def files_with_size(self,size):
+        '''returns a list of the indexed files that are ``size`` bytes'''
+        return [str(x[0]) for x in self.db.execute('SELECT path FROM files WHERE size=?',(size,))]
+
+    def series(self,name):
+        '''returns a ``dict`` with the ``dir``, ``dirty`` and ``dset`` of the series called ``name``, or ``None``'''
+        row = self.db.execute('SELECT dir,dirty,dset FROM series WHERE name=?',(name,)).fetchone()
+        if row==None:
+            return None
+        return {'dir':row[0],'dirty':bool(row[1]),'dset':row[2]}
+
+    def series_for_dir(self,dir_name):
+        '''returns the name of the series stored in the directory ``dir_name``, or ``None``'''
+        row = self.db.execute('SELECT name FROM series WHERE dir=?',(os.path.basename(dir_name.rstrip('/')),)).fetchone()
+        return row[0] if row else None
+
+    def set_series(self,name,dir_name=None,dirty=None,dset=None):
+        '''creates or updates the series called ``name``, only changing the values that are given'''
+        old = self.series(name) or {'dir':None,'dirty':True,'dset':None}
+        if dir_name!=None:
+            old['dir'] = os.path.basename(dir_name.rstrip('/'))
+        if dirty!=None:
+            old['dirty'] = dirty
+        if dset!=None:
+            old['dset'] = dset
+        self.db.execute('INSERT OR REPLACE INTO series VALUES (?,?,?,?)',(name,old['dir'],int(old['dirty']),old['dset']))
+
+    def commit(self):
+        self.db.commit()
+
+_default_scan_tags = [
+    (0x0008, 0x0021),
+    (0x0008, 0x0031),
+    (0x0008, 0x103E),
+    (0x0008, 0x0080),
+    (0x0010, 0x0020),
+    (0x0028, 0x0010),
+    (0x0028, 0x0011),
+]
+
+def _scan_file(args):
+    '''reads a single file for :meth:`scan_dir_iter`
+
+    The file is only opened once: the preamble is checked, only the requested tags are parsed,
+    and the MD5 hash (if requested) is calculated from the same buffer. Returns ``(filename,tag dict)``,
+    with ``None`` instead of the dictionary if the file isn't a DICOM (or can't be read or parsed)'''
+    (filename,tags,md5_hash) = args
+    # pydicom silently ignores tags given as plain tuples
+    specific_tags = [pydicom.tag.Tag(x) for x in tags]
+    try:
+        with open(filename,'rb') as f:
+            buff = f.read() if md5_hash else f.read(132)
+            if buff[128:132]!="DICM":
+                return (filename,None)
+            if md5_hash:
+                d = pydicom.read_file(StringIO.StringIO(buff),stop_before_pixels=True,specific_tags=specific_tags)
+            else:
+                f.seek(0)
+                d = pydicom.read_file(f,stop_before_pixels=True,specific_tags=specific_tags)
+            # the values are only decoded when they're used, so a malformed one fails here
+            tag_dict = _tags_from_dicom(d,filename,tags)
+    except IOError:
+        return (filename,None)
+    except Exception as e:
+        # one broken file shouldn't stop the whole scan (or the pool running it)
+        nl.notify('Warning: could not read DICOM file %s (%s: %s)' % (filename,type(e).__name__,e),level=nl.level.warning)
+        return (filename,None)
+    if md5_hash:
+        tag_dict['md5'] = nl.hash_str(buff)
+    return (filename,tag_dict)
+
+def scan_dir_iter(dirname,tags=None,md5_hash=False,workers=1,threads=False,index=None):
+    '''same as :meth:`scan_dir`, but yields a tuple of ``(filename,tag dict)`` for each DICOM file as soon as it
+    has been read, instead of returning everything at the end
+
+    If ``workers`` is more than 1 (or ``None``, to use one per CPU), the files are read in parallel by a pool
+    of processes (or threads, if ``threads`` is ``True``), and are yielded in the order they finish
+
+    If a :class:`DicomIndex` is given as ``index``, files that are unchanged since they were indexed
+    are not read again, and everything that is read is added to the index'''
+    if tags==None:
+        tags = _default_scan_tags
+    file_list = []
+    for root,dirs,files in os.walk(dirname):
+        for filename in files:
+            fullname = os.path.join(root,filename)
+            if index:
+                (found,tag_dict) = index.lookup(fullname,tags,md5_hash)
+                if found:
+                    if tag_dict!=None:
+                        yield (fullname,tag_dict)
+                    continue
+            file_list.append((fullname,tags,md5_hash))
+    if workers==1:
+        results = itertools.imap(_scan_file,file_list)
+        pool = None
+    else:
+        if workers==None:
+            workers = multiprocessing.cpu_count()
+        pool = multiprocessing.pool.ThreadPool(workers) if threads else multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_scan_file,file_list,chunksize=16)
+    try:
+        for (fullname,tag_dict) in results:
+            if index:
+                index.update(fullname,tags,tag_dict)
+            if tag_dict!=None:
+                yield (fullname,tag_dict)
+        if pool:
+            pool.close()
+    finally:
+        if index:
+            index.commit()
+        if pool:
+            pool.terminate()
+            pool.join()
+
+def scan_dir(dirname,tags=None,md5_hash=False,workers=1,threads=False,index=None):
     '''scans a directory tree and returns a dictionary with files and key DICOM tags
 
     return value is a dictionary absolute filenames as keys and with dictionaries of tags/values
@@ -125,35 +367,27 @@ def scan_dir(dirname,tags=None,md5_hash=False):
 
     If the param ``md5_hash`` is ``True``, this will also return the MD5 hash of the file. This is useful
     for detecting duplicate files
-    '''
-    if tags==None:
-        tags = [
-            (0x0008, 0x0021),
-            (0x0008, 0x0031),
-            (0x0008, 0x103E),
-            (0x0008, 0x0080),
-            (0x0010, 0x0020),
-            (0x0028, 0x0010),
-            (0x0028, 0x0011),
-        ]
 
-    return_dict = {}
+    Large directories can be scanned in parallel by setting ``workers`` to the number of processes
+    to use (``None`` will use one per CPU). If ``threads`` is ``True``, a pool of threads will be used
+    instead of processes. See :meth:`scan_dir_iter` to process the results as they come in
 
-    for root,dirs,files in os.walk(dirname):
-        for filename in files:
-            fullname = os.path.join(root,filename)
-            if is_dicom(fullname):
-                return_dict[fullname] = info_for_tags(fullname,tags)
-                if md5_hash:
-                    return_dict[fullname]['md5'] = nl.hash(fullname)
-    return return_dict
+    If a :class:`DicomIndex` is given as ``index``, only new or changed files will be read
+    '''
+    return dict(scan_dir_iter(dirname,tags,md5_hash,workers,threads,index))
 
 valid = '_.' + string.ascii_letters + string.digits
 def scrub_fname(fname):
     return ''.join(c for c in fname.replace(' ','_') if c in valid).replace('__','_')
 
-def find_dups(file_dict):
-    '''takes output from :meth:`scan_dir` and returns list of duplicate files'''
+def find_dups(file_dict,workers=1):
+    '''takes output from :meth:`scan_dir` and returns list of duplicate files
+
+    If the files were scanned with ``md5_hash``, those hashes are compared. Otherwise, the files are
+    compared using :meth:`neural.utils.find_duplicates` (using ``workers`` threads), which only reads the
+    files it needs to'''
+    if not all(['md5' in file_dict[f] for f in file_dict]):
+        return nl.utils.find_duplicates(file_dict.keys(),workers=workers)
     found_hashes = {}
     for f in file_dict:
         if file_dict[f]['md5'] not in found_hashes:
@@ -182,30 +416,63 @@ def cluster_files(file_dict):
         return_dict[dict_key]['files'].append(filename)
     return return_dict
 
-def max_diff(dset1,dset2):
+def max_diff(dset1,dset2,tolerance=None,check_header=False,chunk_size=2**22):
     '''calculates maximal voxel-wise difference in datasets (in %)
 
     Useful for checking if datasets have the same data. For example, if the maximum difference is
-    < 1.0%, they're probably the same dataset'''
+    < 1.0%, they're probably the same dataset
+
+    The difference at each voxel is ``(a-b)/((a+b)/2)`` as a percent (worked out in the datatype of the datasets,
+    and skipping voxels where it's infinite or undefined), and the largest one is returned. The datasets are
+    compared a block of about ``chunk_size`` voxels at a time, so only that much of each dataset is in memory
+    at once. Each file is read once from start to end (uncompressed datasets are memory-mapped, and compressed
+    ones are decompressed in a single pass). Identical files return ``0.0`` without reading the data (as do
+    datasets without any voxels where the difference is defined), and datasets with different dimensions return
+    ``inf``.
+
+    :tolerance:     if given, stops as soon as a block has a difference larger than this, and returns that
+                    difference (which is only a lower limit on the maximum), so comparing datasets that are
+                    clearly different is fast
+    :check_header:  also return ``inf`` if the datasets have different datatypes or orientations
+    '''
     for dset in [dset1,dset2]:
         if not os.path.exists(dset):
             nl.notify('Error: Could not find file: %s' % dset,level=nl.level.error)
             return float('inf')
+    if os.path.getsize(dset1)==os.path.getsize(dset2) and filecmp.cmp(dset1,dset2,shallow=False):
+        return 0.0
     try:
-        dset1_d = nib.load(dset1)
-        dset2_d = nib.load(dset2)
-        dset1_data = dset1_d.get_data()
-        dset2_data = dset2_d.get_data()
+        # keeps the files open between blocks, so compressed files are decompressed once, not once per block
+        dset1_d = nib.load(dset1,keep_file_open=True)
+        dset2_d = nib.load(dset2,keep_file_open=True)
     except IOError:
         nl.notify('Error: Could not read files %s and %s' % (dset1,dset2),level=nl.level.error)
         return float('inf')
+    shape = dset1_d.shape
+    if shape!=dset2_d.shape:
+        return float('inf')
+    if check_header and (dset1_d.get_data_dtype()!=dset2_d.get_data_dtype() or not np.allclose(dset1_d.affine,dset2_d.affine)):
+        return float('inf')
+    if len(shape)==0:
+        return 0.0
+    # blocks are along the last axis, which is the slowest-changing one in the files
+    step = max(1,chunk_size // max(1,int(np.prod(shape[:-1]))))
+    max_val = None
+    old_err = np.seterr(divide='ignore',invalid='ignore',over='ignore')
     try:
-        old_err = np.seterr(divide='ignore',invalid='ignore')
-        max_val = 100*np.max(np.ma.masked_invalid(np.double(dset1_data - dset2_data) / ((dset1_data+dset2_data)/2)))
+        for i in xrange(0,shape[-1],step):
+            block1 = np.asarray(dset1_d.dataobj[...,i:i+step])
+            block2 = np.asarray(dset2_d.dataobj[...,i:i+step])
+            diff = np.ma.masked_invalid(np.double(block1 - block2) / ((block1+block2)/2))
+            if diff.count()==0:
+                continue
+            block_max = 100*diff.max()
+            max_val = block_max if max_val==None else max(max_val,block_max)
+            if tolerance!=None and max_val>tolerance:
+                break
+    finally:
         np.seterr(**old_err)
-        return max_val
-    except ValueError:
-        return float('inf')
+    return 0.0 if max_val==None else max_val
 
 def _create_dset_dicom(directory,slice_order='alt+z',sort_order=None,force_slices=None):
     tags = {
@@ -324,6 +591,96 @@ def _create_dset_dicom(directory,slice_order='alt+z',sort_order=None,force_slice
         finally:
             shutil.rmtree(sorted_dir)
 
+def _acquisition_order(wrapper):
+    '''sort key to put images in the order they were acquired'''
+    acq_time = wrapper.get('AcquisitionTime')
+    try:
+        acq_time = float(acq_time)
+    except (TypeError,ValueError):
+        acq_time = 0
+    return (acq_time,wrapper.get('InstanceNumber') or 0)
+
+def _create_dset_native(directory,slice_order='alt+z'):
+    '''creates a NIFTI dataset from the images in ``directory`` using only pydicom/nibabel/NumPy (no AFNI)
+
+    Single-slice images are sorted into slices by their position along the slice normal, and into time points
+    by acquisition time and instance number. Siemens mosaics and multi-frame images are unpacked by nibabel, and
+    each file is taken as one time point'''
+    with nl.notify('Trying to create datasets from %s' % directory):
+        directory = os.path.abspath(directory)
+        if not os.path.exists(directory):
+            nl.notify('Error: could not find %s' % directory,level=nl.level.error)
+            return False
+
+        out_file = '%s.nii.gz' % nl.prefix(os.path.basename(directory))
+        if os.path.exists(out_file):
+            nl.notify('Error: file "%s" already exists!' % out_file,level=nl.level.error)
+            return False
+
+        images = []
+        for f in sorted(glob.glob(directory + '/*')):
+            try:
+                wrapper = dicomwrappers.wrapper_from_file(f)
+                if wrapper.get('Rows')!=None:
+                    # Only include DICOMs that actually have image information
+                    images.append(wrapper)
+            except Exception:
+                pass
+        if len(images)==0:
+            nl.notify('Error: Couldn\'t find any valid DICOM images',level=nl.level.error)
+            return False
+
+        try:
+            first_data = images[0].get_data()
+            if first_data.ndim>2:
+                # Each file is already a volume (or a whole time series)
+                images = sorted(images,key=_acquisition_order)
+                volume_shape = first_data.shape[:3]
+                reps_per_file = first_data.shape[3] if first_data.ndim>3 else 1
+                data = np.empty(volume_shape + (len(images)*reps_per_file,),dtype=first_data.dtype)
+                for i in xrange(len(images)):
+                    image_data = first_data if i==0 else images[i].get_data()
+                    data[...,i*reps_per_file:(i+1)*reps_per_file] = image_data.reshape(volume_shape + (reps_per_file,))
+                affine = images[0].affine
+            else:
+                positions = np.round([x.slice_indicator for x in images],3)
+                slice_positions = np.unique(positions)
+                num_reps = len(images) / len(slice_positions)
+                if num_reps*len(slice_positions)!=len(images):
+                    nl.notify('Error: found %d images at %d slice positions, which doesn\'t divide evenly into time points' % (len(images),len(slice_positions)),level=nl.level.error)
+                    return False
+                data = np.empty(first_data.shape + (len(slice_positions),num_reps),dtype=first_data.dtype)
+                for z in xrange(len(slice_positions)):
+                    slice_images = sorted([images[i] for i in np.where(positions==slice_positions[z])[0]],key=_acquisition_order)
+                    for t in xrange(num_reps):
+                        data[:,:,z,t] = first_data if slice_images[t] is images[0] else slice_images[t].get_data()
+                first_slice = [images[i] for i in np.where(positions==slice_positions[0])[0]][0]
+                affine = first_slice.affine.copy()
+                if len(slice_positions)>1:
+                    affine[:3,2] = first_slice.slice_normal * (slice_positions[-1]-slice_positions[0]) / (len(slice_positions)-1)
+        except (dicomwrappers.WrapperError,ValueError,TypeError) as e:
+            nl.notify('Error: Failed to create dataset (%s)' % e,level=nl.level.error)
+            return False
+
+        if data.shape[3]==1:
+            data = data[...,0]
+        # DICOM coordinates are LPS, NIFTI are RAS
+        img = nib.Nifti1Image(data,np.dot(np.diag([-1,-1,1,1]),affine))
+        img.header.set_xyzt_units('mm','sec')
+        TR = images[0].get('RepetitionTime')
+        if data.ndim>3 and TR:
+            zooms = list(img.header.get_zooms())
+            zooms[3] = float(TR)/1000.0
+            img.header.set_zooms(zooms)
+            slice_codes = dict([(v,k) for (k,v) in nl.dsets._nifti_slice_codes.items()])
+            if slice_order in slice_codes:
+                img.header.set_dim_info(slice=2)
+                img.header['slice_code'] = slice_codes[slice_order]
+                img.header['slice_end'] = data.shape[2]-1
+                img.header['slice_duration'] = zooms[3]/data.shape[2]
+        nib.save(img,out_file)
+        return out_file
+
 def create_dset_to3d(prefix,file_list,file_order='zt',num_slices=None,num_reps=None,TR=None,slice_order='alt+z',only_dicoms=True,sort_filenames=False):
     '''manually create dataset by specifying everything (not recommended, but necessary when autocreation fails)
 
@@ -411,8 +768,16 @@ def create_dset_to3d(prefix,file_list,file_order='zt',num_slices=None,num_reps=N
                     nl.notify('stdout:\n' + out[0] + '\nstderr:\n' + out[1],level=nl.level.error)
             return False
 
-def create_dset(directory,slice_order='alt+z',sort_order='zt',force_slices=None):
-    '''tries to autocreate a dataset from images in the given directory'''
+def create_dset(directory,slice_order='alt+z',sort_order='zt',force_slices=None,native=None):
+    '''tries to autocreate a dataset from images in the given directory
+
+    If ``native`` is ``True``, the dataset is assembled in Python (see :meth:`_create_dset_native`)
+    instead of with AFNI's ``Dimon`` and ``to3d``. By default, this is only done if AFNI isn't installed.
+    ``sort_order`` and ``force_slices`` are only used by AFNI'''
+    if native==None:
+        native = nl.which('to3d')==None
+    if native:
+        return _create_dset_native(directory,slice_order)
     return _create_dset_dicom(directory,slice_order,sort_order,force_slices=force_slices)
     # Add more options for GE I-files, and other non-DICOM data formats
 
@@ -435,45 +800,93 @@ def date_for_image(image_fname):
     date_str = date_info[(0x8,0x21)]
     return date_for_str(date_str)
 
-def organize_dir(orig_dir):
+#! Tags used to sort images into series by :meth:`organize_dir` and :meth:`stream_archive`
+_series_tags = [
+    (0x10,0x20),    # Subj ID
+    (0x8,0x21),     # Date
+    (0x8,0x31),     # Time
+    (0x8,0x103e)    # Descr
+]
+
+def _series_name(info):
+    '''returns the name used for the series directory of an image with the tag dictionary ``info``'''
+    info = dict(info)
+    if (0x8,0x31) in info:
+        info[(0x8,0x31)] = str(int(float(info[(0x8,0x31)])))
+    return '-'.join([scrub_fname(str(info.get(x,'_'))) for x in _series_tags])
+
+def organize_dir(orig_dir,index=False,workers=1):
     '''scans through the given directory and organizes DICOMs that look similar into subdirectories
 
-    output directory is the ``orig_dir`` with ``-sorted`` appended to the end'''
+    output directory is the ``orig_dir`` with ``-sorted`` appended to the end
 
-    tags = [
-        (0x10,0x20),    # Subj ID
-        (0x8,0x21),     # Date
-        (0x8,0x31),     # Time
-        (0x8,0x103e)    # Descr
-    ]
+    If ``index`` is ``True``, a :class:`DicomIndex` is kept next to the output directory (with
+    ``.db`` appended to its name). When run again (e.g., after new images arrive in ``orig_dir``),
+    unchanged files aren't read again, new files that duplicate images that were already organized are
+    deleted, and new images of a series that was already organized are merged into its existing directory.
+
+    ``workers`` is passed on to :meth:`scan_dir`. Returns a list of the directories that were changed'''
+
+    tags = _series_tags
     orig_dir = orig_dir.rstrip('/')
-    files = scan_dir(orig_dir,tags=tags,md5_hash=True)
-    dups = find_dups(files)
+    output_dir = '%s-sorted' % orig_dir
+    dicom_index = None
+    if index:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        dicom_index = DicomIndex(output_dir + '.db')
+    files = scan_dir(orig_dir,tags=tags,workers=workers,index=dicom_index)
+    if dicom_index:
+        # Also look for files that are duplicates of images that have already been organized
+        organized = set()
+        for size in set([os.path.getsize(f) for f in files]):
+            organized.update([x for x in dicom_index.files_with_size(size) if x.startswith(os.path.abspath(output_dir)+'/') and os.path.exists(x)])
+        dups = []
+        for dup in nl.utils.find_duplicates(files.keys() + list(organized),workers=workers):
+            # Keep the organized copy, and never delete anything that was already organized
+            dup = sorted(dup,key=lambda x: x not in organized)
+            dup = dup[:1] + [x for x in dup[1:] if x not in organized]
+            if len(dup)>1:
+                dups.append(dup)
+    else:
+        dups = find_dups(files,workers=workers)
     for dup in dups:
         nl.notify('Found duplicates of %s...' % dup[0])
         for each_dup in dup[1:]:
             nl.notify('\tdeleting %s' % each_dup)
             try:
                 os.remove(each_dup)
-            except IOError:
+                if dicom_index:
+                    dicom_index.remove(each_dup)
+            except (IOError, OSError):
                 nl.notify('\t[failed]')
             del(files[each_dup])
 
     clustered = cluster_files(files)
-    output_dir = '%s-sorted' % orig_dir
+    changed_dirs = []
     for key in clustered:
-        if (0x8,0x31) in clustered[key]['info']:
-            clustered[key]['info'][(0x8,0x31)] = str(int(float(clustered[key]['info'][(0x8,0x31)])))
-        for t in tags:
-            if t not in clustered[key]['info']:
-                clustered[key]['info'][t] = '_'
-        run_name = '-'.join([scrub_fname(str(clustered[key]['info'][x])) for x in tags])+'-%d_images' %len(clustered[key]['files'])
+        series_name = _series_name(clustered[key]['info'])
+        num_images = len(clustered[key]['files'])
+        old_dir = None
+        if dicom_index:
+            series = dicom_index.series(series_name)
+            if series and os.path.exists(os.path.join(output_dir,series['dir'])):
+                old_dir = os.path.join(output_dir,series['dir'])
+                num_images += len(os.listdir(old_dir))
+                if series['dset'] and os.path.exists(os.path.join(output_dir,series['dset'])):
+                    # The dataset made from the old images is out of date
+                    os.remove(os.path.join(output_dir,series['dset']))
+        run_name = series_name + '-%d_images' % num_images
         run_dir = os.path.join(output_dir,run_name)
         nl.notify('Moving files into %s' % run_dir)
         try:
+            if old_dir:
+                os.rename(old_dir,run_dir)
+                for f in os.listdir(run_dir):
+                    dicom_index.rename(os.path.join(old_dir,f),os.path.join(run_dir,f))
             if not os.path.exists(run_dir):
                 os.makedirs(run_dir)
-        except IOError:
+        except (IOError, OSError):
             nl.notify('Error: failed to create directory %s' % run_dir)
         else:
             for f in clustered[key]['files']:
@@ -482,13 +895,21 @@ def organize_dir(orig_dir):
                     if dset_fname[0]=='.':
                         dset_fname = '_' + dset_fname[1:]
                     os.rename(f,os.path.join(run_dir,dset_fname))
+                    if dicom_index:
+                        dicom_index.rename(f,os.path.join(run_dir,dset_fname))
                 except (IOError, OSError):
                     pass
+            if dicom_index:
+                dicom_index.set_series(series_name,run_dir,dirty=True)
+            changed_dirs.append(run_dir)
+    if dicom_index:
+        dicom_index.commit()
     for r,ds,fs in os.walk(output_dir,topdown=False):
         for d in ds:
             dname = os.path.join(r,d)
             if len(os.listdir(dname))==0:
                 os.remove(dname)
+    return changed_dirs
 
 def classify(label_dict,image_fname=None,image_label=None):
     '''tries to classify a DICOM image based on known string patterns (with fuzzy matching)
@@ -518,58 +939,229 @@ def classify(label_dict,image_fname=None,image_label=None):
     else:
         return [x[0] for x in flat_dict if x[1]==best_match[0]][0]
 
-def reconstruct_files(input_dir):
-    '''sorts ``input_dir`` and tries to reconstruct the subdirectories found'''
-    input_dir = input_dir.rstrip('/')
+def stream_archive(fname,output_dir,other_files=None):
+    '''extracts the DICOM images in the archive ``fname`` straight into per-series directories in ``output_dir``
+
+    Each file in the archive is read as a stream (see :meth:`neural.utils.archive_members`), and checked for the
+    DICOM preamble. Images are written into a directory named by their series (like :meth:`organize_dir`),
+    skipping exact duplicates, and everything else is spooled into the tarball ``other_files`` (if given).
+    Returns a list of the series directories, or ``None`` if the archive can't be streamed'''
+    members = nl.utils.archive_members(fname)
+    if members==None:
+        return None
+    specific_tags = [pydicom.tag.Tag(x) for x in _series_tags]
+    series = {}
+    other_tgz = None
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    try:
+        for (name,f) in members:
+            buff = f.read(132)
+            d = None
+            if buff[128:132]=="DICM":
+                buff += f.read()
+                try:
+                    d = pydicom.read_file(StringIO.StringIO(buff),stop_before_pixels=True,specific_tags=specific_tags)
+                except Exception:
+                    d = None
+            if d!=None:
+                series_name = _series_name(dict([(k,d[k].value) for k in _series_tags if k in d]))
+                if series_name not in series:
+                    series[series_name] = {'md5':set(),'files':0}
+                    os.makedirs(os.path.join(output_dir,series_name))
+                md5 = nl.hash_str(buff)
+                if md5 in series[series_name]['md5']:
+                    nl.notify('Skipping duplicate image %s' % name)
+                    continue
+                series[series_name]['md5'].add(md5)
+                series[series_name]['files'] += 1
+                dset_fname = os.path.basename(name)
+                if dset_fname[0]=='.':
+                    dset_fname = '_' + dset_fname[1:]
+                if os.path.exists(os.path.join(output_dir,series_name,dset_fname)):
+                    dset_fname = '%d-%s' % (series[series_name]['files'],dset_fname)
+                with open(os.path.join(output_dir,series_name,dset_fname),'wb') as out:
+                    out.write(buff)
+            elif other_files:
+                if other_tgz==None:
+                    other_tgz = tarfile.open(other_files,'w:gz')
+                with tempfile.SpooledTemporaryFile(max_size=64*1024*1024) as spool:
+                    spool.write(buff)
+                    shutil.copyfileobj(f,spool)
+                    tarinfo = tarfile.TarInfo(name)
+                    tarinfo.size = spool.tell()
+                    tarinfo.mtime = time.time()
+                    spool.seek(0)
+                    other_tgz.addfile(tarinfo,spool)
+    finally:
+        if other_tgz:
+            other_tgz.close()
+    series_dirs = []
+    for series_name in series:
+        run_dir = os.path.join(output_dir,series_name + '-%d_images' % series[series_name]['files'])
+        nl.notify('Extracted %d images into %s' % (series[series_name]['files'],run_dir))
+        os.rename(os.path.join(output_dir,series_name),run_dir)
+        series_dirs.append(run_dir)
+    return series_dirs
+
+def _pool_imap(func,args,workers=1,chunksize=1):
+    '''yields ``func(x)`` for each ``x`` in ``args`` (in order of completion), using a pool of
+    ``workers`` processes (``None`` to use one per CPU) if ``workers`` isn't 1'''
+    if workers==1:
+        for result in itertools.imap(func,args):
+            yield result
+        return
+    if workers==None:
+        workers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(min(workers,max(len(args),1)))
+    try:
+        for result in pool.imap_unordered(func,args,chunksize=chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _create_dset_series(dset_dir):
+    '''runs :meth:`create_dset` on ``dset_dir`` (which should be an absolute path), catching any errors
+    so that one bad series can't bring down the rest. Returns a tuple of ``(dset_dir,dset,error)``'''
+    try:
+        os.chdir(os.path.dirname(dset_dir))
+        return (dset_dir,nl.dicom.create_dset(os.path.basename(dset_dir)),None)
+    except Exception as e:
+        return (dset_dir,None,'%s: %s' % (type(e).__name__,e))
+
+def _gzip_dset(fname):
+    '''gzips the (absolute) filename ``fname``, returning a tuple of ``(fname,error)``'''
+    try:
+        nl.run(['gzip',fname],quiet=True)
+        return (fname,None if os.path.exists(fname + '.gz') else 'gzip failed')
+    except Exception as e:
+        return (fname,'%s: %s' % (type(e).__name__,e))
+
+def _tar_dir(args):
+    '''archives the (absolute) directory ``dirname`` into ``tgz_file``, stored relative to its parent directory.
+    Takes a tuple of ``(dirname,tgz_file)`` and returns a tuple of ``(dirname,error)``'''
+    (dirname,tgz_file) = args
+    try:
+        with tarfile.open(tgz_file,'w:gz') as tgz:
+            tgz.add(dirname,arcname=os.path.basename(dirname))
+        return (dirname,None)
+    except Exception as e:
+        return (dirname,'%s: %s' % (type(e).__name__,e))
+
+def _create_dsets(dset_dirs,workers=1,dicom_index=None):
+    '''creates a dataset from each of the (absolute) series directories ``dset_dirs``, with
+    ``workers`` processes, and returns a dictionary of series directory -> dataset'''
+    results = {}
+    with nl.notify('creating datasets from %d series' % len(dset_dirs)):
+        cwd = os.getcwd()
+        try:
+            for i,(dset_dir,dset,error) in enumerate(_pool_imap(_create_dset_series,dset_dirs,workers)):
+                dset_name = os.path.basename(dset_dir)
+                results[dset_name] = dset
+                if error:
+                    nl.notify('Error: [%d/%d] failed to create dataset from %s (%s)' % (i+1,len(dset_dirs),dset_name,error),level=nl.level.error)
+                elif not dset:
+                    nl.notify('Warning: [%d/%d] couldn\'t create dataset from %s' % (i+1,len(dset_dirs),dset_name),level=nl.level.warning)
+                else:
+                    nl.notify('[%d/%d] created %s from %s' % (i+1,len(dset_dirs),dset,dset_name))
+                    if dicom_index:
+                        dicom_index.set_series(dicom_index.series_for_dir(dset_name),dirty=False,dset=dset)
+                        dicom_index.commit()
+        finally:
+            os.chdir(cwd)
+    return results
+
+def reconstruct_files(input_dir,index=False,workers=1):
+    '''sorts ``input_dir`` and tries to reconstruct the subdirectories found
+
+    If ``index`` is ``True``, uses the :class:`DicomIndex` kept by :meth:`organize_dir`, and only
+    (re)creates the datasets of series that have changed since the last time
+
+    If ``workers`` is more than 1 (or ``None``, to use one per CPU), the series are converted in parallel
+    by a pool of processes. A series that fails to convert is reported and skipped without affecting the others.
+    Returns a dictionary mapping each series directory that was converted to its dataset (or ``None`` if it failed)'''
+    input_dir = os.path.abspath(input_dir.rstrip('/'))
+    results = {}
     with nl.notify('Attempting to organize/reconstruct directory'):
         # Some datasets start with a ".", which confuses many programs
         for r,ds,fs in os.walk(input_dir):
             for f in fs:
                 if f[0]=='.':
                     shutil.move(os.path.join(r,f),os.path.join(r,'i'+f))
-        nl.dicom.organize_dir(input_dir)
+        nl.dicom.organize_dir(input_dir,index=index,workers=workers)
         output_dir = '%s-sorted' % input_dir
         if os.path.exists(output_dir):
-            with nl.run_in(output_dir):
-                for dset_dir in os.listdir('.'):
-                    with nl.notify('creating dataset from %s' % dset_dir):
-                        nl.dicom.create_dset(dset_dir)
+            dicom_index = DicomIndex(output_dir + '.db') if index else None
+            dset_dirs = []
+            for dset_dir in sorted(os.listdir(output_dir)):
+                if not os.path.isdir(os.path.join(output_dir,dset_dir)):
+                    continue
+                if dicom_index:
+                    series_name = dicom_index.series_for_dir(dset_dir)
+                    if series_name==None:
+                        continue
+                    series = dicom_index.series(series_name)
+                    if not series['dirty'] and series['dset'] and os.path.exists(os.path.join(output_dir,series['dset'])):
+                        continue
+                dset_dirs.append(os.path.join(output_dir,dset_dir))
+            results = _create_dsets(dset_dirs,workers,dicom_index)
         else:
             nl.notify('Warning: failed to auto-organize directory %s' % input_dir,level=nl.level.warning)
+    return results
 
-def unpack_archive(fname,out_dir):
+def unpack_archive(fname,out_dir,workers=1,stream=False):
     '''unpacks the archive file ``fname`` and reconstructs datasets into ``out_dir``
 
     Datasets are reconstructed and auto-named using :meth:`create_dset`. The raw directories
     that made the datasets are archive with the dataset name suffixed by ``tgz``, and any other
-    files found in the archive are put into ``other_files.tgz``'''
+    files found in the archive are put into ``other_files.tgz``
+
+    If ``workers`` is more than 1 (or ``None``, to use one per CPU), the conversion, gzip and tar
+    steps are each run in parallel by a pool of processes (see :meth:`reconstruct_files`)
+
+    If ``stream`` is ``True`` (and the archive is a zip file or tarball), the archive is read with :meth:`stream_archive`
+    instead of being extracted to disk and then organized, and other files are written straight into ``other_files.tgz``'''
     with nl.notify('Unpacking archive %s' % fname):
         tmp_dir = tempfile.mkdtemp()
         tmp_unpack = os.path.join(tmp_dir,'unpack')
-        os.makedirs(tmp_unpack)
-        nl.utils.unarchive(fname,tmp_unpack)
-        reconstruct_files(tmp_unpack)
+        sorted_dir = tmp_unpack+'-sorted'
         out_dir = os.path.abspath(out_dir)
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-        if not os.path.exists(tmp_unpack+'-sorted'):
+        raw_out = os.path.join(out_dir,'raw')
+        if not os.path.exists(raw_out):
+            os.makedirs(raw_out)
+        series_dirs = None
+        if stream:
+            series_dirs = stream_archive(fname,sorted_dir,os.path.join(raw_out,'other_files.tgz'))
+        if series_dirs!=None:
+            _create_dsets(series_dirs,workers)
+        else:
+            os.makedirs(tmp_unpack)
+            nl.utils.unarchive(fname,tmp_unpack)
+            reconstruct_files(tmp_unpack,workers=workers)
+        if not os.path.exists(sorted_dir):
+            shutil.rmtree(tmp_dir)
             return
-        with nl.run_in(tmp_unpack+'-sorted'):
-            for fname in glob.glob('*.nii'):
-                nl.run(['gzip',fname])
-            for fname in glob.glob('*.nii.gz'):
-                new_file = os.path.join(out_dir,fname)
-                if not os.path.exists(new_file):
-                    shutil.move(fname,new_file)
-            raw_out = os.path.join(out_dir,'raw')
-            if not os.path.exists(raw_out):
-                os.makedirs(raw_out)
-            for rawdir in os.listdir('.'):
-                rawdir_tgz = os.path.join(raw_out,rawdir+'.tgz')
-                if not os.path.exists(rawdir_tgz):
-                    with tarfile.open(rawdir_tgz,'w:gz') as tgz:
-                        tgz.add(rawdir)
-        if len(os.listdir(tmp_unpack))!=0:
+        nii_files = [os.path.join(sorted_dir,x) for x in glob.glob1(sorted_dir,'*.nii')]
+        for (nii_file,error) in _pool_imap(_gzip_dset,nii_files,workers):
+            if error:
+                nl.notify('Error: failed to gzip %s (%s)' % (os.path.basename(nii_file),error),level=nl.level.error)
+        for fname in glob.glob1(sorted_dir,'*.nii.gz'):
+            new_file = os.path.join(out_dir,fname)
+            if not os.path.exists(new_file):
+                shutil.move(os.path.join(sorted_dir,fname),new_file)
+        raw_dirs = []
+        for rawdir in os.listdir(sorted_dir):
+            rawdir_tgz = os.path.join(raw_out,rawdir+'.tgz')
+            if not os.path.exists(rawdir_tgz):
+                raw_dirs.append((os.path.join(sorted_dir,rawdir),rawdir_tgz))
+        for i,(rawdir,error) in enumerate(_pool_imap(_tar_dir,raw_dirs,workers)):
+            if error:
+                nl.notify('Error: [%d/%d] failed to archive %s (%s)' % (i+1,len(raw_dirs),os.path.basename(rawdir),error),level=nl.level.error)
+            else:
+                nl.notify('[%d/%d] archived %s' % (i+1,len(raw_dirs),os.path.basename(rawdir)))
+        if os.path.exists(tmp_unpack) and len(os.listdir(tmp_unpack))!=0:
             # There are still raw files left
             with tarfile.open(os.path.join(raw_out,'other_files.tgz'),'w:gz') as tgz:
                 tgz.add(tmp_unpack)
@@ -1,6 +1,8 @@
 '''methods to do simple manipulations of datasets'''
 import neural as nl
 import shutil,os,glob,re,subprocess
+import collections,copy,threading,sqlite3
+import cPickle as pickle
 from operator import mul
 
 _afni_suffix_regex = r"((\+(orig|tlrc|acpc))?\.?(nii|HEAD|BRIK)?(.gz|.bz2)?)(\[\d+\])?$"
@@ -207,13 +209,343 @@ def _dset_info_afni(dset):
 
     return info
 
-def dset_info(dset):
-    '''returns a :class:`DsetInfo` object containing the meta-data from ``dset``'''
-    if nl.pkg_available('afni'):
-        return _dset_info_afni(dset)
-    nl.notify('Error: no packages available to get dset info',level=nl.level.error)
+#: AFNI ``BRICK_TYPES`` codes
+_afni_datum = {0:'byte',1:'short',2:'int',3:'float',4:'double',5:'complex',6:'rgb',7:'rgba'}
+#: numpy types of NIFTI datasets as AFNI datum names
+_nifti_datum = {'uint8':'byte','int16':'short','int32':'int','float32':'float','float64':'double','complex64':'complex'}
+#: AFNI statistic codes (the same numbers are used for NIFTI intent codes) and the number of parameters each takes
+_stat_codes = {2:('fico',3),3:('fitt',1),4:('fift',2),5:('fizt',0),6:('fict',1),7:('fibt',2),8:('fibn',2),9:('figt',2),10:('fipt',1)}
+#: NIFTI ``slice_code`` values as AFNI slice timing patterns
+_nifti_slice_codes = {1:'seq+z',2:'seq-z',3:'alt+z',4:'alt-z',5:'alt+z2',6:'alt-z2'}
+#: letter of the starting side of each AFNI ``ORIENT_SPECIFIC`` code
+_afni_orient_codes = 'RLPAIS'
+
+def _read_afni_head(filename):
+    '''parses the attributes of an AFNI ``.HEAD`` file into a ``dict``'''
+    with open(filename) as f:
+        head = f.read()
+    attrs = {}
+    for m in re.finditer(r'type\s*=\s*(\S+)-attribute\s+name\s*=\s*(\S+)\s+count\s*=\s*(\d+)\s*\n',head):
+        value = head[m.end():]
+        if m.group(1)=='string':
+            # string values are quoted with a single "'" and are exactly ``count`` characters long
+            value = value[value.index("'")+1:][:int(m.group(3))-1]
+        else:
+            value = value.split('type',1)[0].split()[:int(m.group(3))]
+            value = [int(x) for x in value] if m.group(1)=='integer' else [float(x) for x in value]
+        attrs[m.group(2)] = value
+    return attrs
+
+def _read_afni_extension(header):
+    '''returns the AFNI attributes stored in the NIML extension of a NIFTI ``header`` as a ``dict``'''
+    attrs = {}
+    for ext in header.extensions:
+        if ext.get_code()!=4:
+            continue
+        for m in re.finditer(r'<AFNI_atr([^>]*)>(.*?)</AFNI_atr>',ext.get_content(),re.S):
+            name = re.search(r'atr_name\s*=\s*"([^"]*)"',m.group(1))
+            ni_type = re.search(r'ni_type\s*=\s*"([^"]*)"',m.group(1))
+            if not name or not ni_type:
+                continue
+            value = m.group(2).strip()
+            if ni_type.group(1)=='String':
+                value = value.strip('"')
+                for escaped,char in [('&quot;','"'),('&apos;',"'"),('&lt;','<'),('&gt;','>'),('&amp;','&')]:
+                    value = value.replace(escaped,char)
+            elif ni_type.group(1)=='int':
+                value = [int(x) for x in value.split()]
+            else:
+                value = [float(x) for x in value.split()]
+            attrs[name.group(1)] = value
+    return attrs
+
+def _slice_pattern(offsets):
+    '''tries to match a list of slice time ``offsets`` to one of AFNI's named slice timing patterns'''
+    n = len(offsets)
+    if n<2 or max(offsets)<=0:
+        return None
+    order = sorted(range(n),key=lambda x: offsets[x])
+    odd_first = range(0,n,2) + range(1,n,2)
+    even_first = range(1,n,2) + range(0,n,2)
+    patterns = [
+        ('seq+z',range(n)),
+        ('seq-z',range(n)[::-1]),
+        ('alt+z',odd_first),
+        ('alt-z',[n-1-x for x in odd_first]),
+        ('alt+z2',even_first),
+        ('alt-z2',[n-1-x for x in even_first])
+    ]
+    for name,pattern in patterns:
+        if order==pattern:
+            return name
+    return None
+
+def _fill_dset_info(info,attrs,num_bricks):
+    '''fills in the subbrick and timing fields of ``info`` from the AFNI attributes in ``attrs``'''
+    labels = attrs.get('BRICK_LABS','').split('~')
+    for i in xrange(num_bricks):
+        if i<len(info.subbricks):
+            brick_info = info.subbricks[i]
+        else:
+            brick_info = {'index':i,'label':'#%d' % i,'datum':None}
+            info.subbricks.append(brick_info)
+        if i<len(labels) and labels[i]!='':
+            brick_info['label'] = labels[i]
+        if 'BRICK_TYPES' in attrs and i<len(attrs['BRICK_TYPES']):
+            brick_info['datum'] = _afni_datum.get(attrs['BRICK_TYPES'][i],str(attrs['BRICK_TYPES'][i]))
+        if 'BRICK_STATS' in attrs and 2*i+1<len(attrs['BRICK_STATS']):
+            brick_info['min'] = attrs['BRICK_STATS'][2*i]
+            brick_info['max'] = attrs['BRICK_STATS'][2*i+1]
+    # BRICK_STATAUX is a flat list of: brick index, stat code, number of params, params...
+    stataux = attrs.get('BRICK_STATAUX',[])
+    i = 0
+    while i+2<len(stataux):
+        brick,code,num_params = [int(x) for x in stataux[i:i+3]]
+        params = stataux[i+3:i+3+num_params]
+        if code in _stat_codes and brick<len(info.subbricks):
+            info.subbricks[brick]['stat'] = _stat_codes[code][0]
+            info.subbricks[brick]['params'] = ['%g' % x for x in params]
+        i += 3 + num_params
+    info.reps = len(info.subbricks)
+
+    if 'HISTORY_NOTE' in attrs:
+        slice_timing = re.findall('-time:[tz][tz] \d+ \d+ [0-9.]+ (.*?) ',attrs['HISTORY_NOTE'])
+        if len(slice_timing):
+            info.slice_timing = slice_timing[0]
+    details_attrs = {
+        'identifier': 'IDCODE_STRING',
+        'space': 'TEMPLATE_SPACE'
+    }
+    for d in details_attrs:
+        if details_attrs[d] in attrs:
+            setattr(info,d,attrs[details_attrs[d]])
+
+def _fill_dset_grid(info,orient,origin,delta,dims):
+    '''fills in the spatial fields of ``info``, given the starting side letter, RAI origin, signed step and
+    number of voxels for each of the 3 dataset axes'''
+    info.orient = ''.join(orient)
+    for axis in ['RL','AP','IS']:
+        i = [x in axis for x in orient].index(True)
+        end = origin[i] + delta[i]*(dims[i]-1)
+        info.spatial_from.append(float(min(origin[i],end)))
+        info.spatial_to.append(float(max(origin[i],end)))
+        info.voxel_size.append(float(abs(delta[i])))
+        info.voxel_dims.append(float(dims[i]))
+    info.voxel_volume = reduce(mul,info.voxel_size)
+
+def _dset_info_head(head_file):
+    '''reads the :class:`DsetInfo` of an AFNI dataset directly from its ``.HEAD`` file'''
+    attrs = _read_afni_head(head_file)
+    info = DsetInfo()
+    _fill_dset_grid(info,[_afni_orient_codes[x] for x in attrs['ORIENT_SPECIFIC'][:3]],attrs['ORIGIN'],attrs['DELTA'],attrs['DATASET_DIMENSIONS'][:3])
+    _fill_dset_info(info,attrs,attrs['DATASET_RANK'][1])
+    if 'TAXIS_NUMS' in attrs and 'TAXIS_FLOATS' in attrs:
+        info.TR = attrs['TAXIS_FLOATS'][1]
+        if attrs['TAXIS_NUMS'][2]==77001:
+            # stored in ms
+            info.TR /= 1000.0
+        if info.slice_timing==None and 'TAXIS_OFFSETS' in attrs:
+            info.slice_timing = _slice_pattern(attrs['TAXIS_OFFSETS'])
+    info.filetype = 'BRIK'
+    return info
+
+def _dset_info_nifti(dset):
+    '''reads the :class:`DsetInfo` of a NIFTI dataset directly from its header'''
+    import nibabel as nib
+    import numpy as np
+    img = nib.load(dset)
+    header = img.header
+    info = DsetInfo()
+    # NIFTI affines map to RAS, but everything in DsetInfo is in RAI
+    affine = np.dot(np.diag([-1,-1,1,1]),img.affine)
+    orient = []
+    delta = []
+    origin = []
+    for i in xrange(3):
+        column = affine[:3,i]
+        axis = int(np.argmax(np.abs(column)))
+        orient.append('RAI'[axis] if column[axis]>0 else 'LPS'[axis])
+        delta.append(np.sign(column[axis])*np.sqrt(np.sum(column**2)))
+        origin.append(affine[axis,3])
+    shape = img.shape + (1,)*(3-len(img.shape))
+    _fill_dset_grid(info,orient,origin,delta,shape[:3])
+    num_bricks = int(np.prod(shape[3:])) if len(shape)>3 else 1
+    datum = _nifti_datum.get(str(header.get_data_dtype()),str(header.get_data_dtype()))
+    info.subbricks = [{'index':i,'label':'#%d' % i,'datum':datum} for i in xrange(num_bricks)]
+    intent = int(header['intent_code'])
+    if intent in _stat_codes:
+        params = [float(header['intent_p%d' % (p+1)]) for p in xrange(_stat_codes[intent][1])]
+        for brick_info in info.subbricks:
+            brick_info['stat'] = _stat_codes[intent][0]
+            brick_info['params'] = ['%g' % x for x in params]
+    _fill_dset_info(info,_read_afni_extension(header),num_bricks)
+    if num_bricks>1 and len(shape)==4:
+        TR = float(header.get_zooms()[3])
+        if header.get_xyzt_units()[1]=='msec':
+            TR /= 1000.0
+        if TR>0:
+            info.TR = TR
+    if info.slice_timing==None:
+        info.slice_timing = _nifti_slice_codes.get(int(header['slice_code']))
+    info.filetype = 'NIFTI'
+    return info
+
+def _header_file(dset):
+    '''returns the file containing the header of ``dset`` (ignoring any subbrick selector), or ``None``
+    if it doesn't look like an existing dataset file'''
+    dset = strip_subbrick(str(dset))
+    if is_afni(dset):
+        dset = re.sub(r'\.?(HEAD|BRIK)?(\.(gz|bz2?))?$','',dset) + '.HEAD'
+    elif not is_nifti(dset):
+        return None
+    if os.path.exists(dset):
+        return dset
     return None
 
+def _dset_info_native(dset):
+    '''reads the header of ``dset`` without calling any external programs
+
+    Returns ``None`` if ``dset`` isn't a plain dataset file (e.g., has a subbrick selector or
+    is a ``3dcalc`` expression) or can't be parsed'''
+    dset = str(dset)
+    header_file = _header_file(dset)
+    if header_file==None or strip_subbrick(dset)!=dset:
+        return None
+    try:
+        if is_nifti(header_file):
+            return _dset_info_nifti(header_file)
+        return _dset_info_head(header_file)
+    except Exception:
+        # Something in the header we didn't expect, let 3dinfo deal with it
+        pass
+    return None
+
+class DsetInfoCache(object):
+    '''cache of :class:`DsetInfo` objects, so unchanged headers aren't read again
+
+    Entries are keyed on the absolute path, size, modification time and inode of the
+    dataset header, so any change to the file will cause it to be read again. The most recently
+    used ``max_size`` entries are kept in memory. If ``db_file`` is given, entries are also saved
+    in a SQLite database at that path, which persists across runs (and can be shared by all of the
+    scripts working on the same study).
+
+    The module-level cache :data:`info_cache` is used by :meth:`dset_info`. Example::
+
+        nl.dsets.info_cache.db_file = 'study_dir/dset_info.db'
+        for subj in subjects:
+            nl.dset_info(subj + '.nii.gz')
+        print nl.dsets.info_cache.hits, nl.dsets.info_cache.misses
+    '''
+    def __init__(self,max_size=1024,db_file=None):
+        self.max_size = max_size
+        self.db_file = db_file
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._db = None
+        self._db_key = None
+
+    def _key(self,dset):
+        header_file = _header_file(dset)
+        if header_file==None:
+            return None
+        try:
+            s = os.stat(header_file)
+        except OSError:
+            return None
+        return (os.path.abspath(str(dset)),s.st_size,s.st_mtime,s.st_ino)
+
+    def _connection(self):
+        '''returns a connection to ``db_file``, (re)opening it if the file or process changed'''
+        if self.db_file==None:
+            return None
+        if self._db_key!=(self.db_file,os.getpid()):
+            self._db = sqlite3.connect(self.db_file,timeout=30,check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS dset_info (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, info BLOB)')
+            self._db.commit()
+            self._db_key = (self.db_file,os.getpid())
+        return self._db
+
+    def get(self,dset):
+        '''returns a copy of the cached :class:`DsetInfo` for ``dset``, or ``None`` if it isn't cached'''
+        key = self._key(dset) if self.enabled else None
+        if key==None:
+            return None
+        with self._lock:
+            info = self._entries.pop(key,None)
+            if info==None:
+                db = self._connection()
+                if db:
+                    row = db.execute('SELECT size,mtime,inode,info FROM dset_info WHERE path=?',(key[0],)).fetchone()
+                    if row and tuple(row[:3])==key[1:]:
+                        info = pickle.loads(str(row[3]))
+            if info==None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key,info)
+            return copy.deepcopy(info)
+
+    def _store(self,key,info):
+        self._entries[key] = info
+        while len(self._entries)>self.max_size:
+            self._entries.popitem(last=False)
+
+    def put(self,dset,info):
+        '''saves a copy of ``info`` as the :class:`DsetInfo` for ``dset``'''
+        key = self._key(dset) if self.enabled else None
+        if key==None or info==None:
+            return
+        info = copy.deepcopy(info)
+        with self._lock:
+            self._store(key,info)
+            db = self._connection()
+            if db:
+                db.execute('INSERT OR REPLACE INTO dset_info VALUES (?,?,?,?,?)',key + (sqlite3.Binary(pickle.dumps(info,2)),))
+                db.commit()
+
+    def invalidate(self,dset=None):
+        '''removes ``dset`` (including any subbrick-selected versions of it) from the cache, or clears
+        the entire cache if ``dset`` is ``None``'''
+        with self._lock:
+            db = self._connection()
+            if dset==None:
+                self._entries.clear()
+                if db:
+                    db.execute('DELETE FROM dset_info')
+            else:
+                path = os.path.abspath(strip_subbrick(str(dset)))
+                for key in [k for k in self._entries if strip_subbrick(k[0])==path]:
+                    del(self._entries[key])
+                if db:
+                    # compares the start of the path exactly (LIKE would treat "_" and "%" in the path as wildcards)
+                    prefix = path + '['
+                    db.execute('DELETE FROM dset_info WHERE path=? OR substr(path,1,?)=?',(path,len(prefix.decode('utf-8','replace')),prefix))
+            if db:
+                db.commit()
+
+#: cache used by :meth:`dset_info`
+info_cache = DsetInfoCache()
+
+def dset_info(dset):
+    '''returns a :class:`DsetInfo` object containing the meta-data from ``dset``
+
+    Reads the header directly if possible, and otherwise falls back to parsing
+    the output of ``3dinfo``. Results are cached in :data:`info_cache`'''
+    info = info_cache.get(dset)
+    if info:
+        return info
+    info = _dset_info_native(dset)
+    if info==None:
+        if not nl.pkg_available('afni'):
+            nl.notify('Error: no packages available to get dset info',level=nl.level.error)
+            return None
+        info = _dset_info_afni(dset)
+    info_cache.put(dset,info)
+    return info
+
 def auto_polort(dset):
     '''a copy of 3dDeconvolve's ``-polort A`` option'''
     info = nl.dset_info(dset)
@@ -1,30 +1,164 @@
 import nibabel as nib
+import numpy as np
 import neural as nl
+import multiprocessing,itertools
+
+# the function, (voxels x time) matrix and voxel indices of the running :meth:`Analyze.apply`, inherited by the pool processes
+_apply_state = None
+
+def _apply_chunk(chunk):
+    '''runs the function of :meth:`Analyze.apply` on the voxels ``chunk[0]:chunk[1]`` (in a pool process)'''
+    (func,matrix,indices) = _apply_state
+    return np.asarray(func(np.asarray(matrix[indices[chunk[0]:chunk[1]]])))
 
 class Analyze:
     ''' class to do arbitrary analyses on datasets
-    
+
     Basically just a wrapper for NiBabel
+
+    For voxel-wise analyses, :meth:`apply` runs a function on blocks of voxel time series at a time (which
+    is much faster than looping through voxels one at a time with :meth:`voxel_loop`), and puts the results
+    back into a dataset. For example, to calculate the coefficient of variation in every voxel of the brain::
+
+        def cv(x):
+            return x.std(axis=1) / x.mean(axis=1)
+
+        analyze = nl.general.Analyze('epi.nii')
+        analyze.apply(cv,mask='mask.nii.gz',prefix='epi_cv.nii.gz')
     '''
-    def __init__(self,dset=None):
+    def __init__(self,dset=None,mmap=True):
         '''if ``dset`` is given, will automatically be loaded'''
         self.dset_filename = dset
         self.data = None
         self.header = None
         if dset:
-            self.load(dset)
-    
-    def load(self,dset):
-        '''load a dataset from given filename into the object'''
+            self.load(dset,mmap)
+
+    def load(self,dset,mmap=True):
+        '''load a dataset from given filename into the object
+
+        If ``mmap`` is ``True``, uncompressed datasets are memory-mapped, so only the parts of the data that
+        are used are read from the disk (compressed datasets are always read completely)'''
         self.dset_filename = dset
-        self.dset = nib.load(dset)
+        self.dset = nib.load(dset,mmap=mmap)
         self.data = self.dset.get_data()
         self.header = self.dset.get_header()
-    
+
+    def reps(self):
+        '''number of time points (1 for a 3D dataset)'''
+        return self.data.shape[3] if self.data.ndim>3 else 1
+
+    def matrix(self):
+        '''returns the data as a (voxels x time) matrix, without copying it
+
+        Voxels are in the same order as they are stored in the file (``x`` changing fastest)'''
+        return self.data.reshape((-1,self.reps()),order='F')
+
+    def mask_indices(self,mask=None):
+        '''returns the rows of :meth:`matrix` that are inside ``mask`` (all of them, if ``mask`` is ``None``)
+
+        ``mask`` can be a filename, an :class:`Analyze` or an array with the same grid as the dataset. Any
+        non-zero voxel is in the mask. Returns ``None`` if the mask doesn't match the dataset'''
+        if mask is None:
+            return np.arange(np.prod(self.data.shape[:3]))
+        if isinstance(mask,basestring):
+            mask = Analyze(mask).data
+        elif isinstance(mask,Analyze):
+            mask = mask.data
+        mask = np.asarray(mask)
+        if mask.ndim>3:
+            mask = mask[...,0]
+        if mask.shape!=self.data.shape[:3]:
+            nl.notify('Error: mask has dimensions %s, but dataset %s has dimensions %s' % (mask.shape,self.dset_filename,self.data.shape[:3]),level=nl.level.error)
+            return None
+        return np.flatnonzero(mask.reshape(-1,order='F'))
+
+    def voxel_matrix(self,mask=None):
+        '''returns a tuple of the (voxels x time) matrix of the voxels in ``mask`` (see :meth:`mask_indices`),
+        and the indices of those voxels in :meth:`matrix`'''
+        indices = self.mask_indices(mask)
+        if indices is None:
+            return None
+        return (np.asarray(self.matrix()[indices]),indices)
+
+    def voxel_chunks(self,mask=None,chunk_size=10000):
+        '''iterator that yields tuples of ``(indices, voxels x time matrix)`` for blocks of ``chunk_size`` voxels
+        in ``mask`` at a time. Memory-mapped datasets are only read one block at a time'''
+        indices = self.mask_indices(mask)
+        if indices is None:
+            return
+        matrix = self.matrix()
+        for i in xrange(0,len(indices),chunk_size):
+            chunk = indices[i:i+chunk_size]
+            yield (chunk,np.asarray(matrix[chunk]))
+
+    def apply(self,func,mask=None,chunk_size=10000,workers=1,prefix=None,fill=0):
+        '''runs ``func`` on the time series of every voxel (in ``mask``), a block of voxels at a time, and returns
+        the results as an array on the same grid as the dataset
+
+        :func:          takes a (voxels x time) array and returns an array with one value (or one row of values) for
+                        each voxel. Voxels are given in blocks of up to ``chunk_size``
+        :mask:          only use the voxels inside this mask (see :meth:`mask_indices`); voxels outside of it
+                        are set to ``fill``
+        :workers:       number of processes to split the blocks over (``None`` uses one per CPU). ``func`` must
+                        be defined at the top level of a module, so it can be sent to the processes
+        :prefix:        if given, the results are also saved as a dataset with this filename
+
+        Returns a 3D array if ``func`` returns one value per voxel, otherwise a 4D array. Returns ``None`` if
+        the mask doesn't match the dataset'''
+        global _apply_state
+        indices = self.mask_indices(mask)
+        if indices is None:
+            return None
+        if workers==None:
+            workers = multiprocessing.cpu_count()
+        chunks = [(i,min(i+chunk_size,len(indices))) for i in xrange(0,len(indices),chunk_size)]
+        _apply_state = (func,self.matrix(),indices)
+        pool = None
+        try:
+            if workers>1 and len(chunks)>1:
+                # the pool is started after _apply_state is set, so the processes get the data without copying it
+                pool = multiprocessing.Pool(min(workers,len(chunks)))
+                results = pool.imap(_apply_chunk,chunks)
+            else:
+                results = (_apply_chunk(chunk) for chunk in chunks)
+            output = None
+            for (chunk,result) in itertools.izip(chunks,results):
+                if result.shape[0]!=chunk[1]-chunk[0]:
+                    nl.notify('Error: function returned %d values for %d voxels' % (result.shape[0],chunk[1]-chunk[0]),level=nl.level.error)
+                    return None
+                if output is None:
+                    output = np.empty((np.prod(self.data.shape[:3]),) + result.shape[1:],dtype=result.dtype)
+                    output.fill(fill)
+                output[indices[chunk[0]:chunk[1]]] = result
+            if pool:
+                pool.close()
+        finally:
+            _apply_state = None
+            if pool:
+                pool.terminate()
+                pool.join()
+        if output is None:
+            output = np.empty(np.prod(self.data.shape[:3]))
+            output.fill(fill)
+        output = output.reshape(self.data.shape[:3] + output.shape[1:],order='F')
+        if prefix:
+            self.save(output,prefix)
+        return output
+
+    def save(self,data,prefix):
+        '''saves ``data`` (an array on the same grid as the dataset) as a dataset named ``prefix``, with the same
+        orientation as the dataset'''
+        header = self.header.copy()
+        header.set_data_dtype(data.dtype)
+        nib.save(nib.Nifti1Image(data,self.dset.affine,header),prefix)
+
     def voxel_loop(self):
-        '''iterator that loops through each voxel and yields the coords and time series as a tuple'''
-        # Prob not the most efficient, but the best I can do for now:
-        for x in xrange(len(self.data)):
-            for y in xrange(len(self.data[x])):
-                for z in xrange(len(self.data[x][y])):
-                    yield ((x,y,z),self.data[x][y][z])
\ No newline at end of file
+        '''iterator that loops through each voxel and yields the coords and time series as a tuple
+
+        Analyses that can work on many voxels at once should use :meth:`apply` or :meth:`voxel_chunks`
+        instead, which are much faster'''
+        for x in xrange(self.data.shape[0]):
+            for y in xrange(self.data.shape[1]):
+                for z in xrange(self.data.shape[2]):
+                    yield ((x,y,z),self.data[x,y,z])
@@ -0,0 +1,62 @@
+'''deferred imports, so ``import neural`` doesn't have to load every heavy dependency up front
+
+A :class:`lazy_import` stands in for a module until one of its attributes is first used, and then imports it::
+
+    np = nl.lazy.lazy_import('numpy',globals())
+
+    def mean(x):
+        return np.mean(x)       # numpy is imported here, the first time this is called
+'''
+import sys,importlib,warnings
+
+class lazy_import(object):
+    '''stands in for the module ``name``, which is imported the first time one of its attributes is used
+
+    :namespace:         if given (usually ``globals()`` of the calling module), every name in it that refers to this
+                        object is replaced with the real module once it's imported, so later uses cost nothing extra
+    :ignore_warnings:   hide any warnings given while importing the module
+    '''
+    def __init__(self,name,namespace=None,ignore_warnings=False):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_namespace'] = namespace
+        self.__dict__['_lazy_ignore_warnings'] = ignore_warnings
+        self.__dict__['_lazy_module'] = None
+
+    def _lazy_load(self):
+        module = self._lazy_module
+        if module==None:
+            if self._lazy_ignore_warnings:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    module = importlib.import_module(self._lazy_name)
+            else:
+                module = importlib.import_module(self._lazy_name)
+            self.__dict__['_lazy_module'] = module
+            if self._lazy_namespace!=None:
+                for key in [k for k in self._lazy_namespace if self._lazy_namespace[k] is self]:
+                    self._lazy_namespace[key] = module
+        return module
+
+    def __getattr__(self,attr):
+        return getattr(self._lazy_load(),attr)
+
+    def __setattr__(self,attr,value):
+        setattr(self._lazy_load(),attr,value)
+
+    def __delattr__(self,attr):
+        delattr(self._lazy_load(),attr)
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+    def __repr__(self):
+        if self._lazy_module!=None:
+            return repr(self._lazy_module)
+        return "<module '%s' (not imported yet)>" % self._lazy_name
+
+def lazy_submodules(package,names):
+    '''puts a :class:`lazy_import` for each submodule in ``names`` into ``package`` (unless it's already imported)'''
+    module = sys.modules[package]
+    for name in names:
+        if '%s.%s' % (package,name) not in sys.modules:
+            setattr(module,name,lazy_import('%s.%s' % (package,name),module.__dict__))
@@ -6,8 +6,6 @@ the notification to the most appropriate method
 import sys,os,io
 import platform
 import random,string,copy
-import smtplib
-from email.mime.text import MIMEText
 import neural.term
 
 class SMTPServer:
@@ -30,6 +28,8 @@ def enable_email(from_email,server,username=None,password=None,SSL=False,from_na
 def email(to,msg,subject='Neural notification'):
     if default_SMTP==None:
         raise RuntimeError('Email not enabled, must run "enable_email" first!')
+    import smtplib
+    from email.mime.text import MIMEText
     msg = MIMEText(msg)
     msg['Subject'] = subject
     msg['From'] = default_SMTP.from_name
@@ -1,8 +1,10 @@
 import neural as nl
-import subprocess
+import subprocess,math
+from neural.lazy import lazy_import
+np = lazy_import('numpy',globals())
 
-def create_censor_file(input_dset,out_prefix=None,fraction=0.1,clip_to=0.1,max_exclude=0.3,motion_file=None,motion_exclude=1.0):
-    '''create a binary censor file using 3dToutcount
+def create_censor_file(input_dset,out_prefix=None,fraction=0.1,clip_to=0.1,max_exclude=0.3,motion_file=None,motion_exclude=1.0,native=False):
+    '''create a binary censor file from the fraction of outliers at each time point (see :meth:`neural.qc.outcount`)
 
     :input_dset:        the input dataset
     :prefix:            output 1D file (default: ``prefix(input_dset)`` + ``.1D``)
@@ -16,30 +18,42 @@ def create_censor_file(input_dset,out_prefix=None,fraction=0.1,clip_to=0.1,max_e
     :motion_file:       optional filename of a "motion" file with multiple columns and rows corresponding to reps.
                         It doesn't really matter what the values are, as long as they are appropriate relative to ``motion_exclude``
     :motion_exclude:    Will exclude any reps that have a value greater than this in any column of ``motion_file``
+    :native:            passed on to :meth:`neural.qc.outcount`, to count the outliers in Python instead of with AFNI
     '''
-    (outcount,perc_outliers) = nl.qc.outcount(input_dset,fraction)
+    oc = nl.qc.outcount(input_dset,fraction,native)
+    if oc==None:
+        nl.notify('Error: could not count the outliers in dset %s' % input_dset,level=nl.level.error)
+        return False
+    outcount = np.array(oc[0],dtype=float)
     info = nl.dset_info(input_dset)
-    binarize = lambda o,f: [oo<f for oo in o]
-    perc_outliers = lambda o: 1.-(sum(o)/float(info.reps))
+    perc_outliers = lambda o: 1.-(np.count_nonzero(o)/float(info.reps))
 
     if motion_file:
         with open(motion_file,'Ur') as f:
-            motion = [max([float(y) for y in x.strip().split()]) for x in f.read().split('\n') if len(x.strip())>0 and x.strip()[0]!='#']
-            motion_1D = [x for x in binarize(motion,motion_exclude)]
+            motion = np.array([max([float(y) for y in x.strip().split()]) for x in f.read().split('\n') if len(x.strip())>0 and x.strip()[0]!='#'])
+            motion_1D = motion<motion_exclude
             if perc_outliers(motion_1D) > max_exclude:
                 nl.notify('Error: Too many points excluded because of motion (%.2f) in dset %s' % (perc_outliers(motion_1D),input_dset),level=nl.level.error)
                 return False
-            outcount = [outcount[i] if motion_1D[i] else 1. for i in range(len(outcount))]
+            outcount[:len(motion_1D)][~motion_1D[:len(outcount)]] = 1.
 
-    binary_outcount = binarize(outcount,fraction)
+    # True for the points that are kept
+    binary_outcount = outcount<fraction
 
     if max_exclude and perc_outliers(binary_outcount) > max_exclude:
-        nl.notify('Error: Found %.1f%% outliers in dset %s' % (100*perc_outliers(outcount),input_dset),level=nl.level.error)
+        nl.notify('Error: Found %.1f%% outliers in dset %s' % (100*perc_outliers(binary_outcount),input_dset),level=nl.level.error)
         return False
     if clip_to:
-        while perc_outliers(binary_outcount) > clip_to:
-            best_outlier = min([(outcount[i],i) for i in range(len(outcount)) if not binary_outcount[i]])
-            binary_outcount[best_outlier[1]] = True
+        # keep the excluded points with the fewest outliers (ties go to the earliest point) until few enough are excluded
+        kept = np.count_nonzero(binary_outcount)
+        excluded = np.flatnonzero(~binary_outcount)
+        num_keep = min(len(excluded),max(0,int(math.ceil((1.-clip_to)*info.reps))-kept))
+        # the rounding of the formula can be off by one from the test for too many excluded points
+        if num_keep>0 and 1.-((kept+num_keep-1)/float(info.reps)) <= clip_to:
+            num_keep -= 1
+        elif num_keep<len(excluded) and 1.-((kept+num_keep)/float(info.reps)) > clip_to:
+            num_keep += 1
+        binary_outcount[excluded[np.argsort(outcount[excluded],kind='mergesort')[:num_keep]]] = True
     if not out_prefix:
         out_prefix = nl.prefix(input_dset) + '.1D'
     with open(out_prefix,'w') as f:
@@ -1,6 +1,9 @@
 '''quality control functions'''
 import neural as nl
-import tempfile,os,sys,shutil,re
+import tempfile,os,sys,shutil,re,math,multiprocessing
+from neural.lazy import lazy_import
+np = lazy_import('numpy',globals())
+nib = lazy_import('nibabel',globals())
 
 def find_atlas(atlas=None):
     if atlas:
@@ -51,23 +54,207 @@ def atlas_overlap(dset,atlas=None):
         pass
     return (cost,overlap)
 
-def outcount(dset,fraction=0.1):
-    '''gets outlier count and returns ``(list of proportion of outliers by timepoint,total percentage of outlier time points)'''
+def _qginv(p):
+    '''returns ``z`` such that the probability of a standard normal value above ``z`` is ``p`` (AFNI's ``qginv``)'''
+    (low,high) = (-40.0,40.0)
+    for i in xrange(200):
+        mid = (low+high)/2
+        if 0.5*math.erfc(mid/math.sqrt(2))>p:
+            low = mid
+        else:
+            high = mid
+    return (low+high)/2
+
+def _automask(mean,clip_fraction=0.5):
+    '''a simple version of ``3dAutomask``: voxels of the mean image ``mean`` above the clip level, which is
+    ``clip_fraction`` times the median of the voxels above the clip level (found by iterating, starting from
+    the 65th percentile of the positive voxels, like AFNI's ``THD_cliplevel``)'''
+    values = mean[mean>0]
+    if len(values)==0:
+        return mean>0
+    clip = clip_fraction*np.percentile(values,65)
+    for i in xrange(20):
+        new_clip = clip_fraction*np.median(values[values>clip])
+        if abs(new_clip-clip)<1e-6*abs(clip):
+            break
+        clip = new_clip
+    return mean>clip
+
+# the (automask voxels x time) matrix, Legendre basis, its pseudo-inverse and the outlier threshold of the running
+# :meth:`outcount_native`, inherited by the pool processes
+_outcount_state = None
+
+def _outcount_chunk(chunk):
+    '''returns the number of outliers at each time point in the automask voxels ``chunk[0]:chunk[1]``'''
+    (matrix,legendre,fit,threshold) = _outcount_state
+    series = np.array(matrix[chunk[0]:chunk[1]],order='C')
+    # detrends every voxel in the chunk at once, with the pseudo-inverse of the basis worked out beforehand
+    series -= series.dot(fit.T).dot(legendre.T)
+    series -= np.median(series,axis=1)[:,None]
+    deviation = np.abs(series,out=series)
+    mad = np.median(deviation,axis=1)
+    nonzero = mad>0
+    return (deviation[nonzero] > threshold*mad[nonzero,None]).sum(axis=0)
+
+def outcount_native(dset,polort=None,qthr=0.001,chunk_size=20000,workers=1):
+    '''calculates the fraction of outlier voxels at each time point in Python, like ``3dToutcount -fraction -automask``
+
+    Each voxel in the automask is detrended with Legendre polynomials up to order ``polort`` (by default, from
+    :meth:`neural.auto_polort`), and a time point is an outlier if it is more than ``qginv(qthr/reps)*sqrt(pi/2)``
+    times the MAD from the median of the voxel. Voxels are done ``chunk_size`` at a time, split over ``workers``
+    processes (``None`` uses one per CPU). The dataset is read twice, a block of time points at a time: once for
+    the mean of each voxel (for the automask), and once to gather the time series of the automask voxels, which
+    are the only part of it that is in memory (as ``float32``) while the outliers are counted. The automask is only
+    an approximation of ``3dAutomask``, so the results can be slightly different from ``3dToutcount``.
+
+    Returns a list with the fraction for each time point, or ``None`` if ``dset`` can't be read directly'''
+    global _outcount_state
+    engine = nl.stats.roi_engine(dset,native=True)
+    if engine==None:
+        return None
+    if polort==None:
+        polort = int(nl.auto_polort(dset))
+    if workers==None:
+        workers = multiprocessing.cpu_count()
+    reps = engine.reps
+    mean = np.zeros(int(np.prod(engine.shape)))
+    for (i,chunk) in engine.time_chunks():
+        mean += chunk.sum(axis=1,dtype=np.float64)
+    voxels = np.flatnonzero(_automask(mean/reps))
+    if len(voxels)==0 or reps<2:
+        return [0.]*reps
+    matrix = np.empty((len(voxels),reps),dtype=np.float32)
+    for (i,chunk) in engine.time_chunks():
+        matrix[:,i:i+chunk.shape[1]] = chunk[voxels]
+    legendre = np.polynomial.legendre.legvander(np.linspace(-1,1,reps),min(polort,reps-1)).astype(np.float32)
+    fit = np.linalg.pinv(legendre)
+    threshold = _qginv(qthr/reps)*math.sqrt(math.pi/2)
+    chunks = [(i,min(i+chunk_size,len(voxels))) for i in xrange(0,len(voxels),chunk_size)]
+    _outcount_state = (matrix,legendre,fit,threshold)
+    pool = None
+    try:
+        if workers>1 and len(chunks)>1:
+            # the pool is started after _outcount_state is set, so the processes get the data without copying it
+            pool = multiprocessing.Pool(min(workers,len(chunks)))
+            counts = sum(pool.imap_unordered(_outcount_chunk,chunks))
+            pool.close()
+        else:
+            counts = sum([_outcount_chunk(chunk) for chunk in chunks])
+    finally:
+        _outcount_state = None
+        if pool:
+            pool.terminate()
+            pool.join()
+    return list(counts/float(len(voxels)))
+
+def outcount(dset,fraction=0.1,native=False):
+    '''gets outlier count and returns ``(list of proportion of outliers by timepoint,total percentage of outlier time points)
+
+    The outliers are counted with ``3dToutcount``, unless ``native`` is ``True``, which counts them in Python instead
+    (see :meth:`outcount_native`; its automask is only an approximation, so the fractions can differ slightly). If
+    ``native`` is ``None``, Python is used when ``dset`` can be read directly'''
     polort = nl.auto_polort(dset)
     info = nl.dset_info(dset)
-    o = nl.run(['3dToutcount','-fraction','-automask','-polort',polort,dset],stderr=None,quiet=None)
-    if o.return_code==0 and o.output:
-        oc = [float(x) for x in o.output.split('\n') if x.strip()!='']
+    oc = None
+    if native!=False and (native or nl.stats._native_file(dset)!=None):
+        oc = outcount_native(dset,int(polort))
+        if oc==None:
+            return None
+    else:
+        o = nl.run(['3dToutcount','-fraction','-automask','-polort',polort,dset],stderr=None,quiet=None)
+        if o.return_code==0 and o.output:
+            oc = [float(x) for x in o.output.split('\n') if x.strip()!='']
+    if oc!=None:
         binary_outcount = [x<fraction for x in oc]
         perc_outliers = 1 - (sum(binary_outcount)/float(info.reps))
         return (oc,perc_outliers)
 
+def summary_maps(dset,mask=None,prefix=None,chunk_size=16):
+    '''calculates the mean, standard deviation and temporal SNR of every voxel, and the DVARS at every time point,
+    reading ``dset`` only once and ``chunk_size`` time points at a time
+
+    The file is opened once and read from start to end: uncompressed datasets are memory-mapped, and compressed
+    ones are decompressed in a single pass as the chunks are read. Only one chunk of the data (and a few volumes of
+    running totals) is in memory at once, however long the run is. The mean and variance are updated with each
+    chunk using Welford's method, which doesn't lose precision like a running sum of squares does. A 3D dataset
+    is a single time point (with a standard deviation of 0).
+
+    :mask:          dataset on the same grid as ``dset``; voxels outside of it are 0 in the maps and aren't used
+                    for the DVARS
+    :prefix:        if given, the maps are saved as ``prefix_mean.nii.gz``, ``prefix_stdev.nii.gz`` and
+                    ``prefix_tsnr.nii.gz``, and the DVARS as ``prefix_dvars.1D``
+
+    The standard deviation is of the raw time series (like ``3dTstat -stdevNOD``, without detrending), the tSNR
+    is the mean divided by it (0 where it's 0), and the DVARS is the root mean square over the voxels of the
+    change from the previous time point (0 for the first one, like ``3dTto1D -method dvars``).
+
+    Returns a ``dict`` with the 3D arrays ``mean``, ``stdev`` and ``tsnr`` and the array ``dvars``, or ``None``
+    if the datasets can't be read directly'''
+    try:
+        # reads the chunks in order from the open file, so a compressed file isn't decompressed from the start
+        # for every chunk (and a single volume is one chunk)
+        engine = nl.stats.ROIStats(dset,chunk_size)
+    except ValueError as e:
+        nl.notify('Error: %s' % e,level=nl.level.error)
+        return None
+    shape = engine.shape
+    reps = engine.reps
+    if mask is not None:
+        mask_filename = nl.stats._native_file(mask)
+        if mask_filename==None:
+            nl.notify('Error: cannot read %s directly' % mask,level=nl.level.error)
+            return None
+        mask = np.asarray(nib.load(mask_filename).get_data())
+        mask = mask.reshape(mask.shape[:3] + (-1,))[...,0]!=0
+        if mask.shape!=shape:
+            nl.notify('Error: mask has dimensions %s, but dataset %s has dimensions %s' % (mask.shape,dset,shape),level=nl.level.error)
+            return None
+    else:
+        mask = np.ones(shape,dtype=bool)
+    mean = np.zeros(shape)
+    m2 = np.zeros(shape)
+    dvars = np.zeros(reps)
+    previous = None
+    for (i,chunk) in engine.time_chunks():
+        chunk = np.array(chunk,dtype=float).reshape(shape + (-1,),order='F')
+        n = chunk.shape[3]
+        # DVARS of each time point in the chunk, starting from the last time point of the previous chunk
+        series = chunk[mask]
+        if previous is not None:
+            series = np.hstack((previous,series))
+        diff = np.diff(series,axis=1)
+        dvars[i+n-diff.shape[1]:i+n] = np.sqrt((diff**2).mean(axis=0))
+        previous = series[:,-1:]
+        del series,diff
+        # merge the mean and sum of squared deviations of the chunk into the running ones
+        chunk_mean = chunk.mean(axis=3)
+        delta = chunk_mean - mean
+        mean += delta*(float(n)/(i+n))
+        m2 += delta**2*(float(i)*n/(i+n))
+        chunk -= chunk_mean[...,None]
+        m2 += np.einsum('...t,...t->...',chunk,chunk)
+    stdev = np.sqrt(m2/(reps-1)) if reps>1 else np.zeros(shape)
+    tsnr = np.zeros(shape)
+    np.divide(mean,stdev,out=tsnr,where=stdev>0)
+    for m in [mean,stdev,tsnr]:
+        m[~mask] = 0
+    maps = {'mean':mean,'stdev':stdev,'tsnr':tsnr,'dvars':dvars}
+    if prefix:
+        for name in ['mean','stdev','tsnr']:
+            nib.save(nib.Nifti1Image(maps[name].astype(np.float32),engine.affine),'%s_%s.nii.gz' % (prefix,name))
+        with open('%s_dvars.1D' % prefix,'w') as f:
+            f.write('\n'.join(['%g' % x for x in dvars]) + '\n')
+    return maps
+
 def temporal_snr(signal_dset,noise_dset,mask=None,prefix='temporal_snr.nii.gz'):
     '''Calculates temporal SNR by dividing average signal of ``signal_dset`` by SD of ``noise_dset``.
     ``signal_dset`` should be a dataset that contains the average signal value (i.e., nothing that has
     been detrended by removing the mean), and ``noise_dset`` should be a dataset that has all possible
     known signal fluctuations (e.g., task-related effects) removed from it (the residual dataset from a 
-    deconvolve works well)'''
+    deconvolve works well)
+
+    To get the tSNR of a single dataset (without detrending) in Python, reading the file only once, use
+    :meth:`summary_maps`'''
     for d in [('mean',signal_dset), ('stdev',noise_dset)]:
         new_d = nl.suffix(d[1],'_%s' % d[0])
         cmd = ['3dTstat','-%s' % d[0],'-prefix',new_d]
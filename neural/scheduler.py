@@ -3,30 +3,89 @@
 All of these functions are made on the assumption that all clients' filesystems
 are identical, for example on a shared folder'''
 import zmq
-import json,time
+import json,time,os,threading,itertools,multiprocessing,Queue,atexit
 from datetime import datetime
 import neural as nl
 
 default_port = 8765
 packet_expire = 60.0 # seconds
+heartbeat_interval = 1.0 # seconds between status updates published by each server
+heartbeat_expire = 10.0 # seconds before a server that hasn't sent a heartbeat is considered down
+default_timeout = 10.0 # seconds to wait for a server to answer before reconnecting
 _key = 'scheduler'
 info = None
 
 class Server:
-    def __init__(self,name=None,address='localhost',port=default_port,password=None):
+    '''a job server, which runs commands sent to it on ``workers`` local processes (one per CPU by default)
+
+    Jobs are accepted as soon as they arrive and queued until a worker is free, so a single client can keep all of
+    the workers busy (see :meth:`submit_jobs`). Every :data:`heartbeat_interval` seconds, the server publishes
+    its :meth:`status` on ``heartbeat_port`` (by default, the port after ``port``) for :class:`Scheduler` to use'''
+    def __init__(self,name=None,address='localhost',port=default_port,password=None,workers=None,heartbeat_port=None):
         self.name = name
         self.address = address
         self.port = port
         self.password = password
-    
+        self.workers = workers if workers else multiprocessing.cpu_count()
+        self.heartbeat_port = heartbeat_port if heartbeat_port else port + 1
+        self.jobs = 0   #! number of jobs that have been accepted but not finished
+
+    def status(self):
+        '''returns a dictionary describing this server and how busy it is'''
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            load = None
+        return {
+            'name': self.name,
+            'address': self.address,
+            'port': self.port,
+            'workers': self.workers,
+            'jobs': self.jobs,
+            'free_workers': max(self.workers - self.jobs,0),
+            'queue_depth': max(self.jobs - self.workers,0),
+            'load': load,
+            'free_memory': _free_memory()
+        }
+
     def start_server(self):
+        # Start the workers before zmq, so they don't inherit any of its sockets
+        pool = multiprocessing.Pool(self.workers)
+        finished = Queue.Queue()
         c = zmq.Context()
-        sock = c.socket(zmq.REP)
+        sock = c.socket(zmq.ROUTER)
         sock.bind('tcp://*:%s' % self.port)
-        
+        heartbeat_sock = c.socket(zmq.PUB)
+        heartbeat_sock.bind('tcp://*:%s' % self.heartbeat_port)
+        last_heartbeat = 0
+
+        def job_done(envelope,job_id):
+            def callback(result):
+                # this runs in the pool's result thread, which stops handling every other job if it raises
+                result['id'] = job_id
+                try:
+                    reply = json.dumps(result)
+                except (TypeError,ValueError) as e:
+                    reply = json.dumps({'id':job_id,'error':'could not send the result (%s: %s)' % (type(e).__name__,e)})
+                finished.put((envelope,reply))
+            return callback
+
         try:
             while True:
-                msg = sock.recv()
+                while not finished.empty():
+                    (envelope,reply) = finished.get()
+                    self.jobs -= 1
+                    sock.send_multipart(envelope + [reply])
+                if time.time() - last_heartbeat > heartbeat_interval:
+                    heartbeat_sock.send(json.dumps(dict(self.status().items() + [('key',_key),('time',time.time())])))
+                    last_heartbeat = time.time()
+                if not sock.poll(50):
+                    continue
+                # The last frame is the message, everything before it is the address of the client
+                frames = sock.recv_multipart()
+                envelope = frames[:-1]
+                msg = frames[-1]
+                obj = None
                 try:
                     obj = json.loads(msg)
                     if 'key' not in obj or obj['key']!=_key:
@@ -36,41 +95,96 @@ class Server:
                             raise ValueError
                         if nl.hash_str(self.password + str(obj['time']))!= obj['password']:
                             raise ValueError
-                except ValueError:
+                except (ValueError,TypeError):
                     # not a valid packet
-                    sock.send('ERR')
+                    if isinstance(obj,dict) and 'id' in obj:
+                        sock.send_multipart(envelope + [json.dumps({'id':obj['id'],'error':'invalid packet'})])
+                    else:
+                        sock.send_multipart(envelope + ['ERR'])
                     continue
                 else:
                     if 'task' in obj:
                         if obj['task']=='info':
-                            sock.send(json.dumps({'name':self.name,'address':self.address,'port':self.port}))
+                            sock.send_multipart(envelope + [json.dumps(dict(self.status().items() + [('id',obj.get('id'))]))])
                             continue
-                    
+
                         if obj['task']=='job':
                             print 'Being asked to run command: ' + str(obj['command'])
-                            cmd = [obj['command'],None,'.']
-                            if 'products' in obj:
-                                cmd[1] = obj['products']
-                            if 'working_directory' in obj:
-                                cmd[2] = obj['working_directory']
-                            output = nl.run(*cmd)
-                            sock.send(json.dumps({'output':output.__dict__()}))
+                            self.jobs += 1
+                            pool.apply_async(_run_job,(obj,),callback=job_done(envelope,obj.get('id')))
                             continue
-                
-                    sock.send('OK')
+
+                    sock.send_multipart(envelope + ['OK'])
         except KeyboardInterrupt:
+            pool.terminate()
             c.destroy()
 
-def _send_raw(msg,address='localhost',port=default_port):
-    c = zmq.Context()
-    sock = c.socket(zmq.REQ)
-    sock.connect('tcp://%s:%s' % (address,port))
-    sock.send(msg)
-    return sock.recv()  
+def _free_memory():
+    '''returns the available memory (in bytes) on this machine, or ``None`` if it can't tell'''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError,ValueError):
+        pass
+    return None
+
+def _run_job(obj):
+    '''runs the job described by the packet ``obj`` on one of a :class:`Server`\'s workers'''
+    try:
+        output = nl.utils.run(obj['command'],obj.get('products'),obj.get('working_directory','.'),force_local=True,stderr=obj.get('stderr',True),quiet=obj.get('quiet',False))
+    except Exception as e:
+        return {'error':'%s: %s' % (type(e).__name__,e)}
+    if output and isinstance(output.output,str):
+        # the reply is sent as JSON, which needs valid UTF-8
+        output.output = output.output.decode('utf-8','replace')
+    return {'output':output.__dict__ if output else output}
+
+def _context():
+    '''returns the zmq context for this process (shared by every socket, and recreated after a fork)'''
+    return zmq.Context.instance()
+
+_req_sockets = {}
+_req_sockets_lock = threading.Lock()
+
+def _send_raw(msg,address='localhost',port=default_port,timeout=None,retries=1):
+    '''sends ``msg`` to the server and returns its reply, or ``None`` if it didn't answer within ``timeout`` seconds
+    (by default, :data:`default_timeout`)
+
+    Sockets are kept open and reused for the next message to the same server. A socket that times out is thrown
+    away and the message is sent again on a new connection (up to ``retries`` times)'''
+    if timeout==None:
+        timeout = default_timeout
+    key = (os.getpid(),address,port)
+    for attempt in xrange(retries+1):
+        with _req_sockets_lock:
+            idle = _req_sockets.setdefault(key,[])
+            sock = idle.pop() if idle else None
+        if sock==None:
+            sock = _context().socket(zmq.REQ)
+            sock.setsockopt(zmq.LINGER,0)
+            sock.connect('tcp://%s:%s' % (address,port))
+        sock.send(msg)
+        if sock.poll(timeout*1000):
+            rep = sock.recv()
+            with _req_sockets_lock:
+                _req_sockets[key].append(sock)
+            return rep
+        # A REQ socket can't be used again until it gets a reply, so start over with a new one
+        sock.close(0)
+        nl.notify('Warning: no reply from %s:%s after %g seconds' % (address,port,timeout),level=nl.level.warning)
+    return None
+
+class ServerInfo:
+    '''status of a server, as returned by :meth:`server_info` (see :meth:`Server.status`)'''
+    pass
 
 def server_info(address='localhost',port=default_port):
     info_req = json.dumps({'key':_key,'task':'info'})
     rep = _send_raw(info_req,address,port)
+    if rep==None:
+        return None
     info = ServerInfo()
     try:
         rep_dict = json.loads(rep)
@@ -81,40 +195,264 @@ def server_info(address='localhost',port=default_port):
     return info
 
 class Job:
-    def __init__(self,command=[],products=None,working_directory='.'):
+    def __init__(self,command=[],products=None,working_directory='.',stderr=True,quiet=False):
         self.command = command
         self.working_directory = working_directory
         self.products = products
+        self.stderr = stderr
+        self.quiet = quiet
         self.result = None
 
-def send_job(job,address='localhost',port=default_port,password=None):
-    job_req_dict = dict({'key':_key,'task':'job','time':time.time()}.items() + job.__dict__.items())
-    if password:
-        job_req_dict['password'] = nl.hash_str(password + str(job_req_dict['time']))
-    job_req = json.dumps(job_req_dict)
-    rep = _send_raw(job_req,address,port)
-    try:
-        rep_dict = json.loads(rep)
-        for key in rep_dict:
-            if key=='output':
-                output = nl.utils.RunResult()
+class JobFuture:
+    '''the eventual result of a :class:`Job` submitted with :meth:`submit_jobs`
+
+    :job:       the :class:`Job`, which will have its ``output`` set to the :class:`neural.utils.RunResult`
+                when it finishes
+    :error:     description of what went wrong, if the server couldn\'t run the job
+    '''
+    def __init__(self,job):
+        self.job = job
+        self.error = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        '''returns ``True`` if the job has finished (or failed)'''
+        return self._event.is_set()
+
+    def result(self,timeout=None):
+        '''waits (at most ``timeout`` seconds, if given) for the job to finish, and returns its
+        :class:`neural.utils.RunResult`. Returns ``None`` if it failed or didn\'t finish in time'''
+        if not self._event.wait(timeout) or self.error:
+            return None
+        return self.job.output
+
+    def add_done_callback(self,fn):
+        '''calls ``fn(future)`` when the job finishes (or right away, if it already has)'''
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self,rep_dict):
+        if 'output' in rep_dict:
+            output = rep_dict['output']
+            if output:
+                self.job.output = nl.utils.RunResult()
                 for okey in output:
-                    setattr(output,okey,output[okey])
-                job.output = output
+                    setattr(self.job.output,okey,output[okey])
             else:
-                setattr(job,key,rep_dict[key])
-    except (ValueError,KeyError):
+                self.job.output = output
+        else:
+            self.error = rep_dict.get('error','unknown error')
+            nl.notify('Error: job %s failed on server (%s)' % (self.job.command,self.error),level=nl.level.error)
+        with self._lock:
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+class _Connection:
+    '''a DEALER socket to one server, owned by a background thread that sends the jobs queued with
+    :meth:`submit` and hands the results back to their futures in whatever order they finish
+
+    While jobs are outstanding, the server is pinged every :data:`heartbeat_interval` seconds. If it doesn't
+    answer anything for :data:`default_timeout` seconds, its outstanding jobs are failed and the socket is reconnected'''
+    def __init__(self,address,port,password=None):
+        self.address = address
+        self.port = port
+        self.password = password
+        self.pid = os.getpid()
+        self.outbox = Queue.Queue()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self,job_dict,future):
+        job_dict['id'] = '%d-%d' % (os.getpid(),next(self.ids))
+        self.outbox.put((job_dict,future))
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join(1)
+
+    def _connect(self):
+        sock = _context().socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER,0)
+        sock.connect('tcp://%s:%s' % (self.address,self.port))
+        return sock
+
+    def _ping(self,sock):
+        ping = {'key':_key,'task':'info','id':'ping','time':time.time()}
+        if self.password:
+            ping['password'] = nl.hash_str(self.password + str(ping['time']))
+        sock.send(json.dumps(ping))
+
+    def _fail_pending(self,error):
+        pending = self.pending
+        self.pending = {}
+        for future in pending.values():
+            future._finish({'error':error})
+
+    def _loop(self):
+        sock = self._connect()
+        last_reply = last_ping = time.time()
+        while not self.stopped.is_set():
+            while not self.outbox.empty():
+                (job_dict,future) = self.outbox.get()
+                if not self.pending:
+                    last_reply = last_ping = time.time()
+                self.pending[job_dict['id']] = future
+                sock.send(json.dumps(job_dict))
+            if self.pending:
+                if time.time() - last_reply > default_timeout:
+                    nl.notify('Warning: lost connection to %s:%s, reconnecting' % (self.address,self.port),level=nl.level.warning)
+                    self._fail_pending('lost connection to server')
+                    sock.close(0)
+                    sock = self._connect()
+                    continue
+                if time.time() - last_ping > heartbeat_interval:
+                    self._ping(sock)
+                    last_ping = time.time()
+            if not sock.poll(50):
+                continue
+            rep = sock.recv_multipart()[-1]
+            last_reply = time.time()
+            try:
+                rep_dict = json.loads(rep)
+                future = self.pending.pop(rep_dict['id'])
+            except (ValueError,KeyError,TypeError):
+                continue
+            future._finish(rep_dict)
+        sock.close(0)
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+@atexit.register
+def _close_connections():
+    for connection in _connections.values():
+        if connection.pid==os.getpid():
+            connection.close()
+    for (pid,address,port),socks in _req_sockets.items():
+        if pid==os.getpid():
+            for sock in socks:
+                sock.close(0)
+    if scheduler._listener:
+        scheduler._listener.close()
+    # zmq complains if any sockets are still around while the interpreter shuts down, even closed ones
+    _connections.clear()
+    _req_sockets.clear()
+
+def _connection(address,port,password=None):
+    '''returns the :class:`_Connection` to the server for this process, opening it if needed'''
+    with _connections_lock:
+        connection = _connections.get((address,port))
+        if connection==None or connection.pid!=os.getpid():
+            # Threads don't survive a fork, so child processes need their own connection
+            connection = _Connection(address,port,password)
+            _connections[(address,port)] = connection
+        return connection
+
+def submit_jobs(jobs,address='localhost',port=default_port,password=None):
+    '''sends a list of :class:`Job` objects to the server without waiting for them to finish
+
+    Returns a list of :class:`JobFuture` objects (in the same order as ``jobs``). The server will run as many
+    of the jobs at a time as it has workers'''
+    connection = _connection(address,port,password)
+    futures = []
+    for job in jobs:
+        job_req_dict = dict({'key':_key,'task':'job','time':time.time()}.items() + job.__dict__.items())
+        if password:
+            job_req_dict['password'] = nl.hash_str(password + str(job_req_dict['time']))
+        future = JobFuture(job)
+        connection.submit(job_req_dict,future)
+        futures.append(future)
+    return futures
+
+def send_job(job,address='localhost',port=default_port,password=None):
+    '''sends a single :class:`Job` to the server and waits for it to finish'''
+    future = submit_jobs([job],address,port,password)[0]
+    future.result()
+    if future.error:
         return None
     return job
 
+class _HeartbeatListener:
+    '''background thread that subscribes to the heartbeats of a :class:`Scheduler`'s servers and keeps their
+    ``status`` up to date'''
+    def __init__(self,scheduler):
+        self.scheduler = scheduler
+        self.new_servers = Queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self,server):
+        self.new_servers.put(server)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join(1)
+
+    def _loop(self):
+        poller = zmq.Poller()
+        socks = {}
+        while not self.stopped.is_set():
+            while not self.new_servers.empty():
+                server = self.new_servers.get()
+                sock = zmq.Context.instance().socket(zmq.SUB)
+                sock.setsockopt(zmq.SUBSCRIBE,'')
+                sock.connect('tcp://%s:%s' % (server['address'],server['heartbeat_port']))
+                poller.register(sock,zmq.POLLIN)
+                socks[sock] = server
+            for (sock,event) in poller.poll(100):
+                try:
+                    status = json.loads(sock.recv())
+                    if status.get('key')!=_key:
+                        raise ValueError
+                except (ValueError,AttributeError):
+                    continue
+                with self.scheduler.lock:
+                    server = socks[sock]
+                    server['status'] = status
+                    server['last_heartbeat'] = time.time()
+                    # The heartbeat already counts the jobs we've sent so far
+                    server['placed'] = 0
+        for sock in socks:
+            sock.close(0)
+
 class Scheduler:
-    def __init__(self):
+    '''decides where to run each command, given the servers added with :meth:`add_server`
+
+    :policy:    how to choose between the servers that are available:
+
+                :least_loaded:  (default) the server with the fewest jobs per worker, then the lowest load average
+                :round_robin:   weighted round-robin, where each server gets jobs in proportion to its ``speed``
+                                (or number of workers, if no speed was given)
+                :speed:         the fastest server, ignoring how busy it is
+
+    Except with ``speed``, only servers that are sending heartbeats and have a free worker are used, and if
+    every server is busy, the command is run locally
+    '''
+    def __init__(self,policy='least_loaded'):
         self.servers = [{'address':'local'}]
-    
-    def add_server(self,address,port=default_port,password=None,speed=None,valid_times=None,invalid_times=None):
+        self.policy = policy
+        self.lock = threading.Lock()
+        self._listener = None
+
+    def add_server(self,address,port=default_port,password=None,speed=None,valid_times=None,invalid_times=None,heartbeat_port=None):
         '''
         :address:           remote address of server, or special string ``local`` to
                             run the command locally
+        :heartbeat_port:    port the server publishes its heartbeats on (by default, the port after ``port``)
         :valid_times:       times when this server is available, given as a list
                             of tuples of 2 strings of form "HH:MM" that define the
                             start and end times. Alternatively, a list of 7 lists can
@@ -140,14 +478,25 @@ class Scheduler:
             if t:
                 if not (self._is_list_of_tuples(t) or self._is_list_of_tuples(t,True)):
                     raise ValueError('valid_times and invalid_times must either be lists of strings or lists')
-        self.servers.append({
+        server = {
             'address':address,
             'port':port,
             'password':password,
             'speed':speed,
             'valid_times':valid_times,
-            'invalid_times':invalid_times
-        })
+            'invalid_times':invalid_times,
+            'heartbeat_port':heartbeat_port if heartbeat_port else port + 1,
+            'status':None,          # last heartbeat received from the server
+            'last_heartbeat':0,
+            'placed':0,             # jobs sent to the server since its last heartbeat
+            'rr_current':0          # state of the weighted round-robin
+        }
+        with self.lock:
+            self.servers.append(server)
+        if address!='local':
+            if self._listener==None:
+                self._listener = _HeartbeatListener(self)
+            self._listener.watch(server)
     
     def _is_list_of_tuples(self,l,is_list=False):
         if not isinstance(l,list):
@@ -178,47 +527,129 @@ class Scheduler:
             return True
         return False
     
+    def _is_available(self,server,now):
+        '''returns whether ``server`` can be used at the time ``now``, according to its ``valid_times`` and ``invalid_times``'''
+        valid = True
+        if 'valid_times' in server and server['valid_times']:
+            times = server['valid_times']
+            if self._is_list_of_tuples(times,is_list=True):
+                wday = (now.weekday() + 1) % 7  # Make Sunday==0
+                times = server['valid_times'][wday]
+            valid = False
+            for t in times:
+                if self._time_is_inbetween(now,t):
+                    valid = True
+                    break
+        if 'invalid_times' in server and server['invalid_times']:
+            times = server['invalid_times']
+            if self._is_list_of_tuples(times,is_list=True):
+                wday = (now.weekday() + 1) % 7  # Make Sunday==0
+                times = server['invalid_times'][wday]
+            for t in times:
+                if self._time_is_inbetween(now,t):
+                    valid = False
+                    break
+        return valid
+
+    def _free_workers(self,server):
+        '''returns how many more jobs ``server`` can start right now, based on its last heartbeat
+        (or ``None`` if it hasn't sent one recently)'''
+        status = server.get('status')
+        if not status or time.time() - server['last_heartbeat'] > heartbeat_expire:
+            return None
+        return status['workers'] - status['jobs'] - server['placed']
+
     def choose_server(self):
-        valid_servers = []
         now = datetime.now()
-        for server in self.servers:
-            valid = True
-            if 'valid_times' in server and server['valid_times']:
-                times = server['valid_times']
-                if self._is_list_of_tuples(times,is_list=True):
-                    wday = (now.weekday() + 1) % 7  # Make Sunday==0
-                    times = server['valid_times'][wday]
-                valid = False
-                for t in times:
-                    if self._time_is_inbetween(now,t):
-                        valid = True
-                        break
-            if 'invalid_times' in server and server['invalid_times']:
-                times = server['invalid_times']
-                if self._is_list_of_tuples(times,is_list=True):
-                    wday = (now.weekday() + 1) % 7  # Make Sunday==0
-                    times = server['valid_times'][wday]
-                for t in times:
-                    if self._time_is_inbetween(now,t):
-                        valid = False
-                        break
-            if valid:
-                valid_servers.append(server)
-        sorted_servers = sorted(valid_servers,key=lambda x: x['speed'] if 'speed' in x and x['speed'] else 0)
-        return sorted_servers[-1]
+        with self.lock:
+            valid_servers = [x for x in self.servers if self._is_available(x,now)]
+            if self.policy=='speed':
+                sorted_servers = sorted(valid_servers,key=lambda x: x['speed'] if 'speed' in x and x['speed'] else 0)
+                return sorted_servers[-1]
+            local = [x for x in valid_servers if x['address']=='local']
+            remote = [x for x in valid_servers if x['address']!='local' and self._free_workers(x)>0]
+            if len(remote)==0:
+                # Every server is busy (or down), so run it here
+                return local[0] if local else {'address':'local'}
+            if self.policy=='round_robin':
+                # Smooth weighted round-robin (each server gets its share of jobs, but spread out)
+                weights = [x['speed'] if x['speed'] else x['status']['workers'] for x in remote]
+                for (x,weight) in zip(remote,weights):
+                    x['rr_current'] += weight
+                server = max(remote,key=lambda x: x['rr_current'])
+                server['rr_current'] -= sum(weights)
+            else:
+                def load(x):
+                    workers = float(x['status']['workers'])
+                    return (
+                        (x['status']['jobs'] + x['placed']) / workers,
+                        x['status']['load'] / workers if x['status']['load']!=None else 0,
+                        -(x['status']['free_memory'] or 0)
+                    )
+                server = min(remote,key=load)
+            server['placed'] += 1
+            return server
 
 scheduler = Scheduler()
 
-def _new_run(command,products=None,working_directory='.',force_local=False):
+def _cache_lookup(job,cache):
+    '''looks up a :class:`Job` that is going to a server in :data:`neural.utils.run_cache` (if ``cache`` is ``True``,
+    or ``None`` and the cache is enabled). Returns a tuple of the key to store its products under once it has run
+    (or ``None``) and the :class:`neural.utils.RunResult` with the products restored from the cache (or ``None``)'''
+    if cache==None:
+        cache = nl.utils.run_cache.enabled
+    if not cache or not job.products:
+        return (None,None)
+    products = [job.products] if isinstance(job.products,basestring) else job.products
+    with nl.run_in(job.working_directory):
+        if all([os.path.exists(x) for x in products]):
+            return (None,None)
+        return nl.utils.run_cache.lookup([str(x) for x in nl.flatten(job.command)],products,job.quiet!=False)
+
+def _cache_store(key,job):
+    '''stores the products of a :class:`Job` that was run on a server under ``key``, if it finished successfully'''
+    output = getattr(job,'output',None)
+    if key and output and output.return_code==0:
+        with nl.run_in(job.working_directory):
+            nl.utils.run_cache.store(key,[job.products] if isinstance(job.products,basestring) else job.products,output.output)
+
+def submit(command,products=None,working_directory='.',force_local=False,stderr=True,quiet=False,cache=None):
+    '''same as :meth:`neural.utils.run`, but returns a :class:`JobFuture` right away instead of waiting for
+    the command to finish. Commands that the scheduler places on the local machine are run before returning'''
+    server = scheduler.choose_server()
+    job = Job(command,products,working_directory,stderr,quiet)
+    if force_local or server['address']=='local':
+        output = nl.utils.run(command,products,working_directory,force_local,stderr,quiet,cache)
+        future = JobFuture(job)
+        future._finish({'output':output.__dict__ if output else output})
+        return future
+    (cache_key,result) = _cache_lookup(job,cache)
+    if result:
+        future = JobFuture(job)
+        future._finish({'output':result.__dict__})
+        return future
+    future = submit_jobs([job],server['address'],server['port'],server.get('password'))[0]
+    if cache_key:
+        future.add_done_callback(lambda f: _cache_store(cache_key,f.job))
+    return future
+
+def _new_run(command,products=None,working_directory='.',force_local=False,stderr=True,quiet=False,cache=None):
     server = scheduler.choose_server()
     if force_local or server['address']=='local':
-        return nl.utils.run(command,products,working_directory,force_local)
+        return nl.utils.run(command,products,working_directory,force_local,stderr,quiet,cache)
     else:
-        job = Job(command,products,working_directory)
+        job = Job(command,products,working_directory,stderr,quiet)
+        (cache_key,result) = _cache_lookup(job,cache)
+        if result:
+            return result
         if 'password' in server:
             job_return = send_job(job,server['address'],server['port'],server['password'])
         else:
             job_return = send_job(job,server['address'],server['port'])
+        if job_return==None:
+            nl.notify('Warning: job failed on %s, running it locally instead' % server['address'],level=nl.level.warning)
+            return nl.utils.run(command,products,working_directory,force_local,stderr,quiet,cache)
+        _cache_store(cache_key,job_return)
         return job_return.output
 
 nl.run = _new_run
\ No newline at end of file
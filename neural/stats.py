@@ -1,7 +1,9 @@
 '''calculate statistics off of datasets'''
 import neural as nl
-import subprocess
-import nibabel as nib
+import os,re,subprocess,collections,threading
+from neural.lazy import lazy_import
+nib = lazy_import('nibabel',globals())
+np = lazy_import('numpy',globals())
 
 def max(dset):
     '''max value of dataset
@@ -10,7 +12,250 @@ def max(dset):
     this from `dset_info`'''
     return nib.load(dset).get_data().max()
 
-def voxel_count(dset,p=None,positive_only=False,mask=None,ROI=None):
+def _native_file(dset):
+    '''returns the file to read ``dset`` from in Python, or ``None`` if it has to go through AFNI (e.g., it has
+    a subbrick selector, or isn't a NIfTI or AFNI dataset)'''
+    dset = str(dset)
+    if re.search(r'[\[\]<>{}]',dset):
+        return None
+    return nl.dsets._header_file(dset)
+
+def _resample_nn(data,affine,shape,target_affine):
+    '''nearest-neighbour resampling of the 3D array ``data`` (with ``affine``) onto the grid with ``shape`` and
+    ``target_affine``. Returns the resampled values flattened in file order, with 0 outside of ``data``'''
+    transform = np.linalg.solve(affine,target_affine)
+    ijk = np.indices(shape).reshape(3,-1)
+    src = np.rint(transform[:3,:3].dot(ijk) + transform[:3,3:]).astype(int)
+    inside = np.all([(src[d]>=0) & (src[d]<data.shape[d]) for d in xrange(3)],axis=0)
+    out = np.zeros(ijk.shape[1],dtype=data.dtype)
+    out[inside] = data[src[0,inside],src[1,inside],src[2,inside]]
+    return out.reshape(shape).reshape(-1,order='F')
+
+def _group_stats(groups,values,num_groups):
+    '''calculates the statistics of :meth:`ROIStats.roi_stats` for each group at once
+
+    ``values`` must be sorted by group and then by value, and ``groups`` is the (0-based) group of each value.
+    Returns a ``dict`` of arrays with one value per group (0 for empty groups)'''
+    counts = np.bincount(groups,minlength=num_groups).astype(float)
+    sums = np.bincount(groups,values,minlength=num_groups)
+    sumsq = np.bincount(groups,values*values,minlength=num_groups)
+    found = counts>0
+    stats = dict([(x,np.zeros(num_groups)) for x in ['mean','sigma','min','max','median','mode']])
+    stats['count'] = counts
+    stats['sum'] = sums
+    stats['mean'][found] = sums[found]/counts[found]
+    several = counts>1
+    stats['sigma'][several] = np.sqrt(np.maximum(sumsq[several] - sums[several]**2/counts[several],0)/(counts[several]-1))
+    if len(values)==0:
+        return stats
+    starts = np.concatenate(([0],np.cumsum(counts)[:-1])).astype(int)[found]
+    ends = starts + counts[found].astype(int) - 1
+    stats['min'][found] = values[starts]
+    stats['max'][found] = values[ends]
+    stats['median'][found] = (values[(starts+ends)//2] + values[(starts+ends+1)//2])/2.
+    # mode: the longest run of the same value in each group (the smallest value, if there's a tie)
+    run_starts = np.flatnonzero(np.concatenate(([True],(np.diff(values)!=0) | (np.diff(groups)!=0))))
+    run_lengths = np.diff(np.concatenate((run_starts,[len(values)])))
+    order = np.lexsort((values[run_starts],-run_lengths,groups[run_starts]))
+    (run_groups,first) = np.unique(groups[run_starts][order],return_index=True)
+    stats['mode'][run_groups] = values[run_starts][order][first]
+    return stats
+
+class ROIStats(object):
+    '''calculates statistics of a dataset within every ROI of a mask, without calling any external programs
+
+    Only the header of the dataset is read when it's created. The data is read from the file when it's needed, one
+    subbrick (or one block of ``chunk_size`` subbricks) at a time, so a long run is never all in memory at once and
+    the object itself only keeps the header and the masks it has used. Each statistic is calculated for all of the
+    ROIs at the same time. Masks on a different grid than the dataset are resampled to the grid of the dataset using
+    nearest-neighbour interpolation (and the resampled mask is kept for the next time)::
+
+        stats = nl.stats.ROIStats('subj1_stats.nii.gz')
+        for roi,values in stats.roi_stats('atlas.nii.gz').items():
+            print roi, values['mean']
+
+    :meth:`voxel_count`, :meth:`mask_average`, :meth:`sphere_average` and :meth:`neural.roi_stats` use this
+    (and reuse the objects for recently used datasets) when they're called with ``native=True``
+
+    Raises a ``ValueError`` if ``dset`` can't be read directly'''
+    def __init__(self,dset,chunk_size=16):
+        self.dset = dset
+        self.filename = _native_file(dset)
+        if self.filename==None:
+            raise ValueError('cannot read %s directly' % dset)
+        image = nib.load(self.filename)
+        extra = [i for i in xrange(3,len(image.shape)) if image.shape[i]>1]
+        if len(image.shape)<3 or len(extra)>1:
+            raise ValueError('cannot read %s directly (it has dimensions %s)' % (dset,image.shape))
+        #! the axis of the subbricks in the file (AFNI writes NIfTI buckets with them along the 5th), or ``None`` if there's only one
+        self.axis = extra[0] if extra else None
+        #! the dimensions of a subbrick
+        self.shape = tuple(image.shape[:3])
+        self.reps = image.shape[self.axis] if self.axis else 1
+        self.affine = image.affine
+        self.chunk_size = chunk_size
+        self._labels = {}
+
+    def _read(self,image,bricks):
+        '''reads the subbricks in the slice ``bricks`` from ``image`` as a (voxels x subbricks) array, in file order'''
+        index = [slice(None)]*3 + [0]*(len(image.shape)-3)
+        if self.axis:
+            index[self.axis] = bricks
+            data = np.asarray(image.dataobj[tuple(index)])
+        else:
+            data = np.asarray(image.dataobj[tuple(index)])[...,None][...,bricks]
+        return data.reshape((-1,data.shape[3]),order='F')
+
+    def _image(self):
+        '''opens the dataset, keeping the file open so reading the subbricks in order doesn't decompress a
+        compressed file from the start for every one'''
+        return nib.load(self.filename,keep_file_open=True)
+
+    def brick(self,i):
+        '''returns the values of subbrick ``i`` (counting from the end if negative) flattened in file order'''
+        if i<0:
+            i += self.reps
+        return np.asarray(self._read(self._image(),slice(i,i+1))[:,0],dtype=float)
+
+    def time_chunks(self,chunk_size=None):
+        '''yields the index of the first subbrick and a (voxels x subbricks) array, in file order, for each block
+        of ``chunk_size`` subbricks (by default, the one the object was created with), reading the file once from
+        start to end (uncompressed datasets are memory-mapped, and compressed ones are decompressed in a single pass)'''
+        image = self._image()
+        chunk_size = chunk_size or self.chunk_size
+        for i in xrange(0,self.reps,chunk_size):
+            yield (i,self._read(image,slice(i,i+chunk_size)))
+
+    def series(self,voxels):
+        '''returns a (voxels x subbricks) array with the time series of the voxels with the indices (in file order)
+        ``voxels``, reading the dataset a block of subbricks at a time'''
+        out = np.empty((len(voxels),self.reps))
+        for (i,chunk) in self.time_chunks():
+            out[:,i:i+chunk.shape[1]] = chunk[voxels]
+        return out
+
+    def matrix(self):
+        '''reads the whole dataset as a (voxels x subbricks) array. It isn't kept, and :meth:`time_chunks` and
+        :meth:`series` only need part of it in memory at once'''
+        return self._read(self._image(),slice(None))
+
+    def labels(self,mask):
+        '''returns the ROI value of each voxel of the dataset (flattened in file order) from the dataset ``mask``,
+        resampling it if it's on a different grid'''
+        filename = _native_file(mask)
+        if filename==None:
+            raise ValueError('cannot read %s directly' % mask)
+        s = os.stat(filename)
+        key = (os.path.abspath(filename),s.st_size,s.st_mtime)
+        if key not in self._labels:
+            image = nib.load(filename)
+            data = np.asarray(image.get_data())
+            data = np.rint(data.reshape(data.shape[:3] + (-1,),order='F')[...,0]).astype(int)
+            if data.shape==self.shape and np.allclose(image.affine,self.affine,atol=1e-3):
+                self._labels[key] = data.reshape(-1,order='F')
+            else:
+                self._labels[key] = _resample_nn(data,image.affine,self.shape,self.affine)
+        return self._labels[key]
+
+    def roi_stats(self,mask,brick=-1):
+        '''returns a ``dict`` with the statistics of subbrick ``brick`` in each ROI of ``mask``, with the same
+        structure (and keys) as :meth:`neural.roi_stats`'''
+        labels = self.labels(mask)
+        voxels = np.flatnonzero(labels>0)
+        (labels,values) = (labels[voxels],self.brick(brick)[voxels])
+        order = np.lexsort((values,labels))
+        (rois,groups) = np.unique(labels[order],return_inverse=True)
+        values = values[order]
+        stats = _group_stats(groups,values,len(rois))
+        nonzero = values!=0
+        nz_stats = _group_stats(groups[nonzero],values[nonzero],len(rois))
+        out_dict = {}
+        for i in xrange(len(rois)):
+            out_dict[int(rois[i])] = {
+                'mean': stats['mean'][i], 'median': stats['median'][i], 'mode': stats['mode'][i],
+                'min': stats['min'][i], 'max': stats['max'][i], 'sigma': stats['sigma'][i], 'sum': stats['sum'][i],
+                'nzmean': nz_stats['mean'][i], 'nzmedian': nz_stats['median'][i], 'nzmode': nz_stats['mode'][i],
+                'nzmin': nz_stats['min'][i], 'nzmax': nz_stats['max'][i], 'nzsigma': nz_stats['sigma'][i],
+                'nzsum': nz_stats['sum'][i], 'nzvoxels': nz_stats['count'][i]
+            }
+        return out_dict
+
+    def voxel_count(self,mask=None,brick=0):
+        '''returns the number of non-zero voxels in subbrick ``brick``, or if a ``mask`` is given, a ``dict`` with
+        the number in each ROI'''
+        nonzero = self.brick(brick)!=0
+        if mask==None:
+            return int(np.count_nonzero(nonzero))
+        labels = self.labels(mask)
+        labels = labels[(labels>0) & nonzero]
+        counts = np.bincount(labels)
+        return dict([(int(r),int(counts[r])) for r in np.flatnonzero(counts)])
+
+    def mask_average(self,mask,brick=-1):
+        '''returns the average of subbrick ``brick`` within the non-zero voxels of ``mask``'''
+        voxels = self.labels(mask)!=0
+        if not voxels.any():
+            return None
+        return float(self.brick(brick)[voxels].mean())
+
+    def sphere_voxels(self,x,y,z,radius=1):
+        '''returns the indices (in file order) of the voxels within ``radius`` mm of the coordinate ``(x,y,z)`` (in RAI order)'''
+        center = np.linalg.solve(self.affine,[-x,-y,z,1])[:3]
+        size = np.sqrt((self.affine[:3,:3]**2).sum(axis=0))
+        low = np.maximum(np.floor(center - radius/size),0).astype(int)
+        high = np.minimum(np.ceil(center + radius/size),np.array(self.shape)-1).astype(int)
+        if (high<low).any():
+            return np.array([],dtype=int)
+        ijk = np.indices(high-low+1).reshape(3,-1) + low[:,None]
+        distance = np.sqrt(((self.affine[:3,:3].dot(ijk - center[:,None]))**2).sum(axis=0))
+        return np.ravel_multi_index(ijk[:,distance<=radius],self.shape,order='F')
+
+    def sphere_average(self,x,y,z,radius=1):
+        '''returns a list of the averages of each subbrick within ``radius`` mm of the coordinate ``(x,y,z)`` (in RAI order)'''
+        voxels = self.sphere_voxels(x,y,z,radius)
+        if len(voxels)==0:
+            return []
+        return [float(a) for a in self.series(voxels).mean(axis=0)]
+
+#! :class:`ROIStats` objects of the most recently used datasets (by filename, size and modification time), which
+#! only hold their headers and resampled masks
+_roi_cache = collections.OrderedDict()
+_roi_cache_size = 8
+_roi_cache_lock = threading.Lock()
+
+def roi_engine(dset,masks=[],native=None):
+    '''returns a :class:`ROIStats` for ``dset`` (reusing a recent one, if the dataset hasn't changed), or ``None``
+    if the statistics should be calculated with AFNI instead
+
+    :masks:     other datasets that will be used with it, which also need to be readable directly
+    :native:    if ``None``, use Python when all of the datasets can be read directly; ``True`` always uses
+                Python (and prints an error if it can't) and ``False`` never does
+    '''
+    if native==False:
+        return None
+    filename = _native_file(dset)
+    if filename==None or any([_native_file(x)==None for x in masks]):
+        if native:
+            nl.notify('Error: cannot read %s directly' % ', '.join([str(x) for x in [dset] + list(masks) if _native_file(x)==None]),level=nl.level.error)
+        return None
+    s = os.stat(filename)
+    key = (os.path.abspath(filename),s.st_size,s.st_mtime)
+    with _roi_cache_lock:
+        if key in _roi_cache:
+            engine = _roi_cache.pop(key)
+        else:
+            try:
+                engine = ROIStats(filename)
+            except ValueError as e:
+                if native:
+                    nl.notify('Error: %s' % e,level=nl.level.error)
+                return None
+        _roi_cache[key] = engine
+        while len(_roi_cache)>_roi_cache_size:
+            _roi_cache.popitem(last=False)
+    return engine
+
+def voxel_count(dset,p=None,positive_only=False,mask=None,ROI=None,native=False):
     ''' returns the number of non-zero voxels
 
     :p:             threshold the dataset at the given *p*-value, then count
@@ -19,6 +264,9 @@ def voxel_count(dset,p=None,positive_only=False,mask=None,ROI=None):
     :ROI:           only use the ROI with the given value (or list of values) within the mask
                     if ROI is 'all' then return the voxel count of each ROI
                     as a dictionary
+    :native:        ``True`` counts in Python instead of with AFNI, and ``None`` counts in Python when the
+                    datasets can be read directly (see :meth:`roi_engine`). In Python, a ``mask`` on a different
+                    grid is resampled with nearest-neighbour interpolation (``3dROIstats`` requires the same grid)
     '''
     if p:
         dset = nl.thresh(dset,p,positive_only)
@@ -27,16 +275,24 @@ def voxel_count(dset,p=None,positive_only=False,mask=None,ROI=None):
             dset = nl.calc(dset,'step(a)')
 
     count = 0
-    devnull = open(os.devnull,"w")
+    count_dict = None
+    engine = roi_engine(dset,[mask] if mask else [],native)
+    if engine==None and native:
+        return None
     if mask:
-        cmd = ['3dROIstats','-1Dformat','-nomeanout','-nobriklab', '-nzvoxels']
-        cmd += ['-mask',str(mask),str(dset)]
-        out = subprocess.check_output(cmd,stderr=devnull).split('\n')
-        if len(out)<4:
-            return 0
-        rois = [int(x.replace('NZcount_','')) for x in out[1].strip()[1:].split()]
-        counts = [int(x.replace('NZcount_','')) for x in out[3].strip().split()]
-        count_dict = None
+        if engine:
+            roi_counts = engine.voxel_count(mask)
+            rois = sorted(roi_counts.keys())
+            counts = [roi_counts[r] for r in rois]
+        else:
+            devnull = open(os.devnull,"w")
+            cmd = ['3dROIstats','-1Dformat','-nomeanout','-nobriklab', '-nzvoxels']
+            cmd += ['-mask',str(mask),str(dset)]
+            out = subprocess.check_output(cmd,stderr=devnull).split('\n')
+            if len(out)<4:
+                return 0
+            rois = [int(x.replace('NZcount_','')) for x in out[1].strip()[1:].split()]
+            counts = [int(x.replace('NZcount_','')) for x in out[3].strip().split()]
         if ROI==None:
             ROI = rois
         if ROI=='all':
@@ -53,23 +309,45 @@ def voxel_count(dset,p=None,positive_only=False,mask=None,ROI=None):
                 else:
                     count += roi_count
     else:
-        cmd = ['3dBrickStat', '-slow', '-count', '-non-zero', str(dset)]
-        count = int(subprocess.check_output(cmd,stderr=devnull).strip())
+        if engine:
+            count = engine.voxel_count()
+        else:
+            devnull = open(os.devnull,"w")
+            cmd = ['3dBrickStat', '-slow', '-count', '-non-zero', str(dset)]
+            count = int(subprocess.check_output(cmd,stderr=devnull).strip())
     if count_dict:
         return count_dict
     return count
 
-def mask_average(dset,mask):
-    '''Returns average of voxels in ``dset`` within non-zero voxels of ``mask``'''
+def mask_average(dset,mask,native=False):
+    '''Returns average of voxels in ``dset`` within non-zero voxels of ``mask``
+
+    If ``native`` is ``True``, it's calculated in Python instead of with ``3dmaskave`` (or if it's ``None``, in
+    Python when both datasets can be read directly; see :meth:`roi_engine`). In Python, a ``mask`` on a different
+    grid is resampled with nearest-neighbour interpolation, while ``3dmaskave`` requires the same grid'''
+    engine = roi_engine(dset,[mask],native)
+    if engine:
+        return engine.mask_average(mask)
+    if native:
+        return None
     o = nl.run(['3dmaskave','-q','-mask',mask,dset])
     if o:
         return float(o.output.split()[-1])
 
-def sphere_average(dset,x,y,z,radius=1):
-    '''returns a list of average values (one for each subbrick/time point) within the coordinate ``(x,y,z)`` (in RAI order) using a sphere of radius ``radius`` in ``dset``'''
+def sphere_average(dset,x,y,z,radius=1,native=False):
+    '''returns a list of average values (one for each subbrick/time point) within the coordinate ``(x,y,z)`` (in RAI order) using a sphere of radius ``radius`` in ``dset``
+
+    If ``native`` is ``True``, it's calculated in Python instead of with ``3dmaskave -dball`` (or if it's ``None``,
+    in Python when the datasets can be read directly; see :meth:`roi_engine`)'''
     return_list = []
     if isinstance(dset,basestring):
         dset = [dset]
     for d in dset:
-        return_list += [float(a) for a in subprocess.check_output(['3dmaskave','-q','-dball',str(x),str(y),str(z),str(radius),d],stderr=subprocess.PIPE).split()]
+        engine = roi_engine(d,native=native)
+        if engine:
+            return_list += engine.sphere_average(x,y,z,radius)
+        elif native:
+            return None
+        else:
+            return_list += [float(a) for a in subprocess.check_output(['3dmaskave','-q','-dball',str(x),str(y),str(z),str(radius),d],stderr=subprocess.PIPE).split()]
     return return_list
@@ -0,0 +1,71 @@
+'''checks PyPI for a newer version of neural
+
+The check is off by default. Setting the environment variable ``NEURAL_CHECK_UPDATES=1`` runs it in the
+background every time neural is imported, or it can be run by hand with :meth:`check_for_update`. The answer
+from PyPI is saved in :data:`cache_file`, so PyPI is asked at most once every :data:`cache_hours` hours'''
+import neural as nl
+import os,json,time,threading,urllib2
+from distutils.version import LooseVersion
+
+#! URL of the PyPI JSON API for this package
+pypi_url = 'https://pypi.org/pypi/neural-fmri/json'
+#! file where the latest version found is saved
+cache_file = os.path.expanduser('~/.neural_update_check')
+#! how long (in hours) the saved answer is used before asking PyPI again
+cache_hours = 24.0
+#! seconds to wait for PyPI before giving up
+timeout = 5.0
+
+def _cached_version():
+    '''returns the latest version saved in :data:`cache_file`, or ``None`` if there isn't one from the last :data:`cache_hours`'''
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if time.time() - cached['time'] < cache_hours*3600:
+            return cached['latest']
+    except (IOError,OSError,ValueError,KeyError,TypeError):
+        pass
+    return None
+
+def latest_version():
+    '''asks PyPI for the latest released version of neural, and saves it in :data:`cache_file`. Returns ``None``
+    if PyPI can't be reached within :data:`timeout` seconds'''
+    try:
+        latest = json.load(urllib2.urlopen(pypi_url,timeout=timeout))['info']['version']
+    except Exception:
+        return None
+    try:
+        with open(cache_file,'w') as f:
+            json.dump({'time':time.time(),'latest':latest},f)
+    except (IOError,OSError):
+        pass
+    return latest
+
+def _check(force):
+    latest = None if force else _cached_version()
+    if latest==None:
+        latest = latest_version()
+    if latest and LooseVersion(str(latest)) > LooseVersion(nl.version):
+        nl.notify('## Update to neural available on PyPI (current version: %s; latest version: %s)' % (nl.version,latest),level=nl.level.debug)
+    return latest
+
+def _check_in_background(force):
+    try:
+        _check(force)
+    except Exception:
+        # Most likely Python is shutting down under the thread, which isn't worth a traceback
+        pass
+
+def check_for_update(block=True,force=False):
+    '''prints a message if there is a newer version of neural on PyPI
+
+    :block:     if ``False``, runs the check in a background (daemon) thread and returns the thread right away,
+                otherwise returns the latest version (or ``None`` if PyPI couldn't be reached)
+    :force:     ask PyPI even if there is a recent answer in :data:`cache_file`
+    '''
+    if block:
+        return _check(force)
+    thread = threading.Thread(target=_check_in_background,args=(force,))
+    thread.daemon = True
+    thread.start()
+    return thread
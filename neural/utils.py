@@ -1,14 +1,20 @@
 ''' This module contains generic helper functions, not related to imaging specifically'''
 import neural as nl
-import os,subprocess
+import os,subprocess,sys,errno
 import datetime,random,string
 import hashlib
 import zlib, base64
-import tempfile,shutil,re,glob,time,random
-import chardet
+import tempfile,shutil,re,glob,time,random,zipfile,tarfile
+from neural.lazy import lazy_import
+chardet = lazy_import('chardet',globals())
 from threading import Thread,Event
 import json,time,re
-import numpy as np
+import multiprocessing,multiprocessing.pool,threading,collections
+np = lazy_import('numpy',globals())
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 
 #! A list of archives this library understands
@@ -42,6 +48,34 @@ def unarchive(filename,output_dir='.'):
             return subprocess.call(archive_formats[archive]['command'](output_dir,filename))==0
     return False
 
+def archive_members(filename):
+    '''iterates through the files in a zip or tar archive without extracting it to disk
+
+    Yields a tuple of ``(name,file object)`` for each regular file, in the order they are stored. Tarballs
+    are read as a stream, so each file object has to be read before moving on to the next one. Returns ``None``
+    if the archive isn't a format that can be read this way (e.g., 7zip)'''
+    if filename.endswith(archive_formats['zip']['suffix']):
+        return _zip_members(filename)
+    if filename.endswith(archive_formats['tarball']['suffix'] + archive_formats['tarball-bzip']['suffix']):
+        return _tar_members(filename)
+    return None
+
+def _zip_members(filename):
+    with zipfile.ZipFile(filename) as z:
+        for member in z.infolist():
+            if not member.filename.endswith('/'):
+                f = z.open(member)
+                try:
+                    yield (member.filename,f)
+                finally:
+                    f.close()
+
+def _tar_members(filename):
+    with tarfile.open(filename,'r|*') as t:
+        for member in t:
+            if member.isfile():
+                yield (member.name,t.extractfile(member))
+
 def flatten(nested_list):
     '''converts a list-of-lists to a single flat list'''
     return_list = []
@@ -99,7 +133,154 @@ class RunResult:
     def __str__(self):
         return self.output_filename
 
-def run(command,products=None,working_directory='.',force_local=False,stderr=True,quiet=False):
+class RunCache(object):
+    '''content-addressed store of the products of commands run with :meth:`run`
+
+    When enabled, a command is looked up by its arguments, the contents (or modification times) of every
+    existing file named in its arguments, and the version of the program (identified by its path, size and
+    modification time). If the same command has already been run on the same inputs, its products are restored
+    by hardlinking them from the store instead of running it again (even in a different directory).
+
+    Only commands with ``products`` that finish successfully are stored. Products are hardlinked into the store,
+    so a product that is later modified in place is detected (by its size and modification time) and not reused,
+    and a stored file is checked against its hash before another command's identical product is linked to it.
+
+    :directory:     where the store is kept
+    :enabled:       set to ``True`` to use the cache for every call to :meth:`run` (it can also be turned
+                    on or off for a single call with the ``cache`` argument)
+    :hash_inputs:   ``content`` (default) to identify input files by their MD5 hash, or ``mtime`` to use
+                    their size and modification time (faster, but only matches the same files)
+    :max_hashes:    number of recently used input file hashes to remember, so unchanged files aren't hashed again
+    '''
+    def __init__(self,directory=None,enabled=False,hash_inputs='content',max_hashes=1024):
+        self.directory = directory if directory else os.path.join(os.path.expanduser('~'),'.neural_run_cache')
+        self.enabled = enabled
+        self.hash_inputs = hash_inputs
+        self.hits = 0
+        self.misses = 0
+        self.max_hashes = max_hashes
+        self._file_hashes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _file_id(self,filename):
+        stat = os.stat(filename)
+        if self.hash_inputs=='mtime':
+            return '%d-%f' % (stat.st_size,stat.st_mtime)
+        key = (os.path.abspath(filename),stat.st_size,stat.st_mtime,stat.st_ino)
+        with self._lock:
+            file_hash = self._file_hashes.pop(key,None)
+        if file_hash==None:
+            file_hash = _hash_file_part((filename,'md5',None))[1]
+        with self._lock:
+            self._file_hashes[key] = file_hash
+            while len(self._file_hashes)>self.max_hashes:
+                self._file_hashes.popitem(last=False)
+        return file_hash
+
+    def _dset_files(self,filename):
+        '''returns the list of files that make up the dataset ``filename`` (which may be an AFNI prefix)'''
+        filename = re.sub(r'(\[.*\]|<.*>|\{.*\})+$','',filename)
+        if os.path.isfile(filename):
+            return [filename]
+        files = []
+        for suffix in ['.HEAD','.BRIK*','+*.HEAD','+*.BRIK*']:
+            files += glob.glob(filename + suffix)
+        return sorted([x for x in files if os.path.isfile(x)])
+
+    def key(self,command,products):
+        '''returns the key for running ``command`` (in the current directory), or ``None`` if it can\'t be cached'''
+        program = which(command[0])
+        if program==None:
+            return None
+        program = os.path.realpath(program)
+        program_stat = os.stat(program)
+        key = [program,program_stat.st_size,program_stat.st_mtime,command,sorted(products)]
+        for arg in command:
+            for f in self._dset_files(arg) if arg not in products else []:
+                key.append((f,self._file_id(f)))
+        return hash_str(json.dumps(key))
+
+    def _entry_file(self,key):
+        return os.path.join(self.directory,'results',key[:2],key + '.json')
+
+    def _object_file(self,object_hash):
+        return os.path.join(self.directory,'objects',object_hash[:2],object_hash)
+
+    def lookup(self,command,products,quiet=False):
+        '''returns a tuple of the key for running ``command`` (in the current directory), or ``None`` if it can\'t be
+        cached, and the :class:`RunResult` with its products restored from the store (or ``None`` if they aren\'t
+        there). Counts the hit or miss'''
+        key = self.key(command,products)
+        if key==None:
+            return (None,None)
+        result = self.restore(key)
+        if result:
+            self.hits += 1
+            nl.notify('Restored products of %s from cache' % command[0],level=nl.level.debug,quiet=quiet)
+            result.output_filename = products[0]
+        else:
+            self.misses += 1
+        return (key,result)
+
+    def restore(self,key):
+        '''restores the products stored for ``key``, returning the :class:`RunResult` (or ``None`` if not found)'''
+        try:
+            with open(self._entry_file(key)) as f:
+                entry = json.load(f)
+            for (filename,object_hash,size,mtime) in entry['files']:
+                stat = os.stat(self._object_file(object_hash))
+                if stat.st_size!=size or stat.st_mtime!=mtime:
+                    # The stored file has been changed since (probably by modifying a product in place)
+                    os.remove(self._entry_file(key))
+                    return None
+        except (IOError,OSError,ValueError,KeyError):
+            return None
+        for (filename,object_hash,size,mtime) in entry['files']:
+            if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            if os.path.exists(filename):
+                os.remove(filename)
+            try:
+                os.link(self._object_file(object_hash),filename)
+            except OSError:
+                # Probably on a different filesystem
+                shutil.copy2(self._object_file(object_hash),filename)
+        return RunResult(entry['output'],0)
+
+    def store(self,key,products,output):
+        '''stores the files that make up ``products`` under ``key``'''
+        files = []
+        for product in products:
+            product_files = self._dset_files(product)
+            if len(product_files)==0:
+                return
+            for filename in product_files:
+                object_hash = _hash_file_part((filename,'md5',None))[1]
+                object_file = self._object_file(object_hash)
+                if os.path.exists(object_file) and not os.path.samefile(filename,object_file) and _hash_file_part((object_file,'md5',None))[1]!=object_hash:
+                    # The stored file has been changed in place since it was stored (through a hardlink to it),
+                    # so it doesn't have this content anymore
+                    os.remove(object_file)
+                if not os.path.exists(object_file):
+                    if not os.path.exists(os.path.dirname(object_file)):
+                        os.makedirs(os.path.dirname(object_file))
+                    try:
+                        os.link(filename,object_file)
+                    except OSError:
+                        shutil.copy2(filename,object_file)
+                stat = os.stat(object_file)
+                files.append((filename,object_hash,stat.st_size,stat.st_mtime))
+        entry_file = self._entry_file(key)
+        if not os.path.exists(os.path.dirname(entry_file)):
+            os.makedirs(os.path.dirname(entry_file))
+        with open(entry_file + '.tmp','w') as f:
+            json.dump({'files':files,'output':output},f)
+        os.rename(entry_file + '.tmp',entry_file)
+
+#! The :class:`RunCache` used by :meth:`run` (disabled by default)
+run_cache = RunCache()
+
+def run(command,products=None,working_directory='.',force_local=False,stderr=True,quiet=False,cache=None):
     '''wrapper to run external programs
 
     :command:           list containing command and parameters
@@ -116,6 +297,7 @@ def run(command,products=None,working_directory='.',force_local=False,stderr=Tru
     :quiet:             ``False`` (default) will print friendly messages
                         ``True`` will suppress everything but errors
                         ``None`` will suppress all output
+    :cache:             whether to use :data:`run_cache` for this command (``None`` uses ``run_cache.enabled``)
 
     Returns result in form of :class:`RunResult`
     '''
@@ -129,22 +311,152 @@ def run(command,products=None,working_directory='.',force_local=False,stderr=Tru
         command = flatten(command)
         command = [str(x) for x in command]
         quiet_option = False if quiet==False else True
+        if cache==None:
+            cache = run_cache.enabled
+        cache_key = None
+        if cache and products:
+            (cache_key,result) = run_cache.lookup(command,products,quiet_option)
+            if result:
+                return result
         with nl.notify('Running %s...' % command[0],level=nl.level.debug,quiet=quiet_option):
-            out = None
-            returncode = 0
-            try:
-                if stderr:
-                    # include STDERR in STDOUT output
-                    out = subprocess.check_output(command,stderr=subprocess.STDOUT)
-                elif stderr==None:
-                    # dump STDERR into nothing
-                    out = subprocess.check_output(command,stderr=subprocess.PIPE)
-                else:
-                    # let STDERR show through to the console
-                    out = subprocess.check_output(command)
-            except subprocess.CalledProcessError, e:
-                if quiet!=None:
-                    nl.notify('''ERROR: %s returned a non-zero status
+            start_time = time.time()
+            (out,returncode,usage) = _run_process(command,stderr)
+            if returncode!=0 and quiet!=None:
+                _notify_run_error(command,out,returncode)
+            result = RunResult(out,returncode)
+            if products and returncode==0:
+                result.output_filename = products[0]
+                if cache_key:
+                    run_cache.store(cache_key,products,out)
+            run_profiler.record(command,products,os.getcwd(),start_time,usage,returncode)
+            return result
+
+def _retry_interrupted(func,*args):
+    '''calls ``func(*args)``, and calls it again if a signal interrupts it (Python 2 raises an error instead)'''
+    while True:
+        try:
+            return func(*args)
+        except (OSError,IOError) as e:
+            if e.errno!=errno.EINTR:
+                raise
+
+def _run_process(command,stderr=True,working_directory=None,started=None):
+    '''runs ``command`` (with ``stderr`` handled as in :meth:`run`) and returns a tuple of the output, return code and
+    resource usage of the process. If given, ``started`` is called with the ``Popen`` object once it has started'''
+    devnull = None
+    if stderr:
+        # include STDERR in STDOUT output
+        stderr_pipe = subprocess.STDOUT
+    elif stderr==None:
+        # dump STDERR into nothing
+        stderr_pipe = devnull = open(os.devnull,'w')
+    else:
+        # let STDERR show through to the console
+        stderr_pipe = None
+    try:
+        process = subprocess.Popen(command,cwd=working_directory,stdout=subprocess.PIPE,stderr=stderr_pipe)
+    finally:
+        if devnull:
+            devnull.close()
+    if started:
+        started(process)
+    chunks = []
+    while True:
+        chunk = _retry_interrupted(os.read,process.stdout.fileno(),65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    out = ''.join(chunks)
+    process.stdout.close()
+    # wait4 gives the resource usage of just this process (which is still right if other threads are running commands)
+    (pid,status,usage) = _retry_interrupted(os.wait4,process.pid,0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return (out,process.returncode,usage)
+
+class RunProfiler(object):
+    '''collects the time and resources used by each command run with :meth:`run` (or :meth:`run_async`)
+
+    Each record is a dictionary with the ``command``, ``products``, ``working_directory``, ``start`` (Unix time),
+    ``wall``, ``user`` and ``sys`` times (in seconds), ``max_rss`` (in bytes), ``return_code``, and the ``pid``
+    and ``thread`` that ran it. The peak memory is measured from when the process was forked, so for small commands it
+    can reflect the size of the Python process instead.
+
+    :enabled:   set to ``True`` to start recording
+    :log_file:  if set, each record is also appended to this file as a line of JSON as soon as it finishes
+                (useful to collect records from several processes, e.g. :meth:`neural.dag.DAG.run`)
+
+    Example::
+
+        nl.run_profiler.enabled = True
+        run_my_analysis()
+        nl.run_profiler.write_chrome_trace('trace.json')    # open in chrome://tracing
+    '''
+    def __init__(self,enabled=False,log_file=None):
+        self.enabled = enabled
+        self.log_file = log_file
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self,command,products,working_directory,start_time,usage,return_code):
+        if not self.enabled:
+            return
+        record = {
+            'command': command,
+            'products': products,
+            'working_directory': working_directory,
+            'start': start_time,
+            'wall': time.time() - start_time,
+            'user': usage.ru_utime if usage else 0,
+            'sys': usage.ru_stime if usage else 0,
+            # ru_maxrss is in kilobytes on Linux, but bytes on OS X
+            'max_rss': (usage.ru_maxrss * (1 if sys.platform=='darwin' else 1024)) if usage else 0,
+            'return_code': return_code,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().ident
+        }
+        with self._lock:
+            self.records.append(record)
+            if self.log_file:
+                with open(self.log_file,'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+    def write_jsonl(self,filename):
+        '''writes the records to ``filename``, as one line of JSON per command'''
+        with self._lock:
+            records = list(self.records)
+        with open(filename,'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def write_chrome_trace(self,filename):
+        '''writes the records to ``filename`` in the Chrome trace event format (for ``chrome://tracing``
+        or Perfetto), with one row for each process and thread that ran commands'''
+        with self._lock:
+            records = list(self.records)
+        events = []
+        for record in records:
+            events.append({
+                'name': os.path.basename(record['command'][0]),
+                'cat': 'run',
+                'ph': 'X',
+                'ts': record['start']*1e6,
+                'dur': record['wall']*1e6,
+                'pid': record['pid'],
+                'tid': record['thread'],
+                'args': dict([(k,record[k]) for k in ['command','products','working_directory','user','sys','max_rss','return_code']])
+            })
+        with open(filename,'w') as f:
+            json.dump({'traceEvents':events,'displayTimeUnit':'ms'},f)
+
+#! The :class:`RunProfiler` used by :meth:`run` (disabled by default)
+run_profiler = RunProfiler()
+
+def _notify_run_error(command,output,returncode):
+    nl.notify('''ERROR: %s returned a non-zero status
 
     ----COMMAND------------
     %s
@@ -155,13 +467,126 @@ def run(command,products=None,working_directory='.',force_local=False,stderr=Tru
     %s
     -----------------------
     Return code: %d
-    ''' % (command[0],' '.join(command),e.output,e.returncode),level=nl.level.error)
-                out = e.output
-                returncode = e.returncode
-            result = RunResult(out,returncode)
-            if products and returncode==0:
-                result.output_filename = products[0]
-            return result
+    ''' % (command[0],' '.join(command),output,returncode),level=nl.level.error)
+
+class RunFuture:
+    '''the eventual result of a command started with :meth:`run_async`'''
+    def __init__(self,command):
+        self.command = command
+        self.cancelled = False
+        self._result = None
+        self._process = None
+        self._event = Event()
+
+    def done(self):
+        '''returns ``True`` if the command has finished (or been cancelled)'''
+        return self._event.is_set()
+
+    def result(self,timeout=None):
+        '''waits (at most ``timeout`` seconds, if given) for the command to finish and returns its :class:`RunResult`
+        (the same as :meth:`run` would have). Returns ``None`` if it was cancelled or hasn't finished in time'''
+        self._event.wait(timeout)
+        return self._result
+
+    def cancel(self):
+        '''stops the command: if it hasn't started yet it won't be run, and if it is running it is killed'''
+        if self.done():
+            return
+        self.cancelled = True
+        if self._process and self._process.poll()==None:
+            try:
+                self._process.kill()
+            except OSError:
+                pass
+
+def _run_thread(future,products,working_directory,stderr,quiet,semaphore):
+    if semaphore:
+        semaphore.acquire()
+    try:
+        if future.cancelled:
+            return
+        if products:
+            if all([os.path.exists(os.path.join(working_directory,x)) for x in products]):
+                future._result = False
+                return
+        command = future.command
+        quiet_option = False if quiet==False else True
+        nl.notify('Running %s...' % command[0],level=nl.level.debug,quiet=quiet_option)
+        def started(process):
+            future._process = process
+            if future.cancelled:
+                # Cancelled while it was starting
+                process.kill()
+        start_time = time.time()
+        try:
+            (out,returncode,usage) = _run_process(command,stderr,working_directory,started)
+        except OSError as e:
+            (out,returncode,usage) = (str(e),1,None)
+        run_profiler.record(command,products,working_directory,start_time,usage,returncode)
+        if future.cancelled:
+            return
+        if returncode!=0 and quiet!=None:
+            _notify_run_error(command,out,returncode)
+        future._result = RunResult(out,returncode)
+        if products and returncode==0:
+            future._result.output_filename = products[0]
+    finally:
+        if semaphore:
+            semaphore.release()
+        future._event.set()
+
+def run_async(command,products=None,working_directory='.',force_local=False,stderr=True,quiet=False,semaphore=None):
+    '''same as :meth:`run`, but starts the command in the background and returns a :class:`RunFuture` right away
+
+    Unlike :meth:`run`, this never changes the current directory, so any number of commands can be run at the
+    same time. If a ``threading.Semaphore`` is given as ``semaphore``, the command waits for it before starting
+    (see :meth:`run_all`). Commands run this way aren't sent to :mod:`neural.scheduler`, and don't use :data:`run_cache`'''
+    if products and isinstance(products,basestring):
+        products = [products]
+    command = [str(x) for x in flatten(command)]
+    future = RunFuture(command)
+    thread = Thread(target=_run_thread,args=(future,products,os.path.abspath(working_directory),stderr,quiet,semaphore))
+    thread.daemon = True
+    thread.start()
+    return future
+
+def run_all(commands,max_concurrent=None,cancel_on_error=False,**kwargs):
+    '''runs a list of commands, at most ``max_concurrent`` at a time (by default, one per CPU), and returns a list of their
+    :class:`RunResult` objects (in the same order)
+
+    Each entry in ``commands`` can either be a command, or a dictionary of arguments to :meth:`run_async`. Any other
+    keyword arguments are passed to every command. If ``cancel_on_error`` is ``True``, the first command that fails
+    (or a ``KeyboardInterrupt``) cancels all of the others, and ``None`` is returned for each of them
+
+    Example::
+
+        results = nl.run_all([['3dmaskave','-q','-mask',mask,dset] for dset in dsets],stderr=None)'''
+    if max_concurrent==None:
+        max_concurrent = multiprocessing.cpu_count()
+    semaphore = threading.BoundedSemaphore(max_concurrent)
+    futures = []
+    for command in commands:
+        args = dict(kwargs.items() + (command.items() if isinstance(command,dict) else [('command',command)]))
+        futures.append(run_async(semaphore=semaphore,**args))
+    pending = list(futures)
+    try:
+        while len(pending)>0:
+            for future in [x for x in pending if x.done()]:
+                pending.remove(future)
+                result = future.result()
+                if cancel_on_error and result and result.return_code!=0:
+                    for x in futures:
+                        x.cancel()
+                    pending = []
+                    break
+            if len(pending)>0:
+                # Wait with a timeout so that Ctrl-C still works
+                pending[0]._event.wait(0.1)
+    except KeyboardInterrupt:
+        for x in futures:
+            x.cancel()
+        raise
+    return [x.result(0) if not x.cancelled else None for x in futures]
 
 def log(fname,msg):
     ''' generic logging function '''
@@ -180,6 +605,77 @@ def hash(filename):
     dig = m.digest()
     return ''.join(['%x' % ord(x) for x in dig])
 
+def _new_hasher(algorithm):
+    if algorithm=='xxhash':
+        if xxhash==None:
+            raise ValueError('the "xxhash" module is not installed')
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+def _hash_file_part(args):
+    '''returns ``(filename,hash)`` of the first ``size`` bytes of ``filename`` (or the whole file if ``size`` is ``None``)'''
+    (filename,algorithm,size) = args
+    buffer_size = 10*1024*1024
+    m = _new_hasher(algorithm)
+    try:
+        with open(filename,'rb') as f:
+            if size:
+                m.update(f.read(size))
+            else:
+                buff = f.read(buffer_size)
+                while len(buff)>0:
+                    m.update(buff)
+                    buff = f.read(buffer_size)
+    except IOError:
+        return (filename,None)
+    return (filename,m.hexdigest())
+
+def find_duplicates(filenames,algorithm='md5',prefix_size=4096,workers=1):
+    '''returns a list of lists of files in ``filenames`` that have identical contents
+
+    Reads as little as possible: files are first grouped by size (files with a unique size can't
+    have a duplicate), then only the first ``prefix_size`` bytes of files that are the same size are hashed,
+    and only the files whose prefixes match are hashed completely.
+
+    :algorithm:     ``md5``, ``sha1``, or any other algorithm known by ``hashlib`` (e.g., ``blake2b``, if
+                    your Python has it), or ``xxhash`` for a fast non-cryptographic hash (requires the
+                    ``xxhash`` module)
+    :workers:       number of threads to hash files with (``None`` will use one per CPU)
+    '''
+    def group_by(keyed_files):
+        groups = {}
+        for (f,key) in keyed_files:
+            if key!=None:
+                groups.setdefault(key,[]).append(f)
+        return [x for x in groups.values() if len(x)>1]
+
+    pool = None
+    if workers!=1:
+        pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        map_func = pool.map if pool else map
+        sizes = []
+        for f in filenames:
+            try:
+                sizes.append((f,os.path.getsize(f)))
+            except OSError:
+                pass
+        duplicates = []
+        for same_size in group_by(sizes):
+            size = os.path.getsize(same_size[0])
+            prefix_hashes = map_func(_hash_file_part,[(f,algorithm,prefix_size) for f in same_size])
+            for same_prefix in group_by(prefix_hashes):
+                if size<=prefix_size:
+                    # already hashed the whole thing
+                    duplicates.append(same_prefix)
+                else:
+                    duplicates += group_by(map_func(_hash_file_part,[(f,algorithm,None) for f in same_prefix]))
+        return duplicates
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
 def hash_str(string):
     '''returns string of MD5 hash of given string'''
     m = hashlib.md5()
@@ -73,7 +73,7 @@ def blur(dset,fwhm,prefix=None):
         prefix = nl.suffix(dset,'_blur%.1fmm'%fwhm)
     return available_method('blur')(dset,fwhm,prefix)
 
-def roi_stats(mask,dset):
+def roi_stats(mask,dset,native=False):
     '''returns ROI stats on ``dset`` using ``mask`` as the ROI mask
     returns a dictionary with the structure::
 
@@ -102,7 +102,20 @@ def roi_stats(mask,dset):
         :nzsigma:
         :sum:
         :nzsum:
+
+    If ``native`` is ``True``, the statistics (of the last subbrick) are calculated in Python instead of with the
+    analysis package, or if it's ``None``, in Python when both datasets can be read directly (see
+    :meth:`neural.stats.roi_engine`). The results of the Python version differ slightly:
+
+        * if ``mask`` is on a different grid, it's resampled with nearest-neighbour interpolation, instead of
+          with ``3dfractionize -clip 0.2``, so ROI edges can include slightly different voxels
+        * ``sum`` is always included (AFNI only gives ``nzsum``)
     '''
+    engine = nl.stats.roi_engine(dset,[mask],native)
+    if engine:
+        return engine.roi_stats(mask)
+    if native:
+        return None
     return available_method('roi_stats')(mask,dset)
 
 def tshift(dset,suffix='_tshft',initial_ignore=3):
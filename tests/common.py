@@ -0,0 +1,25 @@
+'''shared setup for the tests
+
+The tests check the Python engines in neural against simple numpy (or plain subprocess) versions of the same
+calculation, using the synthetic data from ``benchmarks/synthetic.py``. AFNI doesn't need to be installed. Run
+them from the top of the repository with::
+
+    python -m unittest discover -s tests
+
+The ``neural`` in this checkout is the one that is tested, not an installed copy'''
+import os,sys,tempfile,shutil,unittest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(tests_dir))
+sys.path.insert(0,os.path.join(os.path.dirname(tests_dir),'benchmarks'))
+
+class TempDirTestCase(unittest.TestCase):
+    '''runs each test in a new temporary directory (``self.dir``), which is deleted afterwards'''
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.dir = tempfile.mkdtemp(prefix='neural-test-')
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.dir,True)
@@ -0,0 +1,114 @@
+'''tests of the connectivity functions in :mod:`neural.connectivity`, compared to ``np.corrcoef``'''
+import common
+import unittest
+import numpy as np
+import nibabel as nib
+import neural as nl
+import neural.connectivity
+import synthetic
+
+class TestConnectivity(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        rand = np.random.RandomState(0)
+        self.dset = synthetic.make_nifti('rest.nii.gz',(10,12,8,40))
+        image = nib.load(self.dset)
+        self.affine = image.affine
+        # a shared signal in half of the voxels, so the correlations aren't all close to 0
+        self.data = image.get_data().astype(float)
+        self.data[:5] += 100*np.sin(np.arange(40)/3.)
+        self.data[:,:,0] = 7
+        nib.save(nib.Nifti1Image(self.data.astype(np.float32),self.affine),self.dset)
+        self.matrix = self.data.reshape((-1,40),order='F')
+        self.seeds = [(-4,-6,9),(-14,-4,12),(-14,-4,12)]
+
+    def seed_reference(self,radius):
+        '''the average time series of the voxels within ``radius`` of each seed'''
+        ijk = np.indices(self.data.shape[:3]).reshape(3,-1,order='F')
+        xyz = self.affine[:3,:3].dot(ijk) + self.affine[:3,3:]
+        xyz[:2] *= -1
+        return np.array([self.matrix[np.sqrt(((xyz - np.array(seed)[:,None])**2).sum(axis=0))<=radius].mean(axis=0) for seed in self.seeds])
+
+    def test_seed_series(self):
+        conn = nl.connectivity.SeedConnectivity(self.dset)
+        self.assertTrue(np.allclose(conn.seed_series(self.seeds,radius=5),self.seed_reference(5)))
+
+    def test_correlation_maps(self):
+        seeds = self.seed_reference(5)
+        for chunk_size in [16,7,40]:
+            maps = nl.connectivity.correlation_maps(self.dset,self.seeds,radius=5,chunk_size=chunk_size)
+            self.assertEqual(maps.shape,self.data.shape[:3] + (len(self.seeds),))
+            maps = maps.reshape((-1,len(self.seeds)),order='F')
+            for v in [130,217,500,959]:
+                for s in xrange(len(self.seeds)):
+                    self.assertAlmostEqual(maps[v,s],np.corrcoef(self.matrix[v],seeds[s])[0,1],places=5)
+        # constant voxels don't correlate with anything
+        constant = np.flatnonzero((self.matrix==7).all(axis=1))
+        self.assertTrue(len(constant)>0 and (maps[constant]==0).all())
+
+    def test_masked_fisher_maps(self):
+        mask = np.zeros(self.data.shape[:3],dtype=np.int16)
+        mask[2:8,3:9,2:6] = 1
+        nib.save(nib.Nifti1Image(mask,self.affine),'mask.nii.gz')
+        maps = nl.connectivity.correlation_maps(self.dset,self.seeds[:1],prefix='z.nii.gz',radius=5,mask='mask.nii.gz',fisher=True)
+        self.assertTrue(np.allclose(nib.load('z.nii.gz').get_data(),maps))
+        self.assertTrue((maps[mask==0]==0).all())
+        v = np.ravel_multi_index((4,5,3),self.data.shape[:3],order='F')
+        self.assertAlmostEqual(maps[4,5,3,0],np.arctanh(np.corrcoef(self.matrix[v],self.seed_reference(5)[0])[0,1]),places=5)
+
+    def test_seed_matrix(self):
+        self.assertTrue(np.allclose(nl.connectivity.seed_matrix(self.dset,self.seeds,radius=5),np.corrcoef(self.seed_reference(5))))
+
+class TestROIMatrix(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        rand = np.random.RandomState(1)
+        self.dsets = [synthetic.make_nifti('rest%d.nii.gz' % i,(8,8,6,60),seed=i) for i in xrange(2)]
+        self.data = [nib.load(x).get_data().astype(float) for x in self.dsets]
+        self.affine = nib.load(self.dsets[0]).affine
+        self.atlas_data = rand.randint(0,6,(8,8,6)).astype(np.int16)
+        self.atlas_data[self.atlas_data==3] = 0
+        nib.save(nib.Nifti1Image(self.atlas_data,self.affine),'atlas.nii.gz')
+        self.rois = [1,2,4,5]
+
+    def reference_series(self,data):
+        return np.array([data[self.atlas_data==roi].mean(axis=0) for roi in self.rois])
+
+    def test_roi_series(self):
+        (rois,series) = nl.connectivity.roi_series(self.dsets[0],'atlas.nii.gz')
+        self.assertEqual(list(rois),self.rois)
+        self.assertTrue(np.allclose(series,self.reference_series(self.data[0])))
+
+    def test_roi_matrix(self):
+        reference = np.corrcoef(self.reference_series(self.data[0]))
+        (rois,r) = nl.connectivity.roi_matrix(self.dsets[0],'atlas.nii.gz')
+        self.assertTrue(np.allclose(r,reference))
+        (rois,z) = nl.connectivity.roi_matrix(self.dsets[0],'atlas.nii.gz',fisher=True)
+        self.assertTrue(np.allclose(z[~np.eye(len(rois),dtype=bool)],np.arctanh(reference[~np.eye(len(rois),dtype=bool)])))
+        self.assertEqual(nl.connectivity.roi_matrix(self.dsets[0],'atlas.nii.gz',method='unknown'),None)
+
+    def test_partial(self):
+        # the correlation of the residuals of each pair of ROIs after regressing out all of the others
+        series = self.reference_series(self.data[0])
+        (rois,partial) = nl.connectivity.roi_matrix(self.dsets[0],'atlas.nii.gz',method='partial')
+        for i in xrange(len(rois)):
+            for j in xrange(i+1,len(rois)):
+                others = np.vstack([np.ones(series.shape[1])] + [series[k] for k in xrange(len(rois)) if k not in [i,j]]).T
+                residuals = [x - others.dot(np.linalg.lstsq(others,x,rcond=None)[0]) for x in [series[i],series[j]]]
+                self.assertAlmostEqual(partial[i,j],np.corrcoef(residuals)[0,1])
+                self.assertAlmostEqual(partial[j,i],partial[i,j])
+
+    def test_roi_matrices(self):
+        for workers in [1,2]:
+            out = nl.connectivity.roi_matrices(self.dsets + ['missing.nii.gz'],'atlas.nii.gz',output='matrices.npz',workers=workers)
+            self.assertEqual(list(out['rois']),self.rois)
+            self.assertEqual(out['matrices'].shape,(3,4,4))
+            for i in xrange(2):
+                self.assertTrue(np.allclose(out['matrices'][i],np.corrcoef(self.reference_series(self.data[i])),atol=1e-6))
+            self.assertTrue(np.isnan(out['matrices'][2]).all())
+            saved = np.load('matrices.npz')
+            self.assertTrue(np.array_equal(saved['matrices'][:2],out['matrices'][:2]))
+            self.assertEqual(str(saved['method']),'correlation')
+
+if __name__ == '__main__':
+    unittest.main()
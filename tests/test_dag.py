@@ -0,0 +1,98 @@
+'''tests of :class:`neural.dag.DAG`, compared to running the same commands one after another'''
+import common
+import os,subprocess,unittest
+import neural as nl
+import neural.dag
+
+def _commands(prefix):
+    '''a small pipeline: two independent branches that are joined at the end'''
+    return [
+        (['sh','-c','echo first > %s_a.txt' % prefix],'%s_a.txt' % prefix),
+        (['sh','-c','echo second > %s_b.txt' % prefix],'%s_b.txt' % prefix),
+        (['sh','-c','cat %s_a.txt %s_a.txt > %s_c.txt' % ((prefix,)*3)],'%s_c.txt' % prefix),
+        (['sh','-c','cat %s_c.txt %s_b.txt > %s_d.txt' % ((prefix,)*3)],'%s_d.txt' % prefix),
+    ]
+
+class TestDAG(common.TempDirTestCase):
+    def read(self,filename):
+        with open(filename) as f:
+            return f.read()
+
+    def test_matches_sequential(self):
+        for (command,product) in _commands('seq'):
+            subprocess.check_call(command)
+        dag = nl.dag.DAG()
+        with dag:
+            for (command,product) in _commands('dag'):
+                nl.run(command,products=product)
+        self.assertTrue(dag.run(workers=2))
+        for name in ['a','b','c','d']:
+            self.assertEqual(self.read('dag_%s.txt' % name),self.read('seq_%s.txt' % name))
+        self.assertEqual([x.status for x in dag.nodes],['done']*4)
+
+    def test_dependencies(self):
+        dag = nl.dag.DAG()
+        with dag:
+            for (command,product) in _commands('dag'):
+                nl.run(command,products=product)
+        (a,b,c,d) = dag.nodes
+        self.assertEqual(a.parents,[])
+        self.assertEqual(b.parents,[])
+        self.assertEqual(c.parents,[a])
+        self.assertEqual(sorted(d.parents),sorted([b,c]))
+
+    def test_failure_skips_children(self):
+        dag = nl.dag.DAG()
+        with dag:
+            nl.run(['sh','-c','exit 1'],products='x.txt')
+            nl.run(['cp','x.txt','y.txt'],products='y.txt')
+            nl.run(['sh','-c','echo ok > z.txt'],products='z.txt')
+        self.assertFalse(dag.run(workers=2))
+        self.assertEqual([x.status for x in dag.nodes],['failed','skipped','done'])
+        self.assertFalse(os.path.exists('y.txt'))
+
+    def test_existing_products(self):
+        with open('done.txt','w') as f:
+            f.write('done')
+        dag = nl.dag.DAG()
+        with dag:
+            self.assertEqual(nl.run(['sh','-c','echo again > done.txt'],products='done.txt'),False)
+        self.assertEqual(dag.nodes,[])
+        self.assertTrue(dag.run(workers=1))
+        self.assertEqual(self.read('done.txt'),'done')
+
+    def test_run_replaced_inside(self):
+        old_run = nl.run
+        replaced = lambda *args,**kwargs: None
+        try:
+            dag = nl.dag.DAG()
+            with dag:
+                self.assertEqual(nl.run,dag.add)
+                nl.run = replaced
+            self.assertTrue(nl.run is replaced)
+            with dag:
+                with dag:
+                    pass
+                self.assertEqual(nl.run,dag.add)
+            self.assertTrue(nl.run is replaced)
+        finally:
+            nl.run = old_run
+
+    def test_cache_option(self):
+        old_cache = nl.utils.run_cache
+        nl.utils.run_cache = nl.utils.RunCache(os.path.join(self.dir,'store'),enabled=True)
+        try:
+            dag = nl.dag.DAG()
+            with dag:
+                nl.run(['sh','-c','echo cached > cached.txt'],products='cached.txt')
+                nl.run(['sh','-c','echo not cached > uncached.txt'],products='uncached.txt',cache=False)
+            self.assertEqual([x.cache for x in dag.nodes],[None,False])
+            self.assertTrue(dag.run(workers=2))
+            # the commands ran in other processes, so the store is the only sign of what was cached
+            entries = [x for (root,dirs,files) in os.walk(os.path.join(self.dir,'store','results')) for x in files]
+            self.assertEqual(len(entries),1)
+        finally:
+            nl.utils.run_cache = old_cache
+
+if __name__ == '__main__':
+    unittest.main()
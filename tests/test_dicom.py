@@ -0,0 +1,302 @@
+'''tests of the DICOM functions in :mod:`neural.dicom`, compared to reading the files with pydicom and numpy'''
+import common
+import os,glob,shutil,struct,tarfile,zipfile,unittest
+import numpy as np
+import nibabel as nib
+import pydicom
+import neural as nl
+import neural.dicom
+import synthetic
+
+class TestScanDir(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.files = synthetic.make_dicom_series('dicoms',num_series=2,slices=3,reps=2,rows=8,cols=8)
+        # a few files that aren't DICOMs, or are broken ones
+        with open(os.path.join('dicoms','notes.txt'),'w') as f:
+            f.write('not a DICOM')
+        open(os.path.join('dicoms','empty'),'w').close()
+        with open(self.files[0],'rb') as f:
+            dicom = f.read()
+        # the series description with a value representation pydicom doesn't know
+        tag = '\x08\x00\x3e\x10LO'
+        self.assertEqual(dicom.count(tag),1)
+        with open(os.path.join('dicoms','unknown_vr.dcm'),'wb') as f:
+            f.write(dicom.replace(tag,tag[:4] + 'ZZ'))
+
+    def test_broken_files_skipped(self):
+        for (workers,threads) in [(1,False),(2,False),(2,True)]:
+            for md5_hash in [False,True]:
+                files = nl.dicom.scan_dir('dicoms',md5_hash=md5_hash,workers=workers,threads=threads)
+                self.assertEqual(sorted(files),sorted(self.files))
+                for filename in self.files:
+                    d = pydicom.read_file(filename,stop_before_pixels=True)
+                    self.assertEqual(files[filename][(0x0008,0x103E)],d.SeriesDescription)
+
+def _old_max_diff(dset1,dset2):
+    ''':meth:`neural.dicom.max_diff` as it was before it compared the datasets in blocks'''
+    dset1_data = nib.load(dset1).get_data()
+    dset2_data = nib.load(dset2).get_data()
+    old_err = np.seterr(divide='ignore',invalid='ignore')
+    max_val = 100*np.max(np.ma.masked_invalid(np.double(dset1_data - dset2_data) / ((dset1_data+dset2_data)/2)))
+    np.seterr(**old_err)
+    return max_val
+
+class TestMaxDiff(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.dset = synthetic.make_nifti('a.nii.gz',(10,12,8,20))
+        image = nib.load(self.dset)
+        self.affine = image.affine
+        self.data = image.get_data()
+
+    def save(self,filename,data):
+        nib.save(nib.Nifti1Image(data,self.affine),filename)
+        return filename
+
+    def test_matches_old(self):
+        rand = np.random.RandomState(0)
+        changed = self.data.copy()
+        changed[rand.rand(*changed.shape)<0.01] += 40
+        changed[3,4,5] -= 300
+        # zeros in both datasets (undefined) and only one of them (infinite), which are both left out
+        changed[0,0,0] = self.data[0,0,0] = 0
+        changed[1,0,0] = 0
+        self.save('a.nii.gz',self.data)
+        pairs = [
+            ('a.nii.gz',self.save('b.nii.gz',changed)),
+            ('b.nii.gz','a.nii.gz'),
+            (self.save('a_float.nii',self.data.astype(np.float32)),self.save('b_float.nii',changed.astype(np.float32)*1.001))
+        ]
+        for (a,b) in pairs:
+            for chunk_size in [2**22,1000,1]:
+                self.assertAlmostEqual(nl.dicom.max_diff(a,b,chunk_size=chunk_size),_old_max_diff(a,b))
+        self.assertEqual(nl.dicom.max_diff('a.nii.gz',self.save('same.nii',self.data)),0.0)
+
+    def test_tolerance_and_header(self):
+        changed = self.data.astype(np.float32)
+        changed[...,0] *= 1.5
+        changed[...,-1] *= 1.01
+        self.save('b.nii',changed)
+        # the difference is signed, so it's only large this way around
+        full = nl.dicom.max_diff('b.nii',self.dset,chunk_size=1000)
+        early = nl.dicom.max_diff('b.nii',self.dset,tolerance=10,chunk_size=1000)
+        self.assertTrue(10<early<=full)
+        self.assertTrue(nl.dicom.max_diff(self.dset,'b.nii')<=0)
+        self.assertEqual(nl.dicom.max_diff(self.dset,'b.nii',check_header=True),float('inf'))
+        self.assertEqual(nl.dicom.max_diff(self.dset,self.save('small.nii',self.data[:-1])),float('inf'))
+        self.assertEqual(nl.dicom.max_diff(self.dset,'missing.nii'),float('inf'))
+
+class TestCreateDset(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.slices = 4
+        self.reps = 3
+        rand = np.random.RandomState(0)
+        order = rand.permutation(self.slices*self.reps)
+        # written in a random order, with a different image in each, so the sorting shows in the data
+        self.pixels = {}
+        for (i,n) in enumerate(order):
+            (rep,z) = divmod(n,self.slices)
+            filename = synthetic.make_dicom(os.path.join('epi','IM%04d.dcm' % i) if os.path.exists('epi') else self.new_dir('epi',i),
+                    instance=n+1,z=3.0*z,rows=6,cols=5,acquisition_time='1200%02d.0' % rep)
+            d = pydicom.read_file(filename)
+            d.PixelData = rand.randint(-1000,1000,(6,5)).astype(np.int16).tostring()
+            d.save_as(filename)
+            self.pixels[(z,rep)] = pydicom.read_file(filename).pixel_array
+        with open(os.path.join('epi','notes.txt'),'w') as f:
+            f.write('not a DICOM')
+
+    def new_dir(self,directory,i):
+        os.makedirs(directory)
+        return os.path.join(directory,'IM%04d.dcm' % i)
+
+    def test_matches_pydicom(self):
+        dset = nl.dicom.create_dset('epi',native=True)
+        self.assertEqual(dset,'epi.nii.gz')
+        image = nib.load(dset)
+        data = image.get_data()
+        self.assertEqual(data.shape,(6,5,self.slices,self.reps))
+        for k in xrange(self.slices):
+            # each slice has the images from the position the affine puts it at (the images were written 3 mm apart)
+            z = int(round(image.affine.dot([0,0,k,1])[2]/3.0))
+            for rep in xrange(self.reps):
+                self.assertTrue(np.array_equal(data[:,:,k,rep],self.pixels[(z,rep)]),(k,rep))
+        self.assertTrue(np.allclose(image.header.get_zooms(),(2,2,3,2)))
+        # the first voxel is at the ImagePositionPatient of the first slice, the first axis goes down the rows
+        # (+y in LPS), and everything is in RAS instead of LPS
+        self.assertTrue(np.allclose(image.affine[:2],[[0,-2,0,100],[-2,0,0,100]]))
+        self.assertTrue(np.allclose(abs(image.affine[2,2]),3))
+        self.assertEqual(int(image.header['slice_code']),3)
+        self.assertEqual(nl.dsets._dset_info_nifti(dset).slice_timing,'alt+z')
+        # doesn't overwrite an existing dataset
+        self.assertEqual(nl.dicom.create_dset('epi',native=True),False)
+
+    def test_uneven_reps(self):
+        os.remove(os.path.join('epi','IM0000.dcm'))
+        self.assertEqual(nl.dicom.create_dset('epi',native=True),False)
+        self.assertFalse(os.path.exists('epi.nii.gz'))
+
+class TestReconstruct(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.slices = 3
+        self.reps = 2
+        synthetic.make_dicom_series('raw',num_series=3,slices=self.slices,reps=self.reps,rows=8,cols=8)
+        # the last series is missing an image, so it can't be made into a dataset
+        os.remove(os.path.join('raw','IM%06d.dcm' % (3*self.slices*self.reps)))
+        self.old_which = nl.which
+        # the datasets are always created natively, whether AFNI is installed or not
+        nl.which = lambda program: None if program=='to3d' else self.old_which(program)
+
+    def tearDown(self):
+        nl.which = self.old_which
+        common.TempDirTestCase.tearDown(self)
+
+    def check_dset(self,dset):
+        data = nib.load(dset).get_data()
+        self.assertEqual(data.shape,(8,8,self.slices,self.reps))
+        # each image is filled with its instance number
+        for rep in xrange(self.reps):
+            self.assertEqual(sorted(np.unique(data[...,rep])),range(rep*self.slices+1,(rep+1)*self.slices+1))
+
+    def test_workers(self):
+        for workers in [1,2]:
+            raw_dir = 'raw%d' % workers
+            shutil.copytree('raw',raw_dir)
+            results = nl.dicom.reconstruct_files(raw_dir,workers=workers)
+            self.assertEqual(sorted(results),['subj1-20150101-120%d00-series%d-%d_images' % (s,s,n) for (s,n) in [(1,6),(2,6),(3,5)]])
+            for name in results:
+                if name.startswith('subj1-20150101-120300'):
+                    self.assertFalse(results[name])
+                else:
+                    self.check_dset(os.path.join(raw_dir + '-sorted',results[name]))
+
+    def test_unpack_archive(self):
+        with tarfile.open('raw.tgz','w:gz') as tgz:
+            tgz.add('raw')
+        for workers in [1,2]:
+            out_dir = 'out%d' % workers
+            nl.dicom.unpack_archive('raw.tgz',out_dir,workers=workers)
+            dsets = sorted(glob.glob(os.path.join(out_dir,'*.nii.gz')))
+            self.assertEqual(len(dsets),2)
+            for dset in dsets:
+                self.check_dset(dset)
+            # every series (including the one that failed) is archived, with all of its images
+            raw_tgzs = sorted(glob.glob(os.path.join(out_dir,'raw','subj1-*.tgz')))
+            self.assertEqual([len(tarfile.open(x).getnames()) for x in raw_tgzs],[7,7,6])
+
+def _dir_contents(directory):
+    '''a ``dict`` of each subdirectory of ``directory`` to the sorted MD5s of the files in it'''
+    contents = {}
+    for subdir in os.listdir(directory):
+        if os.path.isdir(os.path.join(directory,subdir)):
+            contents[subdir] = sorted([nl.hash(os.path.join(directory,subdir,x)) for x in os.listdir(os.path.join(directory,subdir))])
+    return contents
+
+class TestStreamArchive(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        synthetic.make_dicom_series(os.path.join('raw','scans'),num_series=2,slices=3,reps=2,rows=8,cols=8,duplicates=4)
+        with open(os.path.join('raw','notes.txt'),'w') as f:
+            f.write('not a DICOM')
+        with tarfile.open('raw.tgz','w:gz') as tgz:
+            tgz.add('raw')
+        with zipfile.ZipFile('raw.zip','w') as z:
+            for (r,ds,fs) in os.walk('raw'):
+                for f in fs:
+                    z.write(os.path.join(r,f))
+        # the directories organize_dir makes from the same files
+        shutil.copytree('raw','organized')
+        nl.dicom.organize_dir('organized')
+        self.reference = _dir_contents('organized-sorted')
+        self.assertEqual(len(self.reference),2)
+
+    def test_matches_organize_dir(self):
+        for archive in ['raw.tgz','raw.zip']:
+            out_dir = 'sorted-' + archive
+            other_files = archive + '-other.tgz'
+            series_dirs = nl.dicom.stream_archive(archive,out_dir,other_files)
+            self.assertEqual(sorted([os.path.basename(x) for x in series_dirs]),sorted(self.reference))
+            self.assertEqual(_dir_contents(out_dir),self.reference)
+            with tarfile.open(other_files) as tgz:
+                self.assertEqual(tgz.getnames(),['raw/notes.txt'])
+                self.assertEqual(tgz.extractfile('raw/notes.txt').read(),'not a DICOM')
+
+    def test_not_streamable(self):
+        self.assertEqual(nl.utils.archive_members('raw.7z'),None)
+        self.assertEqual(nl.dicom.stream_archive('raw.7z','out'),None)
+
+    def test_unpack_archive(self):
+        old_which = nl.which
+        nl.which = lambda program: None if program=='to3d' else old_which(program)
+        try:
+            for stream in [False,True]:
+                out_dir = 'out-%s' % stream
+                nl.dicom.unpack_archive('raw.tgz',out_dir,stream=stream)
+                dsets = sorted(glob.glob1(out_dir,'*.nii.gz'))
+                self.assertEqual(len(dsets),2)
+                if stream:
+                    for dset in dsets:
+                        self.assertTrue(np.array_equal(nib.load(os.path.join(out_dir,dset)).get_data(),nib.load(os.path.join('out-False',dset)).get_data()))
+                    self.assertEqual(sorted(os.listdir(os.path.join(out_dir,'raw'))),sorted(os.listdir(os.path.join('out-False','raw'))))
+        finally:
+            nl.which = old_which
+
+def _csa_header(tags):
+    '''packs the ``dict`` of tag name -> list of float values ``tags`` into a Siemens CSA2 header'''
+    csa = 'SV10' + struct.pack('<4sII','\4\3\2\1',len(tags),77)
+    for name in sorted(tags):
+        csa += struct.pack('<64si4s3i',name,len(tags[name]),'FD',0,len(tags[name]),77)
+        for value in tags[name]:
+            item = '%.4f\0' % value
+            csa += struct.pack('<4i',len(item),len(item),77,len(item)) + item + '\0'*(-len(item) % 4)
+    return csa
+
+class TestInfoTable(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.files = synthetic.make_dicom_series('dicoms',num_series=1,slices=3,reps=2,rows=8,cols=8)
+        self.slice_times = [[0.0,1332.5,665.0],[0.0,665.0,1332.5]]
+        for i in xrange(len(self.files)):
+            d = pydicom.read_file(self.files[i])
+            if i<2:
+                d.add_new((0x29,0x10),'LO','SIEMENS CSA HEADER')
+                d.add_new((0x29,0x1010),'OB',_csa_header({'MosaicRefAcqTimes':self.slice_times[i],'SliceThickness':[3]}))
+            if i==3:
+                # a tag that's only found nested in a sequence
+                item = pydicom.dataset.Dataset()
+                item.ReferencedSOPInstanceUID = '1.2.3.4'
+                d.ReferencedImageSequence = pydicom.sequence.Sequence([item])
+            if i==4:
+                del d.RepetitionTime
+            d.save_as(self.files[i])
+        self.files.append(os.path.join('dicoms','notes.txt'))
+        with open(self.files[-1],'w') as f:
+            f.write('not a DICOM')
+        self.tags = [(0x20,0x13),(0x18,0x80),(0x8,0x103e),(0x8,0x1155)]
+
+    def test_matches_pydicom(self):
+        for workers in [1,2]:
+            table = nl.dicom.info_table(self.files,self.tags,slice_times=True,workers=workers)
+            self.assertEqual(list(table['filename']),self.files)
+            self.assertEqual(list(table['valid']),[True]*6 + [False])
+            # numbers in every file are a numeric column, otherwise missing values are None
+            self.assertEqual(table[(0x20,0x13)].dtype,object)
+            self.assertEqual(list(table[(0x20,0x13)]),range(1,7) + [None])
+            for i in xrange(6):
+                d = pydicom.read_file(self.files[i])
+                self.assertEqual(table[(0x18,0x80)][i],d.get('RepetitionTime'))
+                self.assertEqual(table[(0x8,0x103e)][i],d.SeriesDescription)
+            self.assertEqual(list(table[(0x8,0x1155)]),[None]*3 + ['1.2.3.4'] + [None]*3)
+            self.assertEqual(list(table['slice_times']),self.slice_times + [None]*5)
+        table = nl.dicom.info_table(self.files[:4],(0x20,0x13))
+        self.assertTrue(np.issubdtype(table[(0x20,0x13)].dtype,np.integer))
+        self.assertEqual(list(table[(0x20,0x13)]),range(1,5))
+
+    def test_info_for_tags(self):
+        # single files are looked up the same way, including the nested tag
+        self.assertEqual(nl.dicom.info_for_tags(self.files[3],[(0x8,0x1155),(0x20,0x13)]),{(0x8,0x1155):'1.2.3.4',(0x20,0x13):4})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+'''tests of :class:`neural.dicom.DicomIndex` and indexed scanning with :meth:`neural.dicom.scan_dir`'''
+import common
+import os,time,unittest
+import pydicom
+import neural as nl
+import neural.dicom
+import synthetic
+
+class TestDicomIndex(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.files = synthetic.make_dicom_series('dicoms',num_series=2,slices=3,reps=2,rows=8,cols=8,duplicates=2)
+        with open(os.path.join('dicoms','notes.txt'),'w') as f:
+            f.write('not a DICOM')
+        self.index = nl.dicom.DicomIndex('index.db')
+        self.old_scan_file = nl.dicom._scan_file
+        self.scanned = []
+        def scan_file(args):
+            self.scanned.append(args[0])
+            return self.old_scan_file(args)
+        nl.dicom._scan_file = scan_file
+
+    def tearDown(self):
+        nl.dicom._scan_file = self.old_scan_file
+        common.TempDirTestCase.tearDown(self)
+
+    def test_matches_pydicom(self):
+        files = nl.dicom.scan_dir('dicoms',md5_hash=True,index=self.index)
+        self.assertEqual(sorted(files),sorted(self.files))
+        for filename in files:
+            d = pydicom.read_file(filename,stop_before_pixels=True)
+            self.assertEqual(files[filename][(0x0008,0x103E)],d.SeriesDescription)
+            self.assertEqual(files[filename][(0x0028,0x0010)],d.Rows)
+            with open(filename,'rb') as f:
+                self.assertEqual(files[filename]['md5'],nl.hash_str(f.read()))
+
+    def test_unchanged_files_not_read(self):
+        first = nl.dicom.scan_dir('dicoms',index=self.index)
+        self.index.commit()
+        self.assertEqual(len(self.scanned),len(self.files)+1)
+        del self.scanned[:]
+        second = nl.dicom.scan_dir('dicoms',index=nl.dicom.DicomIndex('index.db'))
+        self.assertEqual(self.scanned,[])
+        self.assertEqual(first,second)
+        self.assertEqual(second,nl.dicom.scan_dir('dicoms'))
+
+    def test_changed_file_read_again(self):
+        nl.dicom.scan_dir('dicoms',index=self.index)
+        filename = sorted(self.files)[-1]
+        synthetic.make_dicom(filename,series=1,instance=1,rows=8,cols=8,description='changed')
+        os.utime(filename,(time.time()+10,time.time()+10))
+        del self.scanned[:]
+        files = nl.dicom.scan_dir('dicoms',index=self.index)
+        self.assertEqual(self.scanned,[filename])
+        self.assertEqual(files[filename][(0x0008,0x103E)],'changed')
+
+    def test_more_tags_read_again(self):
+        nl.dicom.scan_dir('dicoms',tags=[(0x0008,0x103E)],index=self.index)
+        del self.scanned[:]
+        nl.dicom.scan_dir('dicoms',tags=[(0x0008,0x103E),(0x0010,0x0020)],index=self.index)
+        self.assertEqual(len(self.scanned),len(self.files)+1)
+        del self.scanned[:]
+        # only the DICOMs need to be read again to get the hashes
+        nl.dicom.scan_dir('dicoms',tags=[(0x0008,0x103E)],md5_hash=True,index=self.index)
+        self.assertEqual(len(self.scanned),len(self.files))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+'''tests of :class:`neural.dsets.DsetInfoCache` and of reading AFNI ``.HEAD`` files without ``3dinfo``'''
+import common
+import os,subprocess,time,unittest
+import numpy as np
+import nibabel as nib
+import neural as nl
+import synthetic
+
+class TestDsetInfoCache(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.dset = synthetic.make_nifti('epi.nii.gz',(8,9,10,12))
+        self.cache = nl.dsets.DsetInfoCache(db_file='info.db')
+        self.old_cache = nl.dsets.info_cache
+        nl.dsets.info_cache = self.cache
+
+    def tearDown(self):
+        nl.dsets.info_cache = self.old_cache
+        common.TempDirTestCase.tearDown(self)
+
+    def test_matches_header(self):
+        for i in xrange(2):
+            info = nl.dset_info(self.dset)
+            header = nib.load(self.dset).header
+            self.assertEqual(info.reps,header.get_data_shape()[3])
+            self.assertEqual(info.voxel_dims,list(header.get_data_shape()[:3]))
+            self.assertTrue(np.allclose(info.voxel_size,header.get_zooms()[:3]))
+            self.assertEqual(len(info.subbricks),info.reps)
+        self.assertEqual((self.cache.hits,self.cache.misses),(1,1))
+
+    def test_returns_copies(self):
+        nl.dset_info(self.dset).reps = 1000
+        self.assertEqual(nl.dset_info(self.dset).reps,12)
+
+    def test_changed_file(self):
+        nl.dset_info(self.dset)
+        synthetic.make_nifti(self.dset,(8,9,10,20))
+        # make sure the modification time changes, even on filesystems with coarse timestamps
+        os.utime(self.dset,(time.time()+10,time.time()+10))
+        self.assertEqual(nl.dset_info(self.dset).reps,20)
+
+    def test_database(self):
+        nl.dset_info(self.dset)
+        cache = nl.dsets.DsetInfoCache(db_file='info.db')
+        info = cache.get(self.dset)
+        self.assertEqual(info.reps,12)
+        self.assertEqual(cache.hits,1)
+
+    def test_invalidate(self):
+        paths = ['/data/sub_1','/data/sub_1[2]','/data/subX1[3]','/data/sub_10','/data/SUB_1[1]']
+        db = self.cache._connection()
+        for path in paths:
+            db.execute('INSERT INTO dset_info VALUES (?,?,?,?,?)',(path,0,0,0,''))
+        db.commit()
+        self.cache.invalidate('/data/sub_1')
+        left = sorted([str(x[0]) for x in db.execute('SELECT path FROM dset_info')])
+        self.assertEqual(left,['/data/SUB_1[1]','/data/subX1[3]','/data/sub_10'])
+
+def _afni_head(attrs):
+    '''the text of a ``.HEAD`` file with the attributes in the list of ``(type,name,value)`` tuples ``attrs``'''
+    head = ''
+    for (type,name,value) in attrs:
+        if type=='string':
+            head += "\ntype = string-attribute\nname = %s\ncount = %d\n'%s~\n" % (name,len(value)+1,value)
+        else:
+            # values wrap after 5 a line, like AFNI writes them
+            lines = [' '.join([str(x) for x in value[i:i+5]]) for i in xrange(0,len(value),5)]
+            head += '\ntype = %s-attribute\nname = %s\ncount = %d\n %s\n' % (type,name,len(value),'\n '.join(lines))
+    return head
+
+#: a 4D EPI dataset (LPI, 4 x 5 x 3 voxels, 6 time points with a 2000 ms TR)
+_epi_head = _afni_head([
+    ('string','TYPESTRING','3DIM_HEAD_FUNC'),
+    ('string','IDCODE_STRING','XYZ_9wJ4kKYlb1Q7qNNdDo8pDg'),
+    ('integer','DATASET_RANK',[3,6,0,0,0,0,0,0]),
+    ('integer','DATASET_DIMENSIONS',[4,5,3,0,0]),
+    ('integer','ORIENT_SPECIFIC',[1,2,4]),
+    ('float','ORIGIN',[4.5,9,-3]),
+    ('float','DELTA',[-3,-3,3.5]),
+    ('string','HISTORY_NOTE','[someone@scanner: Mon Jan  1 12:00:00 2018] to3d -time:zt 3 6 2000 alt+z -prefix epi epi_*.dcm'),
+    ('integer','BRICK_TYPES',[1]*6),
+    ('float','BRICK_STATS',[0,1000,1,1001,2,1002,3,1003,4,1004,5,1005]),
+    ('string','TEMPLATE_SPACE','ORIG'),
+    ('integer','TAXIS_NUMS',[6,3,77001,-999,-999,-999,-999,-999]),
+    ('float','TAXIS_FLOATS',[0,2000,0,-3,3.5,-999999,-999999,-999999]),
+    ('float','TAXIS_OFFSETS',[0,1333.333,666.6667])
+])
+
+#: what ``3dinfo -verb`` printed for :data:`_epi_head`
+_epi_3dinfo = '''
+Dataset File:    epi+orig
+Identifier Code: XYZ_9wJ4kKYlb1Q7qNNdDo8pDg  Creation Date: Mon Jan  1 12:00:00 2018
+Template Space:  ORIG
+Dataset Type:    Echo Planar (-epan)
+Byte Order:      LSB_FIRST [this CPU native = LSB_FIRST]
+Storage Mode:    BRIK
+Storage Space:   360 (360) bytes
+Geometry String: "MATRIX(-3,0,0,4.5,0,-3,0,9,0,0,3.5,-3):4,5,3"
+Data Axes Tilt:  Plumb
+Data Axes Orientation:
+  first  (x) = Left-to-Right
+  second (y) = Posterior-to-Anterior
+  third  (z) = Inferior-to-Superior   [-orient LPI]
+R-to-L extent:    -4.500 [R] -to-     4.500 [L] -step-     3.000 mm [  4 voxels]
+A-to-P extent:    -3.000 [A] -to-     9.000 [P] -step-     3.000 mm [  5 voxels]
+I-to-S extent:    -3.000 [I] -to-     4.000 [S] -step-     3.500 mm [  3 voxels]
+Number of time steps = 6  Time step = 2.00000s  Origin = 0.00000s  Number time-offset slices = 3  Thickness = 3.500
+  -- At sub-brick #0 '#0' datum type is short:            0 to          1000
+  -- At sub-brick #1 '#1' datum type is short:            1 to          1001
+  -- At sub-brick #2 '#2' datum type is short:            2 to          1002
+  -- At sub-brick #3 '#3' datum type is short:            3 to          1003
+  -- At sub-brick #4 '#4' datum type is short:            4 to          1004
+  -- At sub-brick #5 '#5' datum type is short:            5 to          1005
+
+----- HISTORY -----
+[someone@scanner: Mon Jan  1 12:00:00 2018] to3d -time:zt 3 6 2000 alt+z -prefix epi epi_*.dcm
+'''
+
+#: a 3D statistics bucket in Talairach space (RAI, 2 x 2 x 2 voxels of 1.5 mm)
+_stats_head = _afni_head([
+    ('string','TYPESTRING','3DIM_HEAD_FUNC'),
+    ('string','IDCODE_STRING','XYZ_Hh3b2mWzCx0HMsbSUkNy2Q'),
+    ('integer','DATASET_RANK',[3,3,0,0,0,0,0,0]),
+    ('integer','DATASET_DIMENSIONS',[2,2,2,0,0]),
+    ('integer','ORIENT_SPECIFIC',[0,3,4]),
+    ('float','ORIGIN',[-1.5,-3,0.75]),
+    ('float','DELTA',[1.5,1.5,1.5]),
+    ('string','BRICK_LABS','Full_Coef~Full_Tstat~Full_Fstat'),
+    ('integer','BRICK_TYPES',[3,3,3]),
+    ('float','BRICK_STATS',[-2.25,3.5,-4.125,5,0,17.75]),
+    ('float','BRICK_STATAUX',[1,3,1,20,2,4,2,2,30]),
+    ('string','TEMPLATE_SPACE','TLRC')
+])
+
+#: what ``3dinfo -verb`` printed for :data:`_stats_head`
+_stats_3dinfo = '''
+Dataset File:    stats+tlrc
+Identifier Code: XYZ_Hh3b2mWzCx0HMsbSUkNy2Q  Creation Date: Mon Jan  1 12:30:00 2018
+Template Space:  TLRC
+Dataset Type:    Func-Bucket (-fbuc)
+Byte Order:      LSB_FIRST [this CPU native = LSB_FIRST]
+Storage Mode:    BRIK
+Storage Space:   96 (96) bytes
+Data Axes Tilt:  Plumb
+Data Axes Orientation:
+  first  (x) = Right-to-Left
+  second (y) = Anterior-to-Posterior
+  third  (z) = Inferior-to-Superior   [-orient RAI]
+R-to-L extent:    -1.500 [R] -to-     0.000 [L] -step-     1.500 mm [  2 voxels]
+A-to-P extent:    -3.000 [A] -to-    -1.500 [A] -step-     1.500 mm [  2 voxels]
+I-to-S extent:     0.750 [S] -to-     2.250 [S] -step-     1.500 mm [  2 voxels]
+Number of values stored at each pixel = 3
+  -- At sub-brick #0 'Full_Coef' datum type is float:        -2.25 to           3.5
+  -- At sub-brick #1 'Full_Tstat' datum type is float:       -4.125 to             5
+     statcode = fitt;  statpar = 20
+  -- At sub-brick #2 'Full_Fstat' datum type is float:            0 to         17.75
+     statcode = fift;  statpar = 2 30
+'''
+
+class TestAfniHead(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        for (prefix,head) in [('epi+orig',_epi_head),('stats+tlrc',_stats_head)]:
+            with open(prefix + '.HEAD','w') as f:
+                f.write(head)
+            open(prefix + '.BRIK','w').close()
+        self.old_check_output = subprocess.check_output
+        self.old_cache = nl.dsets.info_cache
+        nl.dsets.info_cache = nl.dsets.DsetInfoCache(db_file='info.db')
+
+    def tearDown(self):
+        subprocess.check_output = self.old_check_output
+        nl.dsets.info_cache = self.old_cache
+        common.TempDirTestCase.tearDown(self)
+
+    def info_3dinfo(self,dset,output):
+        ''':meth:`neural.dsets._dset_info_afni`, as if ``3dinfo`` had printed ``output``'''
+        subprocess.check_output = lambda *args,**kwargs: output
+        return nl.dsets._dset_info_afni(dset)
+
+    def test_attributes(self):
+        attrs = nl.dsets._read_afni_head('epi+orig.HEAD')
+        self.assertEqual(attrs['IDCODE_STRING'],'XYZ_9wJ4kKYlb1Q7qNNdDo8pDg')
+        self.assertTrue(attrs['HISTORY_NOTE'].endswith('epi_*.dcm'))
+        self.assertEqual(attrs['DATASET_DIMENSIONS'],[4,5,3,0,0])
+        self.assertEqual(attrs['TAXIS_NUMS'],[6,3,77001,-999,-999,-999,-999,-999])
+        self.assertEqual(attrs['BRICK_STATS'][:4],[0.0,1000.0,1.0,1001.0])
+        self.assertEqual(attrs['DELTA'],[-3.0,-3.0,3.5])
+        self.assertEqual(nl.dsets._read_afni_head('stats+tlrc.HEAD')['BRICK_LABS'],'Full_Coef~Full_Tstat~Full_Fstat')
+
+    def test_matches_3dinfo(self):
+        for (dset,output) in [('epi+orig',_epi_3dinfo),('stats+tlrc',_stats_3dinfo)]:
+            reference = self.info_3dinfo(dset,output)
+            for name in [dset,dset + '.HEAD',dset + '.BRIK']:
+                info = nl.dsets._dset_info_native(name)
+                for field in ['subbricks','reps','orient','voxel_size','voxel_volume','voxel_dims','spatial_from','spatial_to','slice_timing','TR','filetype','space']:
+                    self.assertEqual(getattr(info,field),getattr(reference,field),'%s %s' % (name,field))
+                # 3dinfo also printed the creation date after the identifier
+                self.assertEqual(info.identifier,reference.identifier.split()[0])
+        self.assertEqual(nl.dset_info('stats+tlrc').subbrick_labeled('Full_Tstat'),1)
+
+    def test_slice_offsets(self):
+        # without a history, the slice timing pattern comes from the time offsets of the slices
+        with open('epi+orig.HEAD','w') as f:
+            f.write(_epi_head.replace('alt+z','').replace('-time:zt','-time'))
+        info = nl.dsets._dset_info_native('epi+orig')
+        self.assertEqual((info.slice_timing,info.TR),('alt+z',2.0))
+
+    def test_not_native(self):
+        # subbrick selectors and broken headers are left to 3dinfo
+        self.assertEqual(nl.dsets._dset_info_native('epi+orig[2]'),None)
+        with open('broken+orig.HEAD','w') as f:
+            f.write(_epi_head.replace('ORIENT_SPECIFIC','ORIENT'))
+        self.assertEqual(nl.dsets._dset_info_native('broken+orig'),None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+'''tests of :meth:`neural.utils.find_duplicates` and :meth:`neural.dicom.find_dups`, compared to hashing every
+file completely'''
+import common
+import os,hashlib,unittest
+import numpy as np
+import neural as nl
+import neural.dicom
+import synthetic
+
+def _reference_duplicates(filenames):
+    '''groups the files by the MD5 of their whole contents'''
+    groups = {}
+    for f in filenames:
+        with open(f,'rb') as fp:
+            groups.setdefault(hashlib.md5(fp.read()).hexdigest(),[]).append(f)
+    return [x for x in groups.values() if len(x)>1]
+
+def _normalize(duplicates):
+    return sorted([sorted(x) for x in duplicates])
+
+class TestFindDuplicates(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        rand = np.random.RandomState(0)
+        big = rand.bytes(20000)
+        small = rand.bytes(100)
+        contents = {
+            'big1': big, 'big2': big, 'big3': big,
+            # the same size and first few KB as the big ones, but different after that
+            'big_changed': big[:-1] + chr((ord(big[-1])+1) % 256),
+            'small1': small, 'small2': small,
+            # the same size as the small ones
+            'small_other': rand.bytes(100),
+            'unique': rand.bytes(50),
+            'empty1': '', 'empty2': ''
+        }
+        for name in contents:
+            with open(name,'wb') as f:
+                f.write(contents[name])
+        self.files = sorted(contents)
+        self.old_hash_file_part = nl.utils._hash_file_part
+
+    def tearDown(self):
+        nl.utils._hash_file_part = self.old_hash_file_part
+        common.TempDirTestCase.tearDown(self)
+
+    def test_matches_reference(self):
+        reference = _normalize(_reference_duplicates(self.files))
+        self.assertEqual(reference,[['big1','big2','big3'],['empty1','empty2'],['small1','small2']])
+        algorithms = ['md5','sha1'] + (['xxhash'] if nl.utils.xxhash else [])
+        for algorithm in algorithms:
+            for workers in [1,3]:
+                for prefix_size in [4096,100,1]:
+                    duplicates = nl.utils.find_duplicates(self.files + ['missing'],algorithm=algorithm,prefix_size=prefix_size,workers=workers)
+                    self.assertEqual(_normalize(duplicates),reference)
+
+    def test_reads_only_needed(self):
+        hashed = []
+        def hash_file_part(args):
+            hashed.append((args[0],args[2]))
+            return self.old_hash_file_part(args)
+        nl.utils._hash_file_part = hash_file_part
+        nl.utils.find_duplicates(self.files)
+        # files with a unique size aren't read at all, and only files whose prefixes match are read completely
+        self.assertFalse('unique' in [x[0] for x in hashed])
+        self.assertEqual(sorted([x[0] for x in hashed if x[1]==None]),['big1','big2','big3','big_changed'])
+
+class TestFindDups(common.TempDirTestCase):
+    def test_scan_dir(self):
+        files = synthetic.make_dicom_series('dicoms',num_series=2,slices=3,reps=2,rows=8,cols=8,duplicates=3)
+        reference = _normalize(_reference_duplicates(files))
+        self.assertEqual(len(reference),3)
+        for md5_hash in [False,True]:
+            scanned = nl.dicom.scan_dir('dicoms',md5_hash=md5_hash)
+            for workers in [1,2]:
+                self.assertEqual(_normalize(nl.dicom.find_dups(scanned,workers=workers)),reference)
+
+if __name__ == '__main__':
+    unittest.main()
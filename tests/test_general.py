@@ -0,0 +1,74 @@
+'''tests of the voxel-wise functions of :class:`neural.general.Analyze`, compared to doing the same thing with numpy'''
+import common
+import unittest
+import numpy as np
+import nibabel as nib
+import neural as nl
+import neural.general
+import synthetic
+
+def _cv(x):
+    '''coefficient of variation of each row'''
+    return x.std(axis=1) / x.mean(axis=1)
+
+def _mean_and_max(x):
+    return np.vstack((x.mean(axis=1),x.max(axis=1))).T
+
+class TestAnalyze(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.shape = (9,10,7,15)
+        synthetic.make_nifti('epi.nii',self.shape)
+        synthetic.make_nifti('epi.nii.gz',self.shape)
+        self.data = nib.load('epi.nii').get_data().astype(float)
+        self.mask = np.zeros(self.shape[:3],dtype=np.int16)
+        self.mask[2:7,1:8,3:6] = 1
+        self.mask[0,0,0] = 1
+        nib.save(nib.Nifti1Image(self.mask,nib.load('epi.nii').affine),'mask.nii.gz')
+
+    def test_apply(self):
+        cv = self.data.std(axis=3) / self.data.mean(axis=3)
+        for dset in ['epi.nii','epi.nii.gz']:
+            analyze = nl.general.Analyze(dset)
+            for (chunk_size,workers) in [(10000,1),(7,1),(50,2)]:
+                self.assertTrue(np.allclose(analyze.apply(_cv,chunk_size=chunk_size,workers=workers),cv))
+                masked = analyze.apply(_cv,mask='mask.nii.gz',chunk_size=chunk_size,workers=workers,fill=-1)
+                self.assertTrue(np.allclose(masked,np.where(self.mask,cv,-1)))
+
+    def test_apply_4d(self):
+        analyze = nl.general.Analyze('epi.nii')
+        out = analyze.apply(_mean_and_max,mask=self.mask>0,chunk_size=30,prefix='out.nii.gz')
+        self.assertEqual(out.shape,self.shape[:3] + (2,))
+        self.assertTrue(np.allclose(out[...,0],np.where(self.mask,self.data.mean(axis=3),0)))
+        self.assertTrue(np.allclose(out[...,1],np.where(self.mask,self.data.max(axis=3),0)))
+        saved = nib.load('out.nii.gz')
+        self.assertTrue(np.allclose(saved.get_data(),out))
+        self.assertTrue(np.allclose(saved.affine,analyze.dset.affine))
+
+    def test_errors(self):
+        analyze = nl.general.Analyze('epi.nii')
+        # not one value per voxel
+        self.assertEqual(analyze.apply(lambda x: x[:1].mean(axis=1)),None)
+        self.assertEqual(analyze.apply(_cv,mask=self.mask[:-1]),None)
+
+    def test_voxel_chunks(self):
+        analyze = nl.general.Analyze('epi.nii')
+        chunks = list(analyze.voxel_chunks(mask=self.mask,chunk_size=40))
+        self.assertEqual([len(x[0]) for x in chunks],[40,40,26])
+        # every voxel in the mask, in the order they are stored (x changing fastest)
+        xyz = np.unravel_index(np.concatenate([x[0] for x in chunks]),self.shape[:3],order='F')
+        self.assertEqual(sorted(zip(*xyz)),sorted(zip(*np.nonzero(self.mask))))
+        self.assertEqual(list(xyz[0][:3]),[0,2,3])
+        self.assertTrue(np.array_equal(np.vstack([x[1] for x in chunks]),self.data[xyz]))
+        (matrix,indices) = analyze.voxel_matrix()
+        self.assertTrue(np.array_equal(matrix,self.data.reshape((-1,self.shape[3]),order='F')))
+
+    def test_voxel_loop(self):
+        analyze = nl.general.Analyze('epi.nii.gz')
+        voxels = list(analyze.voxel_loop())
+        self.assertEqual(len(voxels),np.prod(self.shape[:3]))
+        for (xyz,series) in voxels[::37]:
+            self.assertTrue(np.array_equal(series,self.data[xyz]))
+
+if __name__ == '__main__':
+    unittest.main()
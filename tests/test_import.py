@@ -0,0 +1,95 @@
+'''tests that ``import neural`` doesn't load heavy dependencies or contact PyPI, and of the update check in
+:mod:`neural.update`'''
+import common
+import os,sys,json,time,subprocess,unittest,urllib2,StringIO
+import neural as nl
+import neural.lazy
+import neural.update
+
+def _import_neural(code,env={}):
+    '''runs ``import neural`` followed by ``code`` in a new Python, and returns what ``code`` printed'''
+    new_env = dict([(k,v) for (k,v) in os.environ.items() if not k.startswith('NEURAL_')] + env.items())
+    new_env['PYTHONPATH'] = os.path.dirname(common.tests_dir)
+    return subprocess.check_output([sys.executable,'-c','import sys,json,neural\n' + code],env=new_env)
+
+class TestImport(common.TempDirTestCase):
+    def test_nothing_heavy(self):
+        code = 'print json.dumps([m for m in sys.modules if sys.modules[m]!=None])'
+        modules = json.loads(_import_neural(code))
+        for module in ['numpy','nibabel','pydicom','fuzzywuzzy','chardet','zmq','urllib2','xmlrpclib','smtplib',
+                       'neural.dag','neural.scheduler','neural.eprime','neural.update']:
+            self.assertFalse(module in modules,module)
+
+    def test_lazy_submodules(self):
+        code = '\n'.join([
+            'dag = neural.dag',
+            'loaded = "neural.dag" in sys.modules',
+            'print json.dumps([loaded,neural.dag.__name__,type(neural.dag).__name__,"neural.dag" in sys.modules,neural.dag is sys.modules["neural.dag"]])'
+        ])
+        self.assertEqual(json.loads(_import_neural(code)),[False,'neural.dag','module',True,True])
+
+    def test_lazy_import(self):
+        namespace = {}
+        namespace['json_module'] = namespace['other_name'] = nl.lazy.lazy_import('json',namespace)
+        self.assertEqual(namespace['json_module'].dumps([1]),'[1]')
+        # every name for the stand-in is replaced with the module
+        self.assertTrue(namespace['json_module'] is json and namespace['other_name'] is json)
+        self.assertRaises(ImportError,lambda: nl.lazy.lazy_import('no_such_module').anything)
+
+class TestUpdate(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.old = (nl.update.cache_file,urllib2.urlopen,nl.version)
+        nl.update.cache_file = os.path.join(self.dir,'update_check')
+        nl.version = '1.2.5'
+        self.requests = []
+        self.latest = '1.3.0'
+        def urlopen(url,timeout=None):
+            self.requests.append((url,timeout))
+            if self.latest==None:
+                raise urllib2.URLError('no network')
+            return StringIO.StringIO(json.dumps({'info':{'version':self.latest}}))
+        urllib2.urlopen = urlopen
+
+    def tearDown(self):
+        (nl.update.cache_file,urllib2.urlopen,nl.version) = self.old
+        common.TempDirTestCase.tearDown(self)
+
+    def test_cached(self):
+        self.assertEqual(nl.update.check_for_update(),'1.3.0')
+        self.assertEqual(self.requests,[(nl.update.pypi_url,nl.update.timeout)])
+        # the answer is saved, so PyPI isn't asked again until it's old
+        self.assertEqual(nl.update.check_for_update(),'1.3.0')
+        self.assertEqual(len(self.requests),1)
+        self.latest = '1.4.0'
+        self.assertEqual(nl.update.check_for_update(force=True),'1.4.0')
+        with open(nl.update.cache_file,'w') as f:
+            json.dump({'time':time.time() - nl.update.cache_hours*3600 - 1,'latest':'1.3.0'},f)
+        self.assertEqual(nl.update.check_for_update(),'1.4.0')
+        self.assertEqual(len(self.requests),3)
+
+    def test_no_network(self):
+        self.latest = None
+        self.assertEqual(nl.update.check_for_update(),None)
+        self.assertFalse(os.path.exists(nl.update.cache_file))
+
+    def test_background(self):
+        thread = nl.update.check_for_update(block=False)
+        thread.join(5)
+        self.assertTrue(thread.daemon and not thread.is_alive())
+        self.assertEqual(len(self.requests),1)
+        with open(nl.update.cache_file) as f:
+            self.assertEqual(json.load(f)['latest'],'1.3.0')
+
+    def test_on_import(self):
+        # only checks when asked to, and then uses the saved answer
+        code = 'print json.dumps("neural.update" in sys.modules)'
+        with open(nl.update.cache_file,'w') as f:
+            json.dump({'time':time.time(),'latest':'1.3.0'},f)
+        self.assertEqual(json.loads(_import_neural(code)),False)
+        env = {'NEURAL_CHECK_UPDATES':'1','HOME':self.dir}
+        os.rename(nl.update.cache_file,os.path.join(self.dir,'.neural_update_check'))
+        self.assertEqual(json.loads(_import_neural(code,env)),True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+'''tests of :meth:`neural.qc.outcount_native` and the clipping in :meth:`neural.preprocess.create_censor_file`,
+compared to plain numpy versions'''
+import common
+import math,unittest
+import numpy as np
+import nibabel as nib
+import neural as nl
+import neural.preprocess
+import synthetic
+
+def _reference_outcount(data,mask,polort,qthr=0.001):
+    '''the fraction of outliers at each time point in the voxels of ``mask``, one voxel at a time'''
+    reps = data.shape[3]
+    series = data.reshape((-1,reps),order='F').astype(float)
+    voxels = np.flatnonzero(mask.reshape(-1,order='F'))
+    legendre = np.polynomial.legendre.legvander(np.linspace(-1,1,reps),polort)
+    threshold = nl.qc._qginv(qthr/reps)*math.sqrt(math.pi/2)
+    counts = np.zeros(reps)
+    for voxel in voxels:
+        residual = series[voxel] - legendre.dot(np.linalg.lstsq(legendre,series[voxel],rcond=None)[0])
+        deviation = np.abs(residual - np.median(residual))
+        mad = np.median(deviation)
+        if mad>0:
+            counts += deviation > threshold*mad
+    return counts/len(voxels)
+
+def _reference_clip(outcount,fraction,clip_to):
+    '''keeps the excluded point with the fewest outliers until few enough are excluded, one at a time'''
+    binary_outcount = [x<fraction for x in outcount]
+    while 1.-(sum(binary_outcount)/float(len(outcount))) > clip_to:
+        best_outlier = min([(outcount[i],i) for i in range(len(outcount)) if not binary_outcount[i]])
+        binary_outcount[best_outlier[1]] = True
+    return [int(x) for x in binary_outcount]
+
+class TestOutcount(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        rand = np.random.RandomState(0)
+        self.dset = synthetic.make_nifti('epi.nii',(12,12,8,60))
+        image = nib.load(self.dset)
+        data = image.get_data().astype(float)
+        # a slow drift, a dark border outside of the "brain" and spikes at a few time points
+        data += np.linspace(0,200,data.shape[3])
+        data[:2] = data[-2:] = 10*rand.rand(2,12,8,60)
+        self.brain = np.zeros(data.shape[:3],dtype=bool)
+        self.brain[2:-2] = True
+        self.spikes = [10,25,40]
+        for t in self.spikes:
+            data[...,t][rand.rand(12,12,8)<0.4] += 1000
+        self.data = data.astype(np.int16)
+        nib.save(nib.Nifti1Image(self.data,image.affine),self.dset)
+
+    def test_matches_reference(self):
+        polort = int(nl.auto_polort(self.dset))
+        # the automask should be exactly the "brain"
+        reference = _reference_outcount(self.data,self.brain,polort)
+        for (chunk_size,workers) in [(20000,1),(100,1),(100,2)]:
+            oc = nl.qc.outcount_native(self.dset,chunk_size=chunk_size,workers=workers)
+            self.assertEqual(len(oc),self.data.shape[3])
+            self.assertTrue(np.allclose(oc,reference))
+
+    def test_automask(self):
+        mean = self.data.mean(axis=3)
+        self.assertTrue(np.array_equal(nl.qc._automask(mean.reshape(-1,order='F')).reshape(mean.shape,order='F'),self.brain))
+        # most of the voxels are at 1000, so the clip level is 500
+        mean = np.array([0,-5,5,499,501,600] + [1000]*20 + [2000]*5,dtype=float)
+        self.assertEqual(list(np.flatnonzero(nl.qc._automask(mean))),range(4,len(mean)))
+
+    def test_spikes_found(self):
+        (oc,perc_outliers) = nl.qc.outcount(self.dset,native=True)
+        self.assertEqual(list(np.flatnonzero(np.array(oc)>=0.1)),self.spikes)
+        self.assertAlmostEqual(perc_outliers,len(self.spikes)/60.)
+
+class TestCensorClipping(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.dset = synthetic.make_nifti('epi.nii',(4,4,4,50))
+        self.old_outcount = nl.qc.outcount
+
+    def tearDown(self):
+        nl.qc.outcount = self.old_outcount
+        common.TempDirTestCase.tearDown(self)
+
+    def censor(self,outcount,clip_to):
+        nl.qc.outcount = lambda dset,fraction,native: (list(outcount),None)
+        self.assertTrue(nl.preprocess.create_censor_file(self.dset,'censor.1D',clip_to=clip_to,max_exclude=None))
+        with open('censor.1D') as f:
+            return [int(x) for x in f.read().split()]
+
+    def test_matches_reference(self):
+        rand = np.random.RandomState(0)
+        for i in xrange(20):
+            # rounded, so there are plenty of ties between the points
+            outcount = np.round(rand.rand(50)**2,1)
+            for clip_to in [0.01,0.05,0.1,0.2,0.33,0.5]:
+                self.assertEqual(self.censor(outcount,clip_to),_reference_clip(outcount,0.1,clip_to))
+
+class TestSummaryMaps(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.dset = synthetic.make_nifti('epi.nii.gz',(10,12,8,37))
+        image = nib.load(self.dset)
+        self.affine = image.affine
+        self.data = image.get_data().astype(float)
+
+    def check_maps(self,maps,data,mask):
+        mean = data.mean(axis=3)
+        stdev = data.std(axis=3,ddof=1) if data.shape[3]>1 else np.zeros(data.shape[:3])
+        for (name,reference) in [('mean',mean),('stdev',stdev),('tsnr',np.where(stdev>0,mean/np.where(stdev>0,stdev,1),0))]:
+            self.assertTrue(np.allclose(maps[name],np.where(mask,reference,0)),name)
+        dvars = np.sqrt((np.diff(data[mask],axis=1)**2).mean(axis=0))
+        self.assertTrue(np.allclose(maps['dvars'],np.concatenate(([0],dvars))))
+
+    def test_matches_numpy(self):
+        for chunk_size in [1,5,16,37,100]:
+            self.check_maps(nl.qc.summary_maps(self.dset,chunk_size=chunk_size),self.data,np.ones(self.data.shape[:3],dtype=bool))
+
+    def test_mask_and_prefix(self):
+        mask = np.zeros(self.data.shape[:3],dtype=np.int16)
+        mask[2:7,3:9,1:5] = 1
+        nib.save(nib.Nifti1Image(mask,self.affine),'mask.nii.gz')
+        maps = nl.qc.summary_maps(self.dset,mask='mask.nii.gz',prefix='epi')
+        self.check_maps(maps,self.data,mask>0)
+        for name in ['mean','stdev','tsnr']:
+            self.assertTrue(np.allclose(nib.load('epi_%s.nii.gz' % name).get_data(),maps[name]))
+        self.assertTrue(np.allclose(np.loadtxt('epi_dvars.1D'),maps['dvars'],rtol=1e-5))
+        nib.save(nib.Nifti1Image(mask[:-1],self.affine),'small.nii.gz')
+        self.assertEqual(nl.qc.summary_maps(self.dset,mask='small.nii.gz'),None)
+
+    def test_single_volume(self):
+        # a 3D dataset with fewer slices than the chunk size, which used to be chunked along z
+        nib.save(nib.Nifti1Image(self.data[...,0],self.affine),'volume.nii.gz')
+        maps = nl.qc.summary_maps('volume.nii.gz',chunk_size=16)
+        self.check_maps(maps,self.data[...,:1],np.ones(self.data.shape[:3],dtype=bool))
+        self.assertEqual(list(maps['dvars']),[0.])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+'''tests of running commands with :meth:`neural.utils.run` and :meth:`neural.utils.run_all`, and recording them with
+:class:`neural.utils.RunProfiler`'''
+import common
+import os,json,signal,subprocess,time,unittest
+import neural as nl
+
+class TestRun(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.old_profiler = nl.utils.run_profiler
+        nl.utils.run_profiler = nl.utils.RunProfiler(enabled=True)
+
+    def tearDown(self):
+        nl.utils.run_profiler = self.old_profiler
+        common.TempDirTestCase.tearDown(self)
+
+    def test_matches_subprocess(self):
+        for command in [['echo','out'],['sh','-c','echo out; echo err >&2; exit 3']]:
+            process = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+            result = nl.utils.run(command,quiet=None)
+            self.assertEqual((result.output,result.return_code),(output,process.returncode))
+
+    def test_interrupted(self):
+        # signals keep arriving while the command runs, like SIGCHLD from a pool or a timer
+        old_handler = signal.signal(signal.SIGALRM,lambda signum,frame: None)
+        signal.setitimer(signal.ITIMER_REAL,0.01,0.01)
+        try:
+            # waits while reading the output, and then (after closing it) while waiting for the process to exit
+            result = nl.utils.run(['sh','-c','sleep 0.2; echo done; exec >&- 2>&-; sleep 0.2'])
+        finally:
+            signal.setitimer(signal.ITIMER_REAL,0)
+            signal.signal(signal.SIGALRM,old_handler)
+        self.assertEqual((result.output,result.return_code),('done\n',0))
+
+    def test_profiler(self):
+        nl.utils.run_profiler.log_file = 'log.jsonl'
+        nl.utils.run(['sh','-c','echo made > made.txt'],products='made.txt')
+        nl.utils.run(['sh','-c','exit 2'],quiet=None)
+        records = nl.utils.run_profiler.records
+        self.assertEqual([x['command'] for x in records],[['sh','-c','echo made > made.txt'],['sh','-c','exit 2']])
+        self.assertEqual([x['return_code'] for x in records],[0,2])
+        self.assertEqual(records[0]['products'],['made.txt'])
+        self.assertEqual(records[0]['working_directory'],os.getcwd())
+        for record in records:
+            self.assertTrue(record['wall']>=0 and record['max_rss']>0)
+        with open('log.jsonl') as f:
+            self.assertEqual([json.loads(x) for x in f],json.loads(json.dumps(records)))
+        nl.utils.run_profiler.write_chrome_trace('trace.json')
+        with open('trace.json') as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual([(x['name'],x['ph'],x['args']['return_code']) for x in events],[('sh','X',0),('sh','X',2)])
+        nl.utils.run_profiler.clear()
+        self.assertEqual(nl.utils.run_profiler.records,[])
+
+class TestRunAll(common.TempDirTestCase):
+    def test_matches_subprocess(self):
+        os.mkdir('sub')
+        commands = [['echo','job %d' % i] for i in xrange(6)] + [['sh','-c','echo out; echo err >&2; exit 3'],['pwd']]
+        results = nl.utils.run_all(commands[:-1] + [{'command':commands[-1],'working_directory':'sub'}],max_concurrent=3,quiet=None)
+        for (command,result) in zip(commands,results):
+            process = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,cwd='sub' if command==['pwd'] else None)
+            output = process.communicate()[0]
+            self.assertEqual((result.output,result.return_code),(output,process.returncode))
+        # never changes directory itself
+        self.assertEqual(os.getcwd(),self.dir)
+
+    def test_products_and_stderr(self):
+        future = nl.utils.run_async(['sh','-c','echo made > made.txt; echo err >&2'],products='made.txt',stderr=None)
+        result = future.result(10)
+        self.assertTrue(future.done())
+        self.assertEqual((result.output,result.output_filename),('','made.txt'))
+        # the products already exist, so it isn't run again
+        self.assertEqual(nl.utils.run_async(['sh','-c','exit 1'],products='made.txt').result(10),False)
+
+    def test_concurrent(self):
+        start = time.time()
+        results = nl.utils.run_all([['sleep','0.5']]*4,max_concurrent=4)
+        self.assertTrue(time.time()-start<1.5)
+        start = time.time()
+        results += nl.utils.run_all([['sleep','0.3']]*3,max_concurrent=1)
+        self.assertTrue(time.time()-start>=0.9)
+        self.assertEqual([x.return_code for x in results],[0]*7)
+
+    def test_cancel(self):
+        future = nl.utils.run_async(['sleep','10'])
+        time.sleep(0.2)
+        start = time.time()
+        future.cancel()
+        self.assertEqual(future.result(5),None)
+        self.assertTrue(future.done() and future.cancelled)
+        self.assertTrue(time.time()-start<2)
+        # the first failure stops the ones that are running, and the ones that haven't started never do
+        commands = [['sh','-c','sleep 0.2; exit 1'],['sleep','10'],['sh','-c','touch never_ran']]
+        start = time.time()
+        results = nl.utils.run_all(commands,max_concurrent=2,cancel_on_error=True,quiet=None)
+        self.assertTrue(time.time()-start<5)
+        self.assertEqual(results[0].return_code,1)
+        self.assertEqual(results[1:],[None,None])
+        time.sleep(0.2)
+        self.assertFalse(os.path.exists('never_ran'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+'''tests of :class:`neural.utils.RunCache`, compared to running the same commands without it'''
+import common
+import os,time,subprocess,unittest
+import neural as nl
+
+class TestRunCache(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.old_cache = nl.utils.run_cache
+        nl.utils.run_cache = nl.utils.RunCache(os.path.join(self.dir,'store'),enabled=True)
+        self.write('in.txt','c\nb\na\n')
+
+    def tearDown(self):
+        nl.utils.run_cache = self.old_cache
+        common.TempDirTestCase.tearDown(self)
+
+    def write(self,filename,contents):
+        with open(filename,'w') as f:
+            f.write(contents)
+
+    def read(self,filename):
+        with open(filename) as f:
+            return f.read()
+
+    def sort(self,input_file='in.txt',output_file='out.txt'):
+        '''runs ``sort`` through :meth:`neural.utils.run` and returns what it made, and the same without the cache'''
+        nl.utils.run(['sort','-o',output_file,input_file],products=output_file,quiet=True)
+        subprocess.check_call(['sort','-o','reference.txt',input_file])
+        return (self.read(output_file),self.read('reference.txt'))
+
+    def test_restored(self):
+        (out,reference) = self.sort()
+        self.assertEqual(out,reference)
+        os.remove('out.txt')
+        (out,reference) = self.sort()
+        self.assertEqual(out,reference)
+        self.assertEqual((nl.utils.run_cache.hits,nl.utils.run_cache.misses),(1,1))
+
+    def test_changed_input(self):
+        self.sort()
+        os.remove('out.txt')
+        self.write('in.txt','z\ny\n')
+        (out,reference) = self.sort()
+        self.assertEqual(out,reference)
+        self.assertEqual(nl.utils.run_cache.hits,0)
+
+    def test_same_contents_elsewhere(self):
+        self.sort()
+        os.makedirs('other')
+        self.write(os.path.join('other','in.txt'),self.read('in.txt'))
+        with nl.run_in('other'):
+            (out,reference) = self.sort()
+        self.assertEqual(out,reference)
+        self.assertEqual(nl.utils.run_cache.hits,1)
+
+    def test_product_changed_in_place(self):
+        self.sort()
+        # the product is a hardlink into the store, so this changes the stored copy too
+        with open('out.txt','a') as f:
+            f.write('changed\n')
+        os.utime('out.txt',(time.time()+10,time.time()+10))
+        os.remove('out.txt')
+        (out,reference) = self.sort()
+        self.assertEqual(out,reference)
+        self.assertEqual(nl.utils.run_cache.hits,0)
+
+    def test_changed_object_not_reused(self):
+        self.sort()
+        with open('out.txt','a') as f:
+            f.write('changed\n')
+        os.utime('out.txt',(time.time()+10,time.time()+10))
+        # a different command with the same product as the first one, before it was changed
+        (out,reference) = self.sort(output_file='other.txt')
+        self.assertEqual(out,reference)
+        os.remove('other.txt')
+        (out,reference) = self.sort(output_file='other.txt')
+        self.assertEqual(out,reference)
+        self.assertEqual(nl.utils.run_cache.hits,1)
+
+    def test_file_hashes_bounded(self):
+        cache = nl.utils.RunCache(os.path.join(self.dir,'store'),max_hashes=3)
+        for i in xrange(6):
+            self.write('%d.txt' % i,str(i))
+        first = cache._file_id('0.txt')
+        for i in xrange(6):
+            cache._file_id('%d.txt' % i)
+        self.assertEqual(len(cache._file_hashes),3)
+        self.assertEqual(cache._file_id('0.txt'),first)
+
+if __name__ == '__main__':
+    unittest.main()
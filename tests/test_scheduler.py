@@ -0,0 +1,237 @@
+'''tests of running jobs on a :class:`neural.scheduler.Server`, compared to running the same commands directly'''
+import common
+import os,time,signal,socket,subprocess,multiprocessing,unittest
+import neural as nl
+import neural.scheduler
+
+def _free_port():
+    '''returns a port that nothing is listening on (and the one after it, hopefully)'''
+    s = socket.socket()
+    s.bind(('localhost',0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class TestScheduler(common.TempDirTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.port = _free_port()
+        server = nl.scheduler.Server(name='test',port=cls.port,workers=2)
+        # the server is started before this process uses zmq, so it doesn't inherit any sockets
+        cls.server = multiprocessing.Process(target=server.start_server)
+        cls.server.start()
+        for i in xrange(50):
+            if nl.scheduler.server_info('localhost',cls.port)!=None:
+                break
+            time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        # Ctrl-C makes the server stop its workers
+        os.kill(cls.server.pid,signal.SIGINT)
+        cls.server.join(10)
+        if cls.server.is_alive():
+            cls.server.terminate()
+
+    def test_server_info(self):
+        info = nl.scheduler.server_info('localhost',self.port)
+        self.assertEqual(info.name,'test')
+        self.assertEqual(info.workers,2)
+
+    def test_matches_subprocess(self):
+        commands = [['echo','job %d' % i] for i in xrange(10)] + [['sh','-c','echo failed; exit 3']]
+        futures = nl.scheduler.submit_jobs([nl.scheduler.Job(c,working_directory=self.dir) for c in commands],port=self.port)
+        for (command,future) in zip(commands,futures):
+            process = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+            result = future.result(30)
+            self.assertNotEqual(result,None)
+            self.assertEqual(result.output.strip(),output.strip())
+            self.assertEqual(result.return_code,process.returncode)
+
+    def test_binary_output(self):
+        commands = [['printf','\\377\\376 not UTF-8']] + [['echo','job %d' % i] for i in xrange(4)]
+        futures = nl.scheduler.submit_jobs([nl.scheduler.Job(c,working_directory=self.dir) for c in commands],port=self.port)
+        results = [future.result(30) for future in futures]
+        self.assertEqual(results[0].output,u'\ufffd\ufffd not UTF-8')
+        self.assertEqual([x.output.strip() for x in results[1:]],['job %d' % i for i in xrange(4)])
+
+    def test_reused_sockets(self):
+        key = (os.getpid(),'localhost',self.port)
+        nl.scheduler.server_info('localhost',self.port)
+        sockets = list(nl.scheduler._req_sockets[key])
+        self.assertEqual(len(sockets),1)
+        for i in xrange(5):
+            self.assertEqual(nl.scheduler.server_info('localhost',self.port).name,'test')
+        self.assertEqual(nl.scheduler._req_sockets[key],sockets)
+
+    def test_products(self):
+        job = nl.scheduler.Job(['sh','-c','echo made > made.txt'],products='made.txt',working_directory=self.dir)
+        self.assertNotEqual(nl.scheduler.send_job(job,port=self.port),None)
+        with open(os.path.join(self.dir,'made.txt')) as f:
+            self.assertEqual(f.read(),'made\n')
+
+    def test_choose_server(self):
+        scheduler = nl.scheduler.Scheduler()
+        scheduler.add_server('localhost',self.port)
+        for i in xrange(50):
+            if scheduler._free_workers(scheduler.servers[-1])>0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(scheduler.choose_server()['port'],self.port)
+        self.assertEqual(scheduler.choose_server()['port'],self.port)
+        # both workers have jobs placed on them now, so the next one runs locally
+        self.assertEqual(scheduler.choose_server()['address'],'local')
+        scheduler._listener.close()
+
+    def test_heartbeat(self):
+        scheduler = nl.scheduler.Scheduler()
+        scheduler.add_server('localhost',self.port)
+        server = scheduler.servers[-1]
+        try:
+            for i in xrange(50):
+                if server['status']:
+                    break
+                time.sleep(0.1)
+            self.assertEqual((server['status']['name'],server['status']['workers']),('test',2))
+            scheduler.choose_server()
+            self.assertEqual(scheduler._free_workers(server),1)
+            # the next heartbeat counts the jobs that are really running, instead of the ones placed since the last one
+            last_heartbeat = server['last_heartbeat']
+            for i in xrange(50):
+                if server['last_heartbeat']!=last_heartbeat:
+                    break
+                time.sleep(0.1)
+            self.assertEqual((server['placed'],scheduler._free_workers(server)),(0,2))
+            # a server that stops sending heartbeats isn't used any more
+            server['last_heartbeat'] -= nl.scheduler.heartbeat_expire + 1
+            scheduler._listener.close()
+            self.assertEqual(scheduler._free_workers(server),None)
+            self.assertEqual(scheduler.choose_server()['address'],'local')
+        finally:
+            scheduler._listener.close()
+
+    def test_remote_cache(self):
+        (old_scheduler,old_cache) = (nl.scheduler.scheduler,nl.utils.run_cache)
+        # the "speed" policy always picks the fastest server, even before it has sent a heartbeat
+        nl.scheduler.scheduler = nl.scheduler.Scheduler(policy='speed')
+        nl.scheduler.scheduler.add_server('localhost',self.port,speed=10)
+        nl.utils.run_cache = nl.utils.RunCache(os.path.join(self.dir,'store'),enabled=True)
+        # the product is different every time the command really runs
+        command = ['sh','-c','echo $$ > pid.txt']
+        product = os.path.join(self.dir,'pid.txt')
+        try:
+            self.assertEqual(nl.scheduler._new_run(command,'pid.txt',self.dir).return_code,0)
+            with open(product) as f:
+                first = f.read()
+            os.remove(product)
+            self.assertEqual(nl.scheduler._new_run(command,'pid.txt',self.dir).return_code,0)
+            with open(product) as f:
+                self.assertEqual(f.read(),first)
+            self.assertEqual((nl.utils.run_cache.hits,nl.utils.run_cache.misses),(1,1))
+            os.remove(product)
+            future = nl.scheduler.submit(command,'pid.txt',self.dir)
+            self.assertTrue(future.done())
+            self.assertEqual(future.result().output_filename,'pid.txt')
+            os.remove(product)
+            nl.scheduler.submit(command,'pid.txt',self.dir,cache=False).result(30)
+            with open(product) as f:
+                self.assertNotEqual(f.read(),first)
+            self.assertEqual((nl.utils.run_cache.hits,nl.utils.run_cache.misses),(2,1))
+        finally:
+            nl.scheduler.scheduler._listener.close()
+            (nl.scheduler.scheduler,nl.utils.run_cache) = (old_scheduler,old_cache)
+
+class TestPolicies(unittest.TestCase):
+    '''server selection, with made up heartbeats instead of real servers'''
+    def setUp(self):
+        self.schedulers = []
+
+    def tearDown(self):
+        for scheduler in self.schedulers:
+            scheduler._listener.close()
+
+    def scheduler(self,policy,servers):
+        '''a :class:`neural.scheduler.Scheduler` with a server for each tuple of ``(speed,workers,jobs,load)``
+        in ``servers`` (``workers`` is ``None`` for a server that hasn't sent a heartbeat)'''
+        scheduler = nl.scheduler.Scheduler(policy=policy)
+        self.schedulers.append(scheduler)
+        for (speed,workers,jobs,load) in servers:
+            # nothing is listening on these ports, so the heartbeats are all made up here
+            scheduler.add_server('127.0.0.1',_free_port(),speed=speed)
+            if workers!=None:
+                with scheduler.lock:
+                    scheduler.servers[-1]['status'] = {'workers':workers,'jobs':jobs,'load':load,'free_memory':None}
+                    scheduler.servers[-1]['last_heartbeat'] = time.time()
+        return scheduler
+
+    def choices(self,scheduler,n):
+        '''the indices of the servers chosen for the next ``n`` jobs (0 is the local machine)'''
+        return [scheduler.servers.index(scheduler.choose_server()) for i in xrange(n)]
+
+    def test_least_loaded(self):
+        # (jobs + placed) / workers, then the load per worker
+        scheduler = self.scheduler('least_loaded',[(None,4,3,0.5),(None,2,0,1.0),(None,2,0,0.5),(None,4,4,0)])
+        self.assertEqual(self.choices(scheduler,5),[3,2,3,2,1])
+        # everyone is full, so the rest run locally
+        self.assertEqual(self.choices(scheduler,2),[0,0])
+
+    def test_round_robin(self):
+        scheduler = self.scheduler('round_robin',[(3,8,0,0),(1,8,0,0)])
+        choices = self.choices(scheduler,8)
+        # 3 to 1, and spread out instead of in a block
+        self.assertEqual((choices.count(1),choices.count(2)),(6,2))
+        self.assertEqual(choices[:4],[1,1,2,1])
+        # without speeds, the servers are weighted by their number of workers
+        scheduler = self.scheduler('round_robin',[(None,2,0,0),(None,4,0,0)])
+        self.assertEqual(sorted(self.choices(scheduler,6)),[1,1,2,2,2,2])
+
+    def test_speed(self):
+        # the fastest server, whether it's busy or sending heartbeats or not
+        scheduler = self.scheduler('speed',[(2,4,0,0),(5,None,None,None),(3,1,1,0)])
+        self.assertEqual(self.choices(scheduler,3),[2,2,2])
+
+    def test_no_heartbeat(self):
+        for policy in ['least_loaded','round_robin']:
+            scheduler = self.scheduler(policy,[(5,None,None,None),(1,2,0,0)])
+            self.assertEqual(self.choices(scheduler,3),[2,2,0])
+
+class TestNoServer(common.TempDirTestCase):
+    '''talking to a server that never answers'''
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        self.port = _free_port()
+        self.old_timeout = nl.scheduler.default_timeout
+        nl.scheduler.default_timeout = 0.5
+
+    def tearDown(self):
+        nl.scheduler.default_timeout = self.old_timeout
+        common.TempDirTestCase.tearDown(self)
+
+    def test_send_raw(self):
+        start = time.time()
+        self.assertEqual(nl.scheduler._send_raw('hello',port=self.port,timeout=0.2,retries=2),None)
+        self.assertTrue(0.6<=time.time()-start<5)
+        # sockets that timed out can't be used again
+        self.assertEqual(nl.scheduler._req_sockets[(os.getpid(),'localhost',self.port)],[])
+        self.assertEqual(nl.scheduler.server_info('localhost',self.port),None)
+
+    def test_jobs_fail(self):
+        futures = nl.scheduler.submit_jobs([nl.scheduler.Job(['echo','job %d' % i]) for i in xrange(3)],port=self.port)
+        for future in futures:
+            self.assertEqual(future.result(10),None)
+            self.assertEqual(future.error,'lost connection to server')
+
+    def test_run_locally(self):
+        old_scheduler = nl.scheduler.scheduler
+        nl.scheduler.scheduler = nl.scheduler.Scheduler(policy='speed')
+        nl.scheduler.scheduler.add_server('localhost',self.port,speed=10)
+        try:
+            result = nl.scheduler._new_run(['echo','ran here'],working_directory=self.dir)
+            self.assertEqual((result.output.strip(),result.return_code),('ran here',0))
+        finally:
+            nl.scheduler.scheduler._listener.close()
+            nl.scheduler.scheduler = old_scheduler
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+'''tests of the Python ROI statistics in :mod:`neural.stats`, compared to plain numpy versions'''
+import common
+import os,time,unittest
+import numpy as np
+import nibabel as nib
+import neural as nl
+import synthetic
+
+def _reference_stats(values):
+    '''the statistics of :meth:`neural.roi_stats` for a single ROI, the slow way'''
+    (unique,counts) = np.unique(values,return_counts=True)
+    return {
+        'mean': values.mean(), 'median': np.median(values), 'min': values.min(), 'max': values.max(),
+        'sigma': values.std(ddof=1) if len(values)>1 else 0., 'sum': values.sum(),
+        'mode': unique[np.argmax(counts)]
+    }
+
+class TestROIStats(common.TempDirTestCase):
+    def setUp(self):
+        common.TempDirTestCase.setUp(self)
+        rand = np.random.RandomState(0)
+        self.dset = synthetic.make_nifti('epi.nii',(10,12,8,5))
+        image = nib.load(self.dset)
+        self.affine = image.affine
+        # rounded values, with some zeros, so the medians, modes and non-zero statistics all get tested
+        self.data = np.round(image.get_data()/100.).astype(np.int16)
+        self.data[rand.rand(*self.data.shape)<0.2] = 0
+        nib.save(nib.Nifti1Image(self.data,self.affine),self.dset)
+        self.atlas_data = rand.randint(0,6,self.data.shape[:3]).astype(np.int16)
+        self.atlas = 'atlas.nii.gz'
+        nib.save(nib.Nifti1Image(self.atlas_data,self.affine),self.atlas)
+
+    def check_stats(self,stats,labels,brick):
+        self.assertEqual(sorted(stats),sorted([int(x) for x in np.unique(labels) if x>0]))
+        for roi in stats:
+            values = brick[labels==roi].astype(float)
+            for (key,value) in _reference_stats(values).items():
+                self.assertAlmostEqual(stats[roi][key],value,msg='%s of ROI %d' % (key,roi))
+            for (key,value) in _reference_stats(values[values!=0]).items():
+                self.assertAlmostEqual(stats[roi]['nz' + key],value,msg='nz%s of ROI %d' % (key,roi))
+            self.assertEqual(stats[roi]['nzvoxels'],np.count_nonzero(values))
+
+    def test_roi_stats(self):
+        self.check_stats(nl.roi_stats(self.atlas,self.dset,native=True),self.atlas_data,self.data[...,-1])
+
+    def test_resampled_mask(self):
+        # an atlas with voxels twice as big, which has to be resampled onto the grid of the dataset
+        coarse = self.atlas_data[::2,::2,::2]
+        affine = self.affine.dot(np.diag([2.,2.,2.,1.]))
+        nib.save(nib.Nifti1Image(coarse,affine),'coarse.nii.gz')
+        ijk = np.indices(self.data.shape[:3]).reshape(3,-1)
+        source = np.rint(np.linalg.solve(affine,self.affine).dot(np.vstack((ijk,np.ones(ijk.shape[1]))))[:3]).astype(int)
+        inside = np.all([(source[d]>=0) & (source[d]<coarse.shape[d]) for d in xrange(3)],axis=0)
+        labels = np.zeros(ijk.shape[1],dtype=int)
+        labels[inside] = coarse[source[0,inside],source[1,inside],source[2,inside]]
+        labels = labels.reshape(self.data.shape[:3])
+        self.check_stats(nl.roi_stats('coarse.nii.gz',self.dset,native=True),labels,self.data[...,-1])
+
+    def test_voxel_count(self):
+        brick = self.data[...,0]
+        self.assertEqual(nl.voxel_count(self.dset,native=True),np.count_nonzero(brick))
+        counts = nl.voxel_count(self.dset,mask=self.atlas,ROI='all',native=True)
+        for roi in xrange(1,6):
+            self.assertEqual(counts[roi],np.count_nonzero(brick[self.atlas_data==roi]))
+        self.assertEqual(nl.voxel_count(self.dset,mask=self.atlas,ROI=[2,3],native=True),counts[2]+counts[3])
+
+    def test_mask_average(self):
+        self.assertAlmostEqual(nl.mask_average(self.dset,self.atlas,native=True),self.data[...,-1][self.atlas_data>0].mean())
+
+    def test_sphere_average(self):
+        # coordinates of every voxel, in RAI order
+        ijk = np.indices(self.data.shape[:3]).reshape(3,-1)
+        xyz = self.affine[:3,:3].dot(ijk) + self.affine[:3,3:]
+        xyz[:2] *= -1
+        center = xyz[:,len(xyz[0])//3]
+        inside = np.sqrt(((xyz - center[:,None])**2).sum(axis=0))<=5
+        reference = self.data.reshape((-1,self.data.shape[3]))[inside].mean(axis=0)
+        averages = nl.sphere_average(self.dset,center[0],center[1],center[2],5,native=True)
+        self.assertTrue(np.allclose(averages,reference))
+
+    def test_engine_cache(self):
+        engine = nl.stats.roi_engine(self.dset,native=True)
+        self.assertTrue(nl.stats.roi_engine(self.dset,native=True) is engine)
+        self.assertEqual(nl.stats.roi_engine(self.dset,native=False),None)
+        self.assertEqual(nl.stats.roi_engine(self.dset + '[0]',native=None),None)
+        nib.save(nib.Nifti1Image(self.data*2,self.affine),self.dset)
+        os.utime(self.dset,(time.time()+10,time.time()+10))
+        self.assertAlmostEqual(nl.mask_average(self.dset,self.atlas,native=True),2*self.data[...,-1][self.atlas_data>0].mean())
+
+    def test_nothing_kept(self):
+        # a compressed dataset can't be memory-mapped, so keeping it would keep the whole run in memory
+        nib.save(nib.Nifti1Image(self.data,self.affine),'epi.nii.gz')
+        engine = nl.stats.roi_engine('epi.nii.gz',native=True)
+        nl.roi_stats(self.atlas,'epi.nii.gz',native=True)
+        nl.sphere_average('epi.nii.gz',0,0,0,5,native=True)
+        # only the header and the resampled atlas are kept
+        kept = [x for x in vars(engine).values() if isinstance(x,np.ndarray)] + engine._labels.values()
+        self.assertEqual(sum([x.size for x in kept]),self.affine.size + self.data[...,0].size)
+        self.assertEqual(engine.brick(2).tolist(),self.data[...,2].reshape(-1,order='F').tolist())
+
+    def test_chunks(self):
+        engine = nl.stats.ROIStats(self.dset,chunk_size=2)
+        matrix = self.data.reshape((-1,self.data.shape[3]),order='F')
+        self.assertTrue(np.array_equal(np.hstack([x[1] for x in engine.time_chunks()]),matrix))
+        self.assertEqual([x[0] for x in engine.time_chunks()],[0,2,4])
+        self.assertTrue(np.array_equal(engine.series([5,3,100]),matrix[[5,3,100]]))
+        self.assertTrue(np.array_equal(engine.matrix(),matrix))
+
+    def test_other_dimensions(self):
+        # a single volume, and an AFNI bucket saved as a NIfTI file, with the subbricks along the 5th dimension
+        nib.save(nib.Nifti1Image(self.data[...,0],self.affine),'volume.nii')
+        nib.save(nib.Nifti1Image(self.data[:,:,:,None,:],self.affine),'bucket.nii')
+        volume = nl.stats.ROIStats('volume.nii')
+        self.assertEqual(volume.reps,1)
+        self.assertTrue(np.array_equal(volume.brick(-1),self.data[...,0].reshape(-1,order='F')))
+        bucket = nl.stats.ROIStats('bucket.nii')
+        self.assertEqual(bucket.reps,self.data.shape[3])
+        self.assertTrue(np.array_equal(bucket.brick(3),self.data[...,3].reshape(-1,order='F')))
+        self.check_stats(nl.roi_stats(self.atlas,'bucket.nii',native=True),self.atlas_data,self.data[...,-1])
+
+if __name__ == '__main__':
+    unittest.main()